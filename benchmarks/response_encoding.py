@@ -0,0 +1,49 @@
+"""
+    Compare the serialization of large responses with the default encoder of
+    flask_restful (json.dumps) and the fast encoder (object_service.output.dumps),
+    and the size of the responses with the available content encodings.
+
+        python benchmarks/response_encoding.py [number of objects]
+
+    The payloads are a Classic Object Search response (bibcodes) and an object
+    search response (identifiers with canonical names).
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+from flask import Flask
+from object_service import output
+
+def make_payloads(n):
+    bibcodes = ['%s%s%s' % (1990 + i % 30, ['ApJ..', 'A&A..', 'MNRAS', 'AJ...'][i % 4], ('%s' % (i * 7919 % 100000)).rjust(9, '.') + 'X') for i in range(n)]
+    objects = dict(('NAME Object %s' % i, {'id': str(1000000 + i), 'canonical': 'NGC %s' % i}) for i in range(n))
+    return [('nedsrv (%s bibcodes)' % n, {'data': bibcodes}), ('object search (%s objects)' % n, objects)]
+
+def measure(func, data, repeat=10):
+    times = []
+    for i in range(repeat):
+        stime = time.process_time()
+        func(data)
+        times.append(time.process_time() - stime)
+    return min(times)
+
+def main(n=10000):
+    app = Flask(__name__)
+    print('JSON encoder: %s' % ('orjson' if output.orjson is not None else 'json'))
+    print('Content encodings: %s' % ', '.join(output.available_encodings()))
+    with app.app_context():
+        for name, data in make_payloads(n):
+            default = measure(lambda d: json.dumps(d) + '\n', data)
+            fast = measure(output.dumps, data)
+            body = output.dumps(data)
+            print('%s: json.dumps %.1f ms, fast %.1f ms' % (name, default * 1000, fast * 1000))
+            sizes = ['identity %s bytes' % len(body)]
+            for encoding in output.available_encodings():
+                stime = time.process_time()
+                size = len(output.compress(body, encoding))
+                sizes.append('%s %s bytes (%.1f ms)' % (encoding, size, (time.process_time() - stime) * 1000))
+            print('    ' + ', '.join(sizes))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
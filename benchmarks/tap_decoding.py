@@ -0,0 +1,58 @@
+"""
+    Compare the decoding of SIMBAD TAP results in JSON format (r.json()) with the
+    streaming CSV decoder (read_tap_csv), in CPU time and peak memory.
+
+        python benchmarks/tap_decoding.py [number of rows]
+"""
+from __future__ import print_function
+import io
+import sys
+import csv
+import json
+import time
+import tracemalloc
+from requests.models import Response
+from object_service.SIMBAD import read_tap_csv
+
+def make_rows(n):
+    return [[1000000 + i, 'NAME Object %s, "component" %s' % (i, i % 7), 'NGC %s' % i] for i in range(n)]
+
+def make_response(body, content_type):
+    r = Response()
+    r.status_code = 200
+    r.headers['Content-Type'] = content_type
+    r.raw = io.BytesIO(body)
+    return r
+
+def measure(decode, body, content_type, repeat=5):
+    times = []
+    for i in range(repeat):
+        r = make_response(body, content_type)
+        stime = time.process_time()
+        decode(r)
+        times.append(time.process_time() - stime)
+    r = make_response(body, content_type)
+    tracemalloc.start()
+    decode(r)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+def main(n):
+    rows = make_rows(n)
+    json_body = json.dumps({'metadata': [{'name': 'oidref'}, {'name': 'id'}, {'name': 'main_id'}],
+                            'data': rows}).encode('utf-8')
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['oidref', 'id', 'main_id'])
+    writer.writerows(rows)
+    csv_body = out.getvalue().encode('utf-8')
+    results = [('json', len(json_body)) + measure(lambda r: r.json(), json_body, 'application/json'),
+               ('csv', len(csv_body)) + measure(read_tap_csv, csv_body, 'text/csv')]
+    print('%s rows' % n)
+    print('%-6s %12s %12s %14s' % ('format', 'size (kB)', 'CPU (ms)', 'peak mem (kB)'))
+    for fmt, size, cpu, peak in results:
+        print('%-6s %12.0f %12.1f %14.0f' % (fmt, size / 1024.0, cpu * 1000, peak / 1024.0))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -24,16 +24,142 @@ OBJECTS_NED_OBJSEARCH = 'https://ned.ipac.caltech.edu/cgi-bin/objsearch'
 OBJECTS_NED_MAX_RADIUS = 3
 # Maximum number of objects for NED
 OBJECTS_NED_MAX_NUMBER = 50
+# Format of SIMBAD TAP results: 'json', or 'csv' (decoded while it is received,
+# which takes less time and memory for large results)
+OBJECTS_SIMBAD_FORMAT = 'json'
+# Long lists of object names or identifiers are sent to SIMBAD in chunks of at most
+# this many names, and of at most this many bytes
+OBJECTS_SIMBAD_CHUNK_SIZE = 500
+OBJECTS_SIMBAD_CHUNK_BYTES = 20000
+# Number of threads for sending chunks concurrently
+OBJECTS_SIMBAD_CHUNK_WORKERS = 4
 # Time-out in seconds for SIMBAD TAP service requests
 OBJECTS_SIMBAD_TIMEOUT = 8
+# Hedge SIMBAD TAP queries: if the TAP service in use has not answered within the
+# given percentile of its recent response times, send the query to the CDS mirror too
+OBJECTS_SIMBAD_HEDGE = False
+OBJECTS_SIMBAD_HEDGE_PERCENTILE = 95
+# Delay in seconds before hedging, used until enough response times were recorded
+OBJECTS_SIMBAD_HEDGE_DELAY = 1
+# Maximum fraction of recent TAP queries that may be hedged
+OBJECTS_SIMBAD_HEDGE_BUDGET = 0.1
+# Number of threads available for sending hedged TAP queries
+OBJECTS_SIMBAD_HEDGE_WORKERS = 10
 # Time-out in seconds for NED service requests
 OBJECTS_NED_TIMEOUT = 10
+# Maximum time in seconds to spend on upstream calls (SIMBAD, NED, Solr) for one request
+OBJECTS_REQUEST_DEADLINE = 30
+# Header in which callers can specify a shorter time budget (in seconds)
+OBJECTS_DEADLINE_HEADER = 'X-Request-Timeout'
+# Circuit breakers for upstream services (SIMBAD, NED, Solr):
+# rolling window (seconds) over which error and timeout rates are determined
+OBJECTS_CIRCUIT_WINDOW = 60
+# Minimum number of requests in the window before the circuit can open
+OBJECTS_CIRCUIT_MIN_REQUESTS = 5
+# Error rate (including timeouts) at which the circuit opens
+OBJECTS_CIRCUIT_ERROR_RATE = 0.5
+# Timeout rate at which the circuit opens
+OBJECTS_CIRCUIT_TIMEOUT_RATE = 0.3
+# Time in seconds an open circuit fails fast before probing the service again
+OBJECTS_CIRCUIT_COOLDOWN = 30
 # Cache time-out in seconds (one day = 86400, one week = 604800)
 OBJECTS_CACHE_TIMEOUT = 604800
+# Cache time-out in seconds for object names unknown to SIMBAD or NED
+OBJECTS_CACHE_NEGATIVE_TIMEOUT = 3600
+# Time in seconds a timed-out name translation can still be used while it is being
+# refreshed in the background (30 days). Older translations are looked up again first
+OBJECTS_CACHE_MAX_STALE = 2592000
+# Degraded mode: when SIMBAD or NED fail (or their circuit is open), use expired
+# translations if we have them, and flag the response as degraded
+OBJECTS_DEGRADED_MODE = True
+# Time in seconds expired translations are kept for degraded mode (one year)
+OBJECTS_CACHE_DEGRADED_TIMEOUT = 31536000
+# Number of threads for refreshing timed-out translations
+OBJECTS_CACHE_REFRESH_WORKERS = 4
+# Maximum number of entries in the in-process cache of each worker
+OBJECTS_CACHE_SIZE = 10000
+# Redis-compatible store shared by all workers (e.g. 'redis://localhost:6379/0').
+# If not set, every worker only uses its own in-process cache
+OBJECTS_CACHE_REDIS_URL = None
+# Socket time-out in seconds for the shared cache
+OBJECTS_CACHE_REDIS_TIMEOUT = 0.1
+# Time in seconds to leave the shared cache alone after it failed
+OBJECTS_CACHE_RETRY_INTERVAL = 30
+# Prefix for all cache keys
+OBJECTS_CACHE_PREFIX = 'objects'
+# On-disk snapshot of the cache, opened by every worker at startup
+# (e.g. '/tmp/object_service.cache'). If not set, no snapshot is used
+OBJECTS_CACHE_SNAPSHOT = None
+# Interval in seconds for writing the snapshot (workers take turns, using a lock file
+# next to the snapshot, and only replace it when they have something to add)
+OBJECTS_CACHE_SNAPSHOT_INTERVAL = 600
+# Cache namespaces stored in the snapshot
+OBJECTS_CACHE_SNAPSHOT_NAMESPACES = ['simbad', 'ned']
+# Maximum request rates for SIMBAD and NED: [requests per second, burst size]. The
+# limits apply to each host (e.g. each SIMBAD mirror). With more than one worker,
+# set OBJECTS_RATE_LIMIT_DIR (e.g. '/dev/shm'): the workers on a host then share the
+# limits through files in that directory. If not set, every worker has the full
+# rate to itself
+OBJECTS_SIMBAD_RATE_LIMIT = [5, 10]
+OBJECTS_NED_RATE_LIMIT = [10, 20]
+OBJECTS_RATE_LIMIT_DIR = None
+# Admission control for requests doing upstream lookups: maximum number of concurrent
+# requests per client (token) and in total for each worker. Requests over the total
+# limit wait in a queue of limited size for a limited time (seconds). Refused
+# requests get a 429 with a Retry-After header (seconds)
+OBJECTS_ADMISSION_CONTROL = True
+OBJECTS_CLIENT_CONCURRENCY = 4
+OBJECTS_TOTAL_CONCURRENCY = 16
+OBJECTS_ADMISSION_QUEUE = 32
+OBJECTS_ADMISSION_WAIT = 2
+OBJECTS_ADMISSION_RETRY_AFTER = 1
+# Classic Object Search jobs ("async": true): number of threads running jobs, time in
+# seconds a job may take, and time in seconds results are kept
+OBJECTS_JOB_WORKERS = 4
+OBJECTS_JOB_DEADLINE = 300
+OBJECTS_JOB_TTL = 3600
+# Maximum number of queued and running jobs per client and in total (per worker). Jobs
+# over the limit are refused with a 429, and clients are asked to retry after
+# OBJECTS_JOB_RETRY_AFTER seconds
+OBJECTS_JOB_CLIENT_LIMIT = 4
+OBJECTS_JOB_TOTAL_LIMIT = 32
+OBJECTS_JOB_RETRY_AFTER = 10
+# Directory for job records shared by all workers on a host. If not set, every worker
+# keeps its own jobs in memory and only knows about those: with more than one worker
+# process, a poll that ends up at another worker than the one running the job gets a
+# 404 (unknown job). Set this for any deployment with more than one worker.
+OBJECTS_JOB_DIR = None
+# Maximum time in seconds a client can wait for a job to finish in one request
+OBJECTS_JOB_MAX_WAIT = 30
+# Compress responses when the client accepts that (Accept-Encoding): zstd and brotli
+# when the zstandard and brotli modules are installed, otherwise gzip
+OBJECTS_COMPRESSION = True
+# Responses smaller than this number of bytes are not compressed
+OBJECTS_COMPRESSION_MIN_SIZE = 1024
+# Content types of responses that are compressed
+OBJECTS_COMPRESSION_TYPES = ['application/json', 'text/plain']
+# Compression levels per content encoding
+OBJECTS_COMPRESSION_LEVELS = {'gzip': 6, 'br': 4, 'zstd': 3}
+# Cache-Control policies of the object search ('objects') and query translation
+# ('query') responses, which also get an ETag. Errors and degraded responses are not cached
+OBJECTS_CACHE_CONTROL = {'objects': 'public, max-age=3600', 'query': 'public, max-age=3600'}
+# Number of decimals (in degrees) of cone search positions and radii: equivalent cones
+# are rounded to the same canonical cone, used for the upstream query and the cache
+# (5 decimals is 0.036 arcseconds)
+OBJECTS_CONE_PRECISION = 5
 # Default radius for cone search (degrees)
 OBJECTS_DEFAULT_RADIUS = 0.033333333
 # Maximum number of records to send bibcodes back for
 OBJECT_SOLR_MAX_HITS = 10000
+# Time in seconds SIMBAD and NED identifiers found in the Solr index are remembered
+# as being indexed (cone search results are only checked against Solr for the others)
+OBJECTS_SOLR_VERIFY_TTL = 86400
+# Index file of the simbid and nedid values in the Solr index, built offline from
+# terms exports (python -m object_service.idindex). If set, identifiers are checked
+# against this file instead of Solr, and unindexed ones are left out of queries
+OBJECTS_ID_INDEX = None
+# Time in seconds between checks whether the identifier index file was replaced
+OBJECTS_ID_INDEX_CHECK_INTERVAL = 60
 # In what environment are we?
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'staging').lower()
 # General config settings
@@ -9,9 +9,25 @@ import json
 from requests.exceptions import Timeout, ConnectTimeout, ReadTimeout, ConnectionError
 import timeout_decorator
 import datetime
+from collections import OrderedDict
 from .client import client
+from .circuit import get_breaker
+from .deadline import remaining_time
+from .deadline import deadline_exceeded
+from .singleflight import coalesce
+from .cache import get_cache
+from .cache import mark_upstream_failure
+from .ratelimit import wait_for_rate_limit
+from .names import normalize_object_name
+from .cones import canonical_cone
+from .cones import cone_key
+from .cones import cone_coordinates
 
 def do_ned_object_lookup(url, oname):
+    # Concurrent lookups of the same object name (however it is written) share one request
+    return coalesce(('ned', url, normalize_object_name(oname)), send_ned_object_lookup, url, oname)
+
+def send_ned_object_lookup(url, oname):
     # Prepare the headers for the query
     payload = {
         "name": {"v": "{object}".format(object=oname)}
@@ -21,16 +37,39 @@ def do_ned_object_lookup(url, oname):
         'Content-type': 'application/json',
         'Accept': 'text/plain'
     }
-    # Get timeout for request from the config (use 1 second if not found)
-    TIMEOUT = current_app.config.get('OBJECTS_NED_TIMEOUT',1)
+    # Get timeout for request from the config (use 1 second if not found),
+    # limited by the time left before the request deadline
+    TIMEOUT = remaining_time(current_app.config.get('OBJECTS_NED_TIMEOUT',1))
+    if TIMEOUT <= 0:
+        current_app.logger.info('NED request to %s not sent: request deadline exceeded'%url)
+        return {"Error": "Unable to get results!", "Error Info": "NED request not sent: request deadline exceeded"}
+    # Don't wait for NED when it is known to be down
+    breaker = get_breaker(url)
+    if not breaker.allow_request():
+        current_app.logger.info('NED request to %s not sent: circuit is open'%url)
+        return {"Error": "Unable to get results!", "Error Info": "NED service unavailable (circuit open)"}
+    # Stay below the request rate NED allows (shared by the workers on this host), but
+    # don't spend more than half of our time waiting for that
+    waited = wait_for_rate_limit('ned', url, TIMEOUT / 2.0)
+    if waited is None:
+        breaker.release_request()
+        current_app.logger.info('NED request to %s not sent: rate limit'%url)
+        return {"Error": "Unable to get results!", "Error Info": "NED request not sent: rate limit exceeded"}
+    TIMEOUT -= waited
     try:
         r = current_app.client.post(url, data=json.dumps(payload), headers=headers, timeout=TIMEOUT)
     except (ConnectTimeout, ReadTimeout) as err:
+        breaker.record_failure(timeout=True)
         current_app.logger.info('NED request to %s timed out! Request took longer than %s second(s)'%(url, TIMEOUT))
         return {"Error": "Unable to get results!", "Error Info": "NED request timed out: {0}".format(str(err))}
     except Exception as err:
+        breaker.record_failure()
         current_app.logger.error("NED request to %s failed (%s)"%(url, err))
         return {"Error": "Unable to get results!", "Error Info": "NED request failed ({0})".format(err)}
+    if r.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
     # Check if we got a 200 status code back
     if r.status_code != 200:
         current_app.logger.info('NED request to %s failed! Status code: %s'%(url, r.status_code))
@@ -39,21 +78,48 @@ def do_ned_object_lookup(url, oname):
     return r.json()
 
 def get_ned_data(id_list, input_type):
-    QUERY_URL = current_app.config.get('OBJECTS_NED_URL')
-    current_app.logger.info('URL used to get NED data: %s'%QUERY_URL)
-
     results = {}
     results['data'] = {}
     results['skipped'] = []
+    for ident, data in iter_ned_data(id_list, input_type):
+        if data is None:
+            # No usable results for this object
+            results['skipped'].append(ident)
+        elif "Error" in data:
+            # NED query failed. This failure either means timeout or service problems
+            # We return nothing for the entire query, with the proper error message
+            return data
+        else:
+            results['data'][ident] = data
+    return results
+
+def iter_ned_data(id_list, input_type):
+    """
+    Look up the objects in NED one by one: yields tuples of the name (or identifier)
+    and its data, where the data is None for objects NED gave no usable results for,
+    or an error dictionary (after which nothing else is looked up)
+    """
+    QUERY_URL = current_app.config.get('OBJECTS_NED_URL')
+    current_app.logger.info('URL used to get NED data: %s'%QUERY_URL)
+
     # Establish the NED query, based on the type of input
     if input_type in ['identifiers', 'objects']:
-        for ident in id_list:
+        # Every name is only looked up once
+        id_list = list(OrderedDict.fromkeys(id_list))
+        for i, ident in enumerate(id_list):
+            if deadline_exceeded():
+                # Out of time: return what we have so far
+                current_app.logger.info('Request deadline exceeded, skipping NED lookups for %s object(s)'%(len(id_list) - i))
+                mark_upstream_failure()
+                for skipped in id_list[i:]:
+                    yield skipped, None
+                break
             # Since all spaces in the identifiers where replaced by underscores, we have to undo this
             odata = do_ned_object_lookup(QUERY_URL, ident.strip().replace('_',' '))
             if "Error" in odata:
-                # NED query failed. This failure either means timeout or service problems
-                # We return nothing for the entire query, with the proper error message
-                return odata
+                mark_upstream_failure()
+                yield ident, odata
+                return
             # Did we get a successful result back?
             statuscode = odata.get("StatusCode", 999)
             if statuscode == 100:
@@ -62,41 +128,48 @@ def get_ned_data(id_list, input_type):
                 if resultcode == 3:
                     # Proper object name, known by NED
                     if input_type == 'identifiers':
-                        results['data'][ident] = {'id': ident, 'canonical': odata['Preferred']['Name']}
+                        yield ident, {'id': ident, 'canonical': odata['Preferred']['Name']}
                     else:
-                        results['data'][ident] = {'id': odata['Preferred']['Name'].strip().replace(' ','_'), 'canonical': odata['Preferred']['Name']}
+                        yield ident, {'id': odata['Preferred']['Name'].strip().replace(' ','_'), 'canonical': odata['Preferred']['Name']}
                 elif resultcode in [0,1,2]:
                     # Unable to create usable results
-                    results['skipped'].append(ident)
                     current_app.logger.info('NED returned result code {rcode} for object {object}'.format(rcode=resultcode, object=ident))
-                    continue
+                    yield ident, None
                 else:
                     # Unexpected result code!
-                    results['skipped'].append(ident)
                     current_app.logger.info('Unexpected result code from NED! NED returned result code {rcode} for object {object}'.format(rcode=resultcode, object=ident))
-                    continue
+                    yield ident, None
             else:
                 # NED query was not successful
-                results['skipped'].append(ident)
                 current_app.logger.info('NED query failed! NED returned status code {rcode} for object {object}'.format(rcode=statuscode, object=ident))
-                continue
+                yield ident, None
     elif input_type == 'simple':
         # We just take the indexed NED identifier value and remove the underscore
-        results = {}
-        results['data'] = {}
-        results['skipped'] = []
         for ident in id_list:
-            results['data'][ident] = {'id': ident, 'canonical': ident.strip().replace('_',' ')}
+            yield ident, {'id': ident, 'canonical': ident.strip().replace('_',' ')}
     else:
-        return {"Error": "Unable to get results!", "Error Info": "Unknown input type specified!"}
-
-    return results
+        yield None, {"Error": "Unable to get results!", "Error Info": "Unknown input type specified!"}
 
 def ned_position_query(COORD, RADIUS):
+    # Equivalent cones give the same query and cache key
+    RA, DEC, RADIUS = canonical_cone(COORD, RADIUS, current_app.config.get('OBJECTS_NED_MAX_RADIUS'))
+    cone = cone_key(RA, DEC, RADIUS)
+    cache = get_cache()
+    nedids = cache.get('ned_cone', cone)
+    if nedids is not None:
+        return nedids
+    # Concurrent cone searches for the same cone share one request
+    COORD, RADIUS = cone_coordinates(RA, DEC, RADIUS)
+    nedids = coalesce(('ned cone', cone), do_ned_position_query, COORD, RADIUS)
+    if isinstance(nedids, list):
+        cache.set('ned_cone', cone, nedids)
+    return nedids
+
+def do_ned_position_query(COORD, RADIUS):
     nedids = []
     RA, DEC = COORD.to_string('hmsdms').split()
     QUERY_URL = current_app.config.get('OBJECTS_NED_OBJSEARCH')
-    TIMEOUT = current_app.config.get('OBJECTS_NED_TIMEOUT',1)
+    TIMEOUT = remaining_time(current_app.config.get('OBJECTS_NED_TIMEOUT',1))
     MAX_RADIUS = float(current_app.config.get('OBJECTS_NED_MAX_RADIUS'))
     MAX_OBJECTS = int(current_app.config.get('OBJECTS_NED_MAX_NUMBER'))
     # set headers for query
@@ -134,22 +207,118 @@ def ned_position_query(COORD, RADIUS):
     query_params['lat'] = DEC
     # NED wants radius in arcminutes
     query_params['radius'] = min(float(RADIUS.degree), MAX_RADIUS)
-    # Do the query
+    # Do the query (unless we are out of time or NED objsearch is known to be down)
+    if TIMEOUT <= 0:
+        current_app.logger.info('NED cone search to %s not sent: request deadline exceeded'%QUERY_URL)
+        return {"Error": "Unable to get results!", "Error Info": "NED cone search not sent: request deadline exceeded"}
+    breaker = get_breaker(QUERY_URL)
+    if not breaker.allow_request():
+        current_app.logger.info('NED cone search to %s not sent: circuit is open'%QUERY_URL)
+        return {"Error": "Unable to get results!", "Error Info": "NED cone search service unavailable (circuit open)"}
+    # Stay below the request rate NED allows (shared by the workers on this host), but
+    # don't spend more than half of our time waiting for that
+    waited = wait_for_rate_limit('ned', QUERY_URL, TIMEOUT / 2.0)
+    if waited is None:
+        breaker.release_request()
+        current_app.logger.info('NED cone search to %s not sent: rate limit'%QUERY_URL)
+        return {"Error": "Unable to get results!", "Error Info": "NED cone search not sent: rate limit exceeded"}
+    TIMEOUT -= waited
     try:
-        response = current_app.client.get(QUERY_URL, headers=headers, params=query_params, timeout=TIMEOUT)
+        response = current_app.client.get(QUERY_URL, headers=headers, params=query_params, timeout=TIMEOUT, stream=True)
     except (ConnectTimeout, ReadTimeout) as err:
+        breaker.record_failure(timeout=True)
         current_app.logger.info('NED cone search to %s timed out! Request took longer than %s second(s)'%(QUERY_URL, TIMEOUT))
         return {"Error": "Unable to get results!", "Error Info": "NED cone search timed out: {0}".format(str(err))}
     except Exception as err:
+        breaker.record_failure()
         current_app.logger.error("NED cone search to %s failed (%s)"%(QUERY_URL, err))
         return {"Error": "Unable to get results!", "Error Info": "NED cone search failed ({0})".format(err)}
-    data = response.text.split('\n')
-    nedids = [e.split('|')[1].strip().replace(' ','_') for e in data if e.find('|') > -1]
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    # We only read as much of the response as we need
+    if response.encoding is None:
+        response.encoding = 'utf-8'
     try:
-        nedids.remove('Object_Name')
-    except:
-        pass
-    return nedids[:MAX_OBJECTS]
+        nedids = read_ned_object_names(response.iter_lines(decode_unicode=True), MAX_OBJECTS)
+    except Exception as err:
+        current_app.logger.error("Reading NED cone search results from %s failed (%s)"%(QUERY_URL, err))
+        return {"Error": "Unable to get results!", "Error Info": "NED cone search failed ({0})".format(err)}
+    finally:
+        response.close()
+    return nedids
+
+def read_ned_object_names(lines, max_objects):
+    # Collect the object names from NED objsearch results in 'ascii_bar' format:
+    # lines with fields separated by '|', the first of which is a header line
+    # with the column names. We stop as soon as we have enough names.
+    nedids = []
+    column = 1
+    for line in lines:
+        if line.find('|') == -1:
+            continue
+        fields = [f.strip() for f in line.split('|')]
+        if 'Object Name' in fields:
+            # The header line tells us which column has the object names
+            column = fields.index('Object Name')
+            continue
+        if len(fields) <= column:
+            continue
+        nedids.append(fields[column].replace(' ','_'))
+        if len(nedids) >= max_objects:
+            break
+    return nedids
+
+def do_ned_refcode_lookup(ned_url, object_name):
+    # Payload per NED documentation: https://ned.ipac.caltech.edu/ui/Documents/ObjectLookup
+    payload = {"name": {"v": "{0}".format(object_name)}}
+    # Headers for request
+    headers = {
+        'User-Agent': 'ADS Object Service (Classic Object Search)',
+        'Content-type': 'application/json',
+        'Accept': 'text/plain'
+    }
+    # Get timeout for request from the config (use 1 second if not found)
+    TIMEOUT = remaining_time(current_app.config.get('OBJECTS_NED_TIMEOUT',1))
+    if TIMEOUT <= 0:
+        current_app.logger.info('NED request to %s not sent: request deadline exceeded'%ned_url)
+        return {"Error": "Unable to get results!", "Error Info": "NED request not sent: request deadline exceeded"}
+    # Don't wait for NED when it is known to be down
+    breaker = get_breaker(ned_url)
+    if not breaker.allow_request():
+        current_app.logger.info('NED request to %s not sent: circuit is open'%ned_url)
+        return {"Error": "Unable to get results!", "Error Info": "NED service unavailable (circuit open)"}
+    # Stay below the request rate NED allows (shared by the workers on this host), but
+    # don't spend more than half of our time waiting for that
+    waited = wait_for_rate_limit('ned', ned_url, TIMEOUT / 2.0)
+    if waited is None:
+        breaker.release_request()
+        current_app.logger.info('NED request to %s not sent: rate limit'%ned_url)
+        return {"Error": "Unable to get results!", "Error Info": "NED request not sent: rate limit exceeded"}
+    TIMEOUT -= waited
+    # Query NED API to retrieve the canonical object names for the ones provided
+    # (if known to NED)
+    try:
+        r = current_app.client.post(ned_url, data=json.dumps(payload), headers=headers, timeout=TIMEOUT)
+    except (ConnectTimeout, ReadTimeout, Timeout) as err:
+        breaker.record_failure(timeout=True)
+        current_app.logger.info('NED request to %s timed out! Request took longer than %s second(s)'%(ned_url, TIMEOUT))
+        return {"Error": "Unable to get results!", "Error Info": "NED request timed out: {0}".format(str(err))}
+    except Exception as err:
+        breaker.record_failure()
+        current_app.logger.error("NED request to %s failed (%s)"%(ned_url, err))
+        return {"Error": "Unable to get results!", "Error Info": "NED request failed ({0})".format(err)}
+    if r.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    # Check if we got a 200 status code back
+    if r.status_code != 200:
+        current_app.logger.info('NED request to %s failed! Status code: %s'%(ned_url, r.status_code))
+        return {"Error": "Unable to get results!", "Error Info": "NED returned status %s" % r.status_code}
+    # We got a proper response back with data
+    return r.json()
 
 def get_NED_refcodes(obj_data):
     # NED endpoint to get data
@@ -160,43 +329,31 @@ def get_NED_refcodes(obj_data):
     result['ambiguous'] = []
     # Canonical object names returned from NED
     canonicals = []
-    # Parameters for NED query
-    payload = {}
-    # Headers for request
-    headers = {
-        'User-Agent': 'ADS Object Service (Classic Object Search)',
-        'Content-type': 'application/json',
-        'Accept': 'text/plain'
-    }
+    cache = get_cache()
     # We're here, so the data submitted has an 'objects' attribute
     objects = obj_data.get('objects')
     # Let's just check to be sure that the list actually contains entries
     if len(objects) == 0:
         return {"Error": "Unable to get results!",
                 "Error Info": "No object names provided"}
-    # Now attempt to retrieve refcodes for each of the object names submitted
-    for object_name in objects:
-        # Payload per NED documentation: https://ned.ipac.caltech.edu/ui/Documents/ObjectLookup
-        payload["name"] = {"v": "{0}".format(object_name)}
-        # There is an entry, so now try to get the associated refcodes
-        # Get timeout for request from the config (use 1 second if not found)
-        TIMEOUT = current_app.config.get('OBJECTS_NED_TIMEOUT',1)
-        # Query NED API to retrieve the canonical object names for the ones provided
-        # (if known to NED)
-        try:
-            r = current_app.client.post(ned_url, data=json.dumps(payload), headers=headers, timeout=TIMEOUT)
-        except (ConnectTimeout, ReadTimeout, Timeout) as err:
-            current_app.logger.info('NED request to %s timed out! Request took longer than %s second(s)'%(ned_url, TIMEOUT))
-            return {"Error": "Unable to get results!", "Error Info": "NED request timed out: {0}".format(str(err))}
-        except Exception as err:
-            current_app.logger.error("NED request to %s failed (%s)"%(ned_url, err))
-            return {"Error": "Unable to get results!", "Error Info": "NED request failed ({0})".format(err)}
-        # Check if we got a 200 status code back
-        if r.status_code != 200:
-            current_app.logger.info('NED request to %s failed! Status code: %s'%(ned_url, r.status_code))
-            return {"Error": "Unable to get results!", "Error Info": "NED returned status %s" % r.status_code}
-        # We got a proper response back with data
-        ned_data = r.json()
+    # Now attempt to retrieve refcodes for each of the object names submitted (once
+    # for names that occur more than once; the cache takes care of other spellings
+    # of known names)
+    for object_name in OrderedDict.fromkeys(objects):
+        # The NED lookup results (or the relevant part of them) are cached. Canonical
+        # names are shared by all ways of writing an object name, other results are
+        # only cached for the name as written.
+        ned_data = cache.get('ned_refcodes', normalize_object_name(object_name)) or \
+                   cache.get('ned_refcodes_other', object_name)
+        if ned_data is None:
+            ned_data = do_ned_refcode_lookup(ned_url, object_name)
+            if "Error" in ned_data:
+                return ned_data
+            ned_data = {k: v for k, v in ned_data.items() if k in ['ResultCode', 'Preferred', 'Interpreted']}
+            if ned_data.get('ResultCode') == 3:
+                cache.set('ned_refcodes', normalize_object_name(object_name), ned_data)
+            else:
+                cache.set('ned_refcodes_other', object_name, ned_data)
         # We are not interested in these cases: either not a valid object name, or a known one, but there
         # is no entry in the NED database
         if ned_data['ResultCode'] in [0,2]:
@@ -209,7 +366,9 @@ def get_NED_refcodes(obj_data):
         else:
         # We have a canonical name. Store it in the appropriate list, so that we can query Solr with
         # it and retrieve bibcodes
-            canonicals.append(ned_data['Preferred']['Name'].strip())
+            canonical = ned_data['Preferred']['Name'].strip()
+            if canonical not in canonicals:
+                canonicals.append(canonical)
     # We retrieve bibcodes with one Solr query, using "nedid:" (we use canonical object names as identifiers,
     # with spaces replaced by underscores)
     obj_list = " OR ".join(["nedid:%s" % a.replace(' ','_') for a in canonicals])
@@ -228,7 +387,30 @@ def get_NED_refcodes(obj_data):
     headers = {'X-Forwarded-Authorization': request.headers.get('Authorization')}
     params = {'wt': 'json', 'q': q, 'fl': 'bibcode',
                       'rows': current_app.config.get('OBJECT_SOLR_MAX_HITS')}
-    response = client().get(current_app.config.get('OBJECTS_SOLRQUERY_URL'), params=params,headers=headers)
+    solr_url = current_app.config.get('OBJECTS_SOLRQUERY_URL')
+    if deadline_exceeded():
+        return {"Error": "Unable to get results!", "Error Info": "Solr request not sent: request deadline exceeded"}
+    breaker = get_breaker(solr_url)
+    if not breaker.allow_request():
+        current_app.logger.info('Solr request to %s not sent: circuit is open'%solr_url)
+        return {"Error": "Unable to get results!", "Error Info": "Solr service unavailable (circuit open)"}
+    try:
+        response = client().get(solr_url, params=params,headers=headers, timeout=remaining_time())
+    except Timeout as err:
+        breaker.record_failure(timeout=True)
+        current_app.logger.info('Solr request to %s timed out: %s'%(solr_url, err))
+        return {"Error": "Unable to get results!", "Error Info": "Solr request timed out: {0}".format(err)}
+    except ConnectionError as err:
+        breaker.record_failure()
+        current_app.logger.error('Solr request to %s failed: %s'%(solr_url, err))
+        return {"Error": "Unable to get results!", "Error Info": "Solr request failed ({0})".format(err)}
+    except Exception:
+        breaker.record_failure()
+        raise
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
     # See if our request was successful
     if response.status_code != 200:
         return {"Error": "Unable to get results!",
@@ -1,9 +1,71 @@
 from builtins import str
+from builtins import object
 import re
-from flask import current_app
+import csv
+import io
+import time
+import threading
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeout
+from flask import current_app, g
 from requests.exceptions import ConnectTimeout, ReadTimeout
 import timeout_decorator
 import json
+from .circuit import get_breaker
+from .deadline import remaining_time
+from .singleflight import coalesce
+from .cache import get_cache
+from .ratelimit import wait_for_rate_limit
+from .names import cleanup_object_name
+from .executors import get_executor
+from .cones import canonical_cone
+from .cones import cone_key
+
+class TapLatencies(object):
+    """
+    Keeps track of recent response times of the SIMBAD TAP services and of how
+    many of the recent queries were hedged (sent to both mirrors)
+    """
+    def __init__(self, size=200):
+        self.latencies = {}
+        self.size = size
+        self.hedged = deque(maxlen=100)
+        self.lock = threading.Lock()
+
+    def add(self, url, latency):
+        with self.lock:
+            self.latencies.setdefault(url, deque(maxlen=self.size)).append(latency)
+
+    def percentile(self, url, pct, min_samples=20):
+        """Latency percentile for a TAP service, None if we don't have enough data yet"""
+        with self.lock:
+            values = sorted(self.latencies.get(url, []))
+        if len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+    def allow_hedge(self, budget):
+        """Record a query and decide whether it may be hedged within the hedge budget"""
+        with self.lock:
+            allowed = sum(self.hedged) < budget * self.hedged.maxlen
+            self.hedged.append(allowed)
+            return allowed
+
+    def record_unhedged(self):
+        with self.lock:
+            self.hedged.append(False)
+
+def get_tap_latencies():
+    latencies = current_app.extensions.get('tap_latencies')
+    if latencies is None:
+        latencies = current_app.extensions.setdefault('tap_latencies', TapLatencies())
+    return latencies
+
+def get_hedge_executor():
+    # Threads used to send hedged TAP requests
+    return get_executor('simbad_hedge', current_app.config.get('OBJECTS_SIMBAD_HEDGE_WORKERS', 10))
 
 def do_tap_query(query, search_type, maxrec):
     QUERY_URL = current_app.config.get('OBJECTS_SIMBAD_TAP_URL')
@@ -12,7 +74,7 @@ def do_tap_query(query, search_type, maxrec):
     params = {
         'request' : 'doQuery',
         'lang' : 'adql',
-        'format' : 'json',
+        'format' : current_app.config.get('OBJECTS_SIMBAD_FORMAT', 'json'),
         'query' : query
     }
     
@@ -22,23 +84,136 @@ def do_tap_query(query, search_type, maxrec):
     headers = {
         'User-Agent': 'ADS Object Service ({0})'.format(search_type)
     }
-    
-    TIMEOUT = current_app.config.get('OBJECTS_SIMBAD_TIMEOUT',1)
+    # The request only gets the time left before its deadline
+    TIMEOUT = remaining_time(current_app.config.get('OBJECTS_SIMBAD_TIMEOUT',1))
+    if TIMEOUT <= 0:
+        current_app.logger.info('SIMBAD request to %s not sent: request deadline exceeded'%QUERY_URL)
+        return {"Error": "Unable to get results!", "Error Info": "SIMBAD request not sent: request deadline exceeded"}
+    # Identical queries in flight at the same time (e.g. for a popular object) share one request
+    key = ('simbad', QUERY_URL, query, params.get('maxrec'))
+    # The TAP service verification query is about one particular service: never hedge it.
+    # It is a tiny query that is sent for every request, so it does not count against
+    # the rate limit (or it would use up a large part of it)
+    if search_type == 'TAP Service Verification':
+        return coalesce(key, do_tap_request, QUERY_URL, params, headers, TIMEOUT, False)
+    if current_app.config.get('OBJECTS_SIMBAD_HEDGE', False):
+        return coalesce(key, do_hedged_tap_query, params, headers, TIMEOUT)
+    return coalesce(key, do_tap_request, QUERY_URL, params, headers, TIMEOUT)
+
+def do_tap_request(QUERY_URL, params, headers, TIMEOUT, rate_limited=True):
+    # Don't wait for a TAP service that is known to be down
+    breaker = get_breaker(QUERY_URL)
+    if not breaker.allow_request():
+        current_app.logger.info('SIMBAD request to %s not sent: circuit is open'%QUERY_URL)
+        return {"Error": "Unable to get results!", "Error Info": "SIMBAD service unavailable (circuit open)"}
+    # Stay below the request rate SIMBAD allows (shared by the workers on this host), but
+    # don't spend more than half of our time waiting for that
+    waited = wait_for_rate_limit('simbad', QUERY_URL, TIMEOUT / 2.0) if rate_limited else 0
+    if waited is None:
+        breaker.release_request()
+        current_app.logger.info('SIMBAD request to %s not sent: rate limit'%QUERY_URL)
+        return {"Error": "Unable to get results!", "Error Info": "SIMBAD request not sent: rate limit exceeded"}
+    TIMEOUT -= waited
 
+    stime = time.time()
+    # CSV results are read (and decoded) as they come in
+    stream = params.get('format') == 'csv'
     try:
-        r = current_app.client.post(QUERY_URL, data=params, headers=headers, timeout=TIMEOUT)
+        if stream:
+            r = current_app.client.post(QUERY_URL, data=params, headers=headers, timeout=TIMEOUT, stream=True)
+            try:
+                data = read_tap_csv(r) if r.status_code == 200 else None
+            finally:
+                r.close()
+        else:
+            r = current_app.client.post(QUERY_URL, data=params, headers=headers, timeout=TIMEOUT)
     except (ConnectTimeout, ReadTimeout) as err:
+        breaker.record_failure(timeout=True)
         current_app.logger.info('SIMBAD request to %s timed out! Request took longer than %s second(s)'%(QUERY_URL, TIMEOUT))
         return {"Error": "Unable to get results!", "Error Info": "SIMBAD request timed out: {0}".format(err)}
     except Exception as err:
+        breaker.record_failure()
         current_app.logger.error("SIMBAD request to %s failed (%s)"%(QUERY_URL, err))
         return {"Error": "Unable to get results!", "Error Info": "SIMBAD request failed (not timeout): %s"%err}
+    # Only server errors count against the health of the service
+    if r.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
     # Report if the SIMBAD server did not like our query
     if r.status_code != 200:
         current_app.logger.info('SIMBAD request to %s failed! Status code: %s'%(QUERY_URL, r.status_code))
         return {"Error": "Unable to get results!", "Error Info": "SIMBAD returned status %s" % r.status_code}
+    get_tap_latencies().add(QUERY_URL, time.time() - stime)
+    if stream:
+        if data is None:
+            current_app.logger.info('SIMBAD request to %s did not return CSV data'%QUERY_URL)
+            return {"Error": "Unable to get results!", "Error Info": "SIMBAD did not return CSV data"}
+        return {'data': data}
     data = r.json()
     return data
+
+def read_tap_csv(r):
+    """
+    Decode a TAP response in CSV format (a header line with the column names, then
+    one line per row) while it is being received. Returns the rows as lists of
+    strings, or None if the response is not CSV (e.g. a VOTable with an error).
+    """
+    if 'csv' not in r.headers.get('Content-Type', ''):
+        return None
+    # Read straight from the connection (decompressed if need be)
+    r.raw.decode_content = True
+    r.raw.auto_close = False
+    reader = csv.reader(io.TextIOWrapper(r.raw, encoding='utf-8', newline=''))
+    # Skip the header
+    next(reader, None)
+    return [row for row in reader if row]
+
+def do_tap_request_in_context(app, QUERY_URL, params, headers, TIMEOUT):
+    with app.app_context():
+        return do_tap_request(QUERY_URL, params, headers, TIMEOUT)
+
+def do_hedged_tap_query(params, headers, TIMEOUT):
+    # Send the query to the current TAP service. If it has not answered within
+    # the usual response time (a percentile of recent response times), send the
+    # same query to the other mirror and use whichever successful answer comes first.
+    primary = current_app.config.get('OBJECTS_SIMBAD_TAP_URL')
+    secondary = current_app.config.get('OBJECTS_SIMBAD_TAP_URL_CDS')
+    latencies = get_tap_latencies()
+    if primary == secondary:
+        # We already switched to the CDS mirror: nothing to hedge with
+        latencies.record_unhedged()
+        return do_tap_request(primary, params, headers, TIMEOUT)
+    delay = latencies.percentile(primary, current_app.config.get('OBJECTS_SIMBAD_HEDGE_PERCENTILE', 95))
+    if delay is None:
+        delay = current_app.config.get('OBJECTS_SIMBAD_HEDGE_DELAY', 1)
+    app = current_app._get_current_object()
+    executor = get_hedge_executor()
+    first = executor.submit(do_tap_request_in_context, app, primary, params, headers, TIMEOUT)
+    try:
+        data = first.result(timeout=delay)
+        latencies.record_unhedged()
+        return data
+    except FutureTimeout:
+        pass
+    hedge_timeout = remaining_time(current_app.config.get('OBJECTS_SIMBAD_TIMEOUT',1))
+    if hedge_timeout <= 0 or not latencies.allow_hedge(current_app.config.get('OBJECTS_SIMBAD_HEDGE_BUDGET', 0.1)):
+        # No time left, or we have hedged too many queries recently
+        return first.result()
+    current_app.logger.info('SIMBAD request to %s slower than %s seconds, hedging with %s'%(primary, delay, secondary))
+    second = executor.submit(do_tap_request_in_context, app, secondary, params, headers, hedge_timeout)
+    pending = [first, second]
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        results = [future.result() for future in done]
+        data = ([r for r in results if not r.get('Error', None)] or results)[0]
+        if not data.get('Error', None):
+            break
+    # The losing request cannot be interrupted; it is cancelled if it has not started
+    # yet, and otherwise its response is discarded
+    for future in pending:
+        future.cancel()
+    return data
     
 def verify_tap_service():
     # The default TAP service (CfA) is sometimes down, in which
@@ -47,7 +222,11 @@ def verify_tap_service():
     tap_url = current_app.config.get('OBJECTS_SIMBAD_TAP_URL')
     q = 'SELECT TOP 1 * FROM basic;'
     verify = do_tap_query(q, 'TAP Service Verification', 0)
-    if verify.get('Error', None):
+    if 'not sent:' in str(verify.get('Error Info', '')):
+        # The test query was not sent (no time left for this request, or rate limit):
+        # that says nothing about the TAP service, so we keep using it
+        current_app.logger.info('TAP service not verified: {0}'.format(verify.get('Error Info')))
+    elif verify.get('Error', None):
         # If the test query failed, we return the CDS TAP service URL
         # Failure can happen for the following reasons:
         # 1. The request threw an exception
@@ -63,26 +242,85 @@ def verify_tap_service():
         
     return tap_url
     
-def cleanup_object_name(object_name):
-    # remove catalog prefix if present
-    return re.sub('^(NAME|\*|S?V\*)\s+','',object_name)
+def adql_literal(value, numeric=False):
+    # An ADQL literal for a value: an integer, or a string with quotes escaped
+    if numeric:
+        return str(int(value))
+    return "'%s'" % str(value).replace("'", "''")
+
+def adql_chunks(values, numeric=False, max_count=500, max_bytes=20000):
+    """
+    Split a list of values into lists of ADQL literals, for "IN (...)" conditions,
+    with at most max_count values and (about) max_bytes bytes per list
+    """
+    chunks = []
+    chunk = []
+    size = 0
+    for value in values:
+        literal = adql_literal(value, numeric=numeric)
+        length = len(literal.encode('utf-8')) + 1
+        if chunk and (len(chunk) >= max_count or size + length > max_bytes):
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append(literal)
+        size += length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def get_chunk_executor():
+    # Threads used to send the chunks of large SIMBAD queries
+    return get_executor('simbad_chunks', current_app.config.get('OBJECTS_SIMBAD_CHUNK_WORKERS', 4))
+
+def do_tap_query_in_context(app, deadline, query, search_type, maxrec):
+    with app.app_context():
+        g.deadline = deadline
+        return do_tap_query(query, search_type, maxrec)
+
+def do_chunked_tap_query(template, column, values, numeric, search_type):
+    # Query SIMBAD for a (possibly long) list of values: the values go into
+    # "column IN (...)" conditions of at most a certain size, the resulting queries
+    # are sent concurrently, and their results are merged
+    chunks = adql_chunks(values, numeric=numeric,
+                max_count=current_app.config.get('OBJECTS_SIMBAD_CHUNK_SIZE', 500),
+                max_bytes=current_app.config.get('OBJECTS_SIMBAD_CHUNK_BYTES', 20000))
+    queries = [template % ('%s IN (%s)' % (column, ','.join(chunk))) for chunk in chunks]
+    if len(queries) == 1:
+        return do_tap_query(queries[0], search_type, 0)
+    app = current_app._get_current_object()
+    futures = [get_chunk_executor().submit(do_tap_query_in_context, app, g.get('deadline'), q, search_type, 0)
+               for q in queries]
+    data = []
+    for future in futures:
+        r = future.result()
+        if r.get('Error', None):
+            return r
+        data += r.get('data', [])
+    return {'data': data}
 
 def get_simbad_data(id_list, input_type):
     results = {}
+    # Every name or identifier only needs to be in the query once
+    id_list = list(OrderedDict.fromkeys(id_list))
     # Establish the SIMBAD query, based on the type of input
     if input_type == 'objects':
         results['data'] = {k:None for k in id_list}
         # For the object names query we want to have all variants returned, cache them, and select only those entries that match the input
-        qfilter = " OR ".join(["ident2.id=\'%s\'"%a for a in id_list])
-        q = 'SELECT ident1.oidref, ident1.id, basic.main_id FROM ident AS ident1 JOIN ident AS ident2 ON ident1.oidref = ident2.oidref JOIN basic ON ident1.oidref = basic.oid WHERE %s;' % qfilter
+        q = 'SELECT ident1.oidref, ident1.id, basic.main_id FROM ident AS ident1 JOIN ident AS ident2 ON ident1.oidref = ident2.oidref JOIN basic ON ident1.oidref = basic.oid WHERE %s;'
+        column = 'ident2.id'
     elif input_type == 'identifiers':
         # For the identifiers query we just want to have the canonical names returned
-        qfilter = " OR ".join(["oid=\'%s\'"%a for a in id_list])
-        q = "SELECT oid, main_id, main_id FROM basic WHERE %s;" % qfilter
+        q = "SELECT oid, main_id, main_id FROM basic WHERE %s;"
+        column = 'oid'
+        # SIMBAD identifiers are integers
+        id_list = [i for i in id_list if str(i).strip().isdigit()]
+        if not id_list:
+            return {'data': {}}
     else:
         return {"Error": "Unable to get results!", "Error Info": "Unknown input type specified!"}
     # Fire off the query
-    r = do_tap_query(q, 'Object Search', 0)
+    r = do_chunked_tap_query(q, column, id_list, input_type == 'identifiers', 'Object Search')
     if r.get('Error', None):
         return r
     # Contruct the results
@@ -101,11 +339,54 @@ def get_simbad_data(id_list, input_type):
         results = {"Error": "Unable to get results!", "Error Info": "Bad data returned by SIMBAD"}
     return results
 
+def get_simbad_data_in_context(app, deadline, id_list, input_type):
+    with app.app_context():
+        g.deadline = deadline
+        return get_simbad_data(id_list, input_type)
+
+def iter_simbad_data(id_list, input_type):
+    """
+    Like get_simbad_data, but for every chunk of the list as soon as its results are
+    in: yields tuples of the names (or identifiers) in a chunk and the results for
+    them. The chunks are queried concurrently, but only a few at a time, so that the
+    results that are waiting to be sent stay small.
+    """
+    id_list = list(OrderedDict.fromkeys(id_list))
+    if input_type == 'identifiers':
+        id_list = [i for i in id_list if str(i).strip().isdigit()]
+    elif input_type != 'objects':
+        yield id_list, {"Error": "Unable to get results!", "Error Info": "Unknown input type specified!"}
+        return
+    chunks = adql_chunks(id_list, numeric=input_type == 'identifiers',
+                max_count=current_app.config.get('OBJECTS_SIMBAD_CHUNK_SIZE', 500),
+                max_bytes=current_app.config.get('OBJECTS_SIMBAD_CHUNK_BYTES', 20000))
+    todo = deque()
+    start = 0
+    for chunk in chunks:
+        todo.append(id_list[start:start + len(chunk)])
+        start += len(chunk)
+    app = current_app._get_current_object()
+    deadline = g.get('deadline')
+    workers = current_app.config.get('OBJECTS_SIMBAD_CHUNK_WORKERS', 4)
+    pending = {}
+    while todo or pending:
+        while todo and len(pending) < workers:
+            values = todo.popleft()
+            pending[get_chunk_executor().submit(get_simbad_data_in_context, app, deadline, values, input_type)] = values
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future.result()
+
 def simbad_position_query(COORD, RADIUS):
-    RA, DEC = COORD.to_string('decimal').split()
     MAX_RADIUS = float(current_app.config.get('OBJECTS_SIMBAD_MAX_RADIUS'))
     MAX_NUMBER = current_app.config.get('OBJECTS_SIMBAD_MAX_NUMBER')
-    RADIUS = min(float(RADIUS.degree), MAX_RADIUS)
+    # Equivalent cones give the same query (and share one request) and cache key
+    RA, DEC, RADIUS = canonical_cone(COORD, RADIUS, MAX_RADIUS)
+    cone = cone_key(RA, DEC, RADIUS)
+    cache = get_cache()
+    simbids = cache.get('simbad_cone', cone)
+    if simbids is not None:
+        return simbids
     
     q = "SELECT TOP %s oid, \
                        DISTANCE( \
@@ -125,4 +406,5 @@ def simbad_position_query(COORD, RADIUS):
         simbids = list(set([str(d[0]) for d in r['data']]))
     except Exception as err:
         return {'Error': 'Unable to get results!', 'Error Info': 'Unable to retrieve SIMBAD identifiers from SIMBAD response (no "data" key)!'}
+    cache.set('simbad_cone', cone, simbids)
     return simbids
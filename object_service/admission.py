@@ -0,0 +1,97 @@
+from builtins import object
+import threading
+from functools import wraps
+from collections import Counter
+from flask import current_app, request
+from flask import Response
+
+class AdmissionControl(object):
+    """
+    Limits the number of requests doing expensive work (upstream lookups) at the
+    same time: per client, and in total. A request from a client that is at its limit
+    is refused right away. When the total limit is reached, requests wait in a queue
+    of limited size for a limited time, and are refused when the queue is full or
+    their time is up.
+    """
+    def __init__(self, client_limit=4, total_limit=16, queue_size=32, max_wait=2):
+        self.client_limit = client_limit
+        self.total_limit = total_limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.active = Counter()
+        self.total = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, client):
+        """Returns True if the client may go ahead, in which case release() must follow"""
+        with self.condition:
+            if self.active[client] >= self.client_limit:
+                return False
+            if self.total >= self.total_limit:
+                if self.waiting >= self.queue_size:
+                    return False
+                self.waiting += 1
+                try:
+                    admitted = self.condition.wait_for(lambda: self.total < self.total_limit, self.max_wait)
+                finally:
+                    self.waiting -= 1
+                if not admitted or self.active[client] >= self.client_limit:
+                    return False
+            self.active[client] += 1
+            self.total += 1
+            return True
+
+    def release(self, client):
+        with self.condition:
+            self.active[client] -= 1
+            if self.active[client] <= 0:
+                del self.active[client]
+            self.total -= 1
+            self.condition.notify()
+
+def get_admission_control():
+    admission = current_app.extensions.get('admission_control')
+    if admission is None:
+        admission = current_app.extensions.setdefault('admission_control', AdmissionControl(
+                        client_limit=current_app.config.get('OBJECTS_CLIENT_CONCURRENCY', 4),
+                        total_limit=current_app.config.get('OBJECTS_TOTAL_CONCURRENCY', 16),
+                        queue_size=current_app.config.get('OBJECTS_ADMISSION_QUEUE', 32),
+                        max_wait=current_app.config.get('OBJECTS_ADMISSION_WAIT', 2)))
+    return admission
+
+def client_key():
+    # Clients are identified by their token, or else by their address
+    token = request.headers.get('X-Forwarded-Authorization') or request.headers.get('Authorization')
+    if token:
+        return token
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.remote_addr
+
+def admission_control(func):
+    """Decorator for views doing expensive work: returns a 429 when over capacity"""
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        if not current_app.config.get('OBJECTS_ADMISSION_CONTROL', True):
+            return func(*args, **kwargs)
+        admission = get_admission_control()
+        client = client_key()
+        if not admission.acquire(client):
+            current_app.logger.info('Request refused: too many concurrent requests')
+            return {"Error": "Unable to get results!",
+                    "Error Info": "Too many concurrent requests, please try again later"}, 429, \
+                   {'Retry-After': str(current_app.config.get('OBJECTS_ADMISSION_RETRY_AFTER', 1))}
+        try:
+            response = func(*args, **kwargs)
+        except Exception:
+            admission.release(client)
+            raise
+        if isinstance(response, Response) and response.is_streamed:
+            # A streamed response does its work while it is sent
+            response.call_on_close(lambda: admission.release(client))
+        else:
+            admission.release(client)
+        return response
+    return decorated
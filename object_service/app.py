@@ -3,6 +3,11 @@ from werkzeug.serving import run_simple
 from .views import ObjectSearch
 from .views import QuerySearch
 from .views import ClassicObjectSearch
+from .views import ClassicObjectSearchJob
+from .deadline import set_request_deadline
+from .cache import init_cache
+from .output import output_json
+from .output import compress_response
 from flask_restful import Api
 from flask_discoverer import Discoverer
 from adsmutils import ADSFlask
@@ -16,11 +21,21 @@ def create_app():
 
     app = ADSFlask(__name__, static_folder=None)
     app.url_map.strict_slashes = False
+    # Every request gets a deadline for all the upstream calls it makes
+    app.before_request(set_request_deadline)
+    # Start with a warm cache if a snapshot is available
+    init_cache(app)
+
+    # Large responses are compressed, if the client accepts that
+    app.after_request(compress_response)
 
     api = Api(app)
+    # Faster JSON serialization than the default of flask_restful
+    api.representations['application/json'] = output_json
     api.add_resource(ObjectSearch, '/', '/<string:objects>', '/<string:objects>/<string:source>')
     api.add_resource(QuerySearch, '/query')
     api.add_resource(ClassicObjectSearch, '/nedsrv')
+    api.add_resource(ClassicObjectSearchJob, '/nedsrv/jobs/<string:job_id>')
 
     discoverer = Discoverer(app)
 
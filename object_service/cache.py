@@ -0,0 +1,423 @@
+from builtins import object
+import os
+import time
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import current_app, g
+from .executors import get_executor
+from .sortedfile import SortedFile
+try:
+    import redis
+except ImportError:
+    redis = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# States of cache entries stored with ObjectCache.set_entry
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+
+class LRUCache(object):
+    """
+    In-process cache with a maximum number of entries (least recently used
+    entries are dropped first) and a time-to-live per entry
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, expires = self.data.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            self.data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, time.time() + ttl)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def items(self):
+        """Returns a list of tuples (key, expiration time, value) of all entries"""
+        with self.lock:
+            return [(k, e, v) for k, (v, e) in self.data.items()]
+
+class Snapshot(SortedFile):
+    """
+    Read-only snapshot of cache entries on disk, written periodically so that new
+    workers do not start with a cold cache. The file has one line per entry:
+
+        key<TAB>expiration time<TAB>JSON value
+
+    with the lines sorted by key. The file is memory-mapped and looked up by binary
+    search, so opening a snapshot with millions of entries costs (almost) nothing and
+    its pages are shared by all workers on the host.
+    """
+    def get(self, key):
+        """Returns the tuple (value, expiration time) for the key, or None"""
+        target = key.encode('utf-8')
+        line = self.lower_bound(target, key=lambda l: l.partition(b'\t')[0])
+        if line is None:
+            return None
+        k, _, rest = line.partition(b'\t')
+        if k != target:
+            return None
+        expires, _, value = rest.partition(b'\t')
+        return json.loads(value.decode('utf-8')), float(expires)
+
+    def items(self):
+        """Returns a list of tuples (key, expiration time, value) of all entries"""
+        entries = []
+        for line in self.lines():
+            k, expires, value = line.split(b'\t', 2)
+            entries.append((k.decode('utf-8'), float(expires), json.loads(value.decode('utf-8'))))
+        return entries
+
+def line_key(line):
+    # The key of a snapshot line
+    return line.partition(b'\t')[0]
+
+def snapshot_lines(entries):
+    # The lines for cache entries (tuples of key, expiration time and value), sorted
+    lines = []
+    for key, expires, value in entries:
+        if '\t' in key or '\n' in key:
+            continue
+        lines.append(b'\t'.join([key.encode('utf-8'), ('%.0f' % expires).encode('ascii'),
+                                 json.dumps(value).encode('utf-8')]))
+    lines.sort(key=line_key)
+    return lines
+
+def write_lines(path, lines, changes=None):
+    # Write the lines under a temporary name and then move the file into place, so
+    # readers never see a partial snapshot. Returns the number of lines written. With
+    # a changes counter (see merge_lines) that stays at 0, the file is left alone.
+    count = 0
+    tmp = '%s.%s.%s' % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'wb') as f:
+        for line in lines:
+            if count:
+                f.write(b'\n')
+            f.write(line)
+            count += 1
+    if changes is not None and not changes[0]:
+        os.remove(tmp)
+    else:
+        os.rename(tmp, path)
+    return count
+
+def write_snapshot(path, entries):
+    """
+    Write cache entries (tuples of key, expiration time and value) to a snapshot file.
+    Returns the number of entries written.
+    """
+    return write_lines(path, snapshot_lines(entries))
+
+def merge_lines(old, new, now, changes):
+    """
+    Merge the lines of a snapshot with (sorted) new lines, as streams: the lines
+    of the snapshot that have expired are left out, and new lines replace those
+    with the same key. Every line that is left out or replaced is counted in
+    changes[0].
+    """
+    new = iter(new)
+    pending = next(new, None)
+    for line in old:
+        key = line_key(line)
+        while pending is not None and line_key(pending) < key:
+            changes[0] += 1
+            yield pending
+            pending = next(new, None)
+        if pending is not None and line_key(pending) == key:
+            if pending != line:
+                changes[0] += 1
+            yield pending
+            pending = next(new, None)
+        elif float(line.split(b'\t', 2)[1]) > now:
+            yield line
+        else:
+            changes[0] += 1
+    while pending is not None:
+        changes[0] += 1
+        yield pending
+        pending = next(new, None)
+
+@contextmanager
+def snapshot_lock(path):
+    """
+    Lock held while writing the snapshot, so that workers write it one at a time
+    (each on top of what the previous one wrote)
+    """
+    if fcntl is None:
+        yield
+        return
+    with open('%s.lock' % path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class SharedCache(object):
+    """
+    Cache tier shared by all workers, in a Redis-compatible key-value store. Values
+    are stored as JSON. When the store cannot be reached, the cache behaves as if it
+    were empty, and the store is left alone for a while before trying again.
+    """
+    def __init__(self, client, retry_interval=30):
+        self.client = client
+        self.retry_interval = retry_interval
+        self.down_since = None
+
+    def available(self):
+        return self.down_since is None or time.time() - self.down_since > self.retry_interval
+
+    def failed(self, err):
+        self.down_since = time.time()
+        current_app.logger.error('Shared cache unavailable: %s'%err)
+
+    def get(self, key):
+        """
+        Returns the tuple (value, expiration time) for the key, or None. The expiration
+        time is None for an entry without a time-out.
+        """
+        if not self.available():
+            return None
+        try:
+            # The value and the time it has left, in one round trip
+            pipe = self.client.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.pttl(key)
+            value, pttl = pipe.execute()
+        except Exception as err:
+            self.failed(err)
+            return None
+        self.down_since = None
+        if value is None:
+            return None
+        expires = None
+        if pttl is not None and pttl >= 0:
+            expires = time.time() + pttl / 1000.0
+        return json.loads(value), expires
+
+    def set(self, key, value, ttl):
+        if not self.available():
+            return
+        try:
+            self.client.set(key, json.dumps(value), ex=int(ttl))
+        except Exception as err:
+            self.failed(err)
+            return
+        self.down_since = None
+
+class ObjectCache(object):
+    """
+    Cache for name translations, cone search results and NED canonical names.
+    Entries live in a namespace per source (e.g. 'simbad', 'ned', 'ned_cone'), in an
+    in-process LRU tier in front of an optional on-disk snapshot and an optional
+    shared tier.
+    """
+    def __init__(self, local, shared=None, prefix='objects', ttl=604800, snapshot=None, max_stale=0, keep_expired=0):
+        self.local = local
+        self.shared = shared
+        self.prefix = prefix
+        self.ttl = ttl
+        self.snapshot = snapshot
+        self.max_stale = max_stale
+        self.keep_expired = keep_expired
+
+    def key(self, namespace, key):
+        return '%s:%s:%s' % (self.prefix, namespace, key)
+
+    def get(self, namespace, key):
+        k = self.key(namespace, key)
+        value = self.local.get(k)
+        if value is None and self.snapshot is not None:
+            entry = self.snapshot.get(k)
+            if entry is not None and entry[1] > time.time():
+                value = entry[0]
+                self.local.set(k, value, entry[1] - time.time())
+        if value is None and self.shared is not None:
+            entry = self.shared.get(k)
+            if entry is not None:
+                value = entry[0]
+                # Kept in this worker for as long as it lives in the shared tier
+                self.local.set(k, value, self.ttl if entry[1] is None else entry[1] - time.time())
+        return value
+
+    def set(self, namespace, key, value, ttl=None):
+        k = self.key(namespace, key)
+        ttl = ttl or self.ttl
+        self.local.set(k, value, ttl)
+        if self.shared is not None:
+            self.shared.set(k, value, ttl)
+
+    def get_entry(self, namespace, key):
+        """
+        Returns the tuple (value, state) for an entry stored with set_entry, where
+        the state is FRESH, STALE (past its time-out, but it can still be used while
+        it is being refreshed) or EXPIRED (only fit for degraded mode), or
+        (None, None) if there is no entry
+        """
+        entry = self.get(namespace, key)
+        if not isinstance(entry, dict) or 'value' not in entry:
+            return None, None
+        now = time.time()
+        if entry['fresh_until'] > now:
+            return entry['value'], FRESH
+        if entry.get('stale_until', entry['fresh_until'] + self.max_stale) > now:
+            return entry['value'], STALE
+        return entry['value'], EXPIRED
+
+    def set_entry(self, namespace, key, value, ttl=None):
+        """
+        Store an entry that can still be served for 'max_stale' seconds after its
+        time-out, while it is being refreshed (stale-while-revalidate), and that is
+        kept for another 'keep_expired' seconds for when the upstream service fails
+        """
+        ttl = ttl or self.ttl
+        now = time.time()
+        entry = {'value': value, 'fresh_until': now + ttl, 'stale_until': now + ttl + self.max_stale}
+        self.set(namespace, key, entry, ttl + self.max_stale + self.keep_expired)
+
+    def save_snapshot(self, namespaces):
+        """
+        Write the entries of the given namespaces to the snapshot file: the entries in
+        the current snapshot that have not expired, updated with those in the
+        in-process tier. The current snapshot is read as a stream (and its values are
+        not decoded), and it is only replaced when something changed. Workers write
+        the snapshot one at a time. Returns the number of entries in the snapshot.
+        """
+        now = time.time()
+        prefixes = tuple(self.key(ns, '') for ns in namespaces)
+        new = snapshot_lines((k, e, v) for k, e, v in self.local.items() if e > now and k.startswith(prefixes))
+        with snapshot_lock(self.snapshot.path):
+            # Another worker may have written a new snapshot in the meantime
+            self.snapshot.load()
+            changes = [0]
+            count = write_lines(self.snapshot.path, merge_lines(self.snapshot.lines(), new, now, changes), changes)
+            self.snapshot.load()
+        return count
+
+def make_cache(app):
+    """Set up the object cache from the config of the application"""
+    shared = None
+    client = app.config.get('OBJECTS_CACHE_CLIENT')
+    url = app.config.get('OBJECTS_CACHE_REDIS_URL')
+    if client is None and url:
+        if redis is None:
+            app.logger.error('OBJECTS_CACHE_REDIS_URL is set, but the redis module is not installed')
+        else:
+            client = redis.StrictRedis.from_url(url,
+                        socket_timeout=app.config.get('OBJECTS_CACHE_REDIS_TIMEOUT', 0.1))
+    if client is not None:
+        shared = SharedCache(client, app.config.get('OBJECTS_CACHE_RETRY_INTERVAL', 30))
+    snapshot = None
+    if app.config.get('OBJECTS_CACHE_SNAPSHOT'):
+        snapshot = Snapshot(app.config.get('OBJECTS_CACHE_SNAPSHOT'))
+    local = LRUCache(app.config.get('OBJECTS_CACHE_SIZE', 10000))
+    return ObjectCache(local, shared,
+                prefix=app.config.get('OBJECTS_CACHE_PREFIX', 'objects'),
+                ttl=app.config.get('OBJECTS_CACHE_TIMEOUT', 604800),
+                snapshot=snapshot,
+                max_stale=app.config.get('OBJECTS_CACHE_MAX_STALE', 0),
+                keep_expired=app.config.get('OBJECTS_CACHE_DEGRADED_TIMEOUT', 0) if app.config.get('OBJECTS_DEGRADED_MODE') else 0)
+
+def get_cache():
+    """Get the object cache of the application, set up from the config on first use"""
+    cache = current_app.extensions.get('object_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault('object_cache', make_cache(current_app))
+    return cache
+
+def mark_degraded():
+    """Flag the current request as served (partly) from expired cache entries"""
+    g.degraded = True
+
+def is_degraded():
+    return g.get('degraded', False)
+
+def mark_upstream_failure():
+    """Flag the current request as answered without (some) results of an upstream service"""
+    g.upstream_failure = True
+
+def upstream_failed():
+    return g.get('upstream_failure', False)
+
+# The keys of the cache entries being refreshed
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+def get_refresh_executor():
+    # Threads used to refresh stale cache entries
+    return get_executor('cache_refresh', current_app.config.get('OBJECTS_CACHE_REFRESH_WORKERS', 4))
+
+def revalidate(key, func, *args):
+    """
+    Call func(*args) in the background to refresh a stale cache entry, unless a
+    refresh for the same key is already under way
+    """
+    with refreshing_lock:
+        if key in refreshing:
+            return False
+        refreshing.add(key)
+    app = current_app._get_current_object()
+    try:
+        get_refresh_executor().submit(do_revalidate, app, key, func, *args)
+    except Exception:
+        with refreshing_lock:
+            refreshing.discard(key)
+        raise
+    return True
+
+def do_revalidate(app, key, func, *args):
+    try:
+        with app.app_context():
+            func(*args)
+    except Exception as err:
+        app.logger.error('Refreshing cache entry %s failed: %s' % (str(key), err))
+    finally:
+        with refreshing_lock:
+            refreshing.discard(key)
+
+def refresh_snapshot(app, cache):
+    """Periodically write the snapshot and pick up snapshots written by other workers"""
+    interval = app.config.get('OBJECTS_CACHE_SNAPSHOT_INTERVAL', 600)
+    namespaces = app.config.get('OBJECTS_CACHE_SNAPSHOT_NAMESPACES', ['simbad', 'ned'])
+    while True:
+        time.sleep(interval)
+        try:
+            count = cache.save_snapshot(namespaces)
+            app.logger.info('Wrote %s entries to cache snapshot %s' % (count, cache.snapshot.path))
+        except Exception as err:
+            app.logger.error('Failed to write cache snapshot %s: %s' % (cache.snapshot.path, err))
+
+def init_cache(app):
+    """
+    Set up the object cache when the application is created. If a snapshot is
+    configured, it is opened right away (warm start), and a background thread keeps
+    it up to date.
+    """
+    if not app.config.get('OBJECTS_CACHE_SNAPSHOT'):
+        # Nothing to warm up: the cache is set up on first use
+        return None
+    cache = app.extensions.setdefault('object_cache', make_cache(app))
+    if cache.snapshot.mm is not None:
+        app.logger.info('Loaded cache snapshot %s' % cache.snapshot.path)
+    refresher = threading.Thread(target=refresh_snapshot, args=(app, cache))
+    refresher.daemon = True
+    refresher.start()
+    return cache
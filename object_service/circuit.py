@@ -0,0 +1,115 @@
+from builtins import object
+import time
+import threading
+from collections import deque
+from flask import current_app
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for an upstream service (SIMBAD TAP mirrors, NED, Solr)
+
+    The breaker keeps track of the outcome of requests over a rolling time window.
+    When the error rate or the timeout rate in that window gets too high, the circuit
+    opens and requests fail fast (without contacting the service) for a cool-down
+    period. After the cool-down, one request at a time is let through as a probe
+    (half-open): a success closes the circuit again, a failure re-opens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window=60, min_requests=5, error_rate=0.5, timeout_rate=0.3, cooldown=30):
+        self.name = name
+        self.window = float(window)
+        self.min_requests = int(min_requests)
+        self.error_rate = float(error_rate)
+        self.timeout_rate = float(timeout_rate)
+        self.cooldown = float(cooldown)
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.probing = False
+        self.probe_started = 0
+        # entries are tuples (time, failed, timed out)
+        self.events = deque()
+        self.lock = threading.Lock()
+
+    def _prune(self, now):
+        while self.events and self.events[0][0] < now - self.window:
+            self.events.popleft()
+
+    def allow_request(self):
+        """Returns True if a request to the upstream service may be sent"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.cooldown:
+                    return False
+                self.state = self.HALF_OPEN
+                self.probing = False
+            # Half-open: only one probe request at a time (unless the probe got lost)
+            now = time.time()
+            if self.probing and now - self.probe_started < self.cooldown:
+                return False
+            self.probing = True
+            self.probe_started = now
+            return True
+
+    def release_request(self):
+        """
+        The request allowed by allow_request() was not sent after all (e.g. because of
+        the rate limit): if it was the probe, let another request probe the service
+        """
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            now = time.time()
+            if self.state != self.CLOSED:
+                # The probe request succeeded: the service is back
+                self.state = self.CLOSED
+                self.probing = False
+                self.events.clear()
+            self.events.append((now, False, False))
+            self._prune(now)
+
+    def record_failure(self, timeout=False):
+        with self.lock:
+            now = time.time()
+            if self.state != self.CLOSED:
+                # The probe request failed: back to open for another cool-down period
+                self._open(now)
+                return
+            self.events.append((now, True, timeout))
+            self._prune(now)
+            if len(self.events) < self.min_requests:
+                return
+            errors = sum(1 for e in self.events if e[1])
+            timeouts = sum(1 for e in self.events if e[2])
+            if float(errors) / len(self.events) >= self.error_rate or \
+               float(timeouts) / len(self.events) >= self.timeout_rate:
+                self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.probing = False
+        self.events.clear()
+
+def get_breaker(name):
+    """
+    Get the circuit breaker for the upstream service identified by 'name'
+    (typically the service URL). Breakers live for as long as the application.
+    """
+    breakers = current_app.extensions.setdefault('circuit_breakers', {})
+    breaker = breakers.get(name)
+    if breaker is None:
+        breaker = breakers.setdefault(name, CircuitBreaker(name,
+                    window=current_app.config.get('OBJECTS_CIRCUIT_WINDOW', 60),
+                    min_requests=current_app.config.get('OBJECTS_CIRCUIT_MIN_REQUESTS', 5),
+                    error_rate=current_app.config.get('OBJECTS_CIRCUIT_ERROR_RATE', 0.5),
+                    timeout_rate=current_app.config.get('OBJECTS_CIRCUIT_TIMEOUT_RATE', 0.3),
+                    cooldown=current_app.config.get('OBJECTS_CIRCUIT_COOLDOWN', 30)))
+    return breaker
@@ -0,0 +1,31 @@
+from flask import current_app
+from astropy.coordinates import SkyCoord
+from astropy.coordinates import Angle
+
+def canonical_cone(coordinates, radius, max_radius=None):
+    """
+    Canonical form of a cone search, so that the same cone written in different ways
+    ("80.894 -69.756:0.1", "05 23 34.6 -69 45 22:6'", ...) gives the same upstream
+    query and cache key: the tuple (ra, dec, radius), in degrees (ICRS), rounded to
+    OBJECTS_CONE_PRECISION decimals, with the radius at most max_radius
+    """
+    precision = current_app.config.get('OBJECTS_CONE_PRECISION', 5)
+    icrs = coordinates.icrs
+    radius = float(radius.degree)
+    if max_radius is not None:
+        radius = min(radius, float(max_radius))
+    # Adding 0.0 turns -0.0 into 0.0
+    ra = round(float(icrs.ra.degree) % 360.0, precision) % 360.0 + 0.0
+    dec = round(float(icrs.dec.degree), precision) + 0.0
+    # A radius that rounds to 0 would not find anything
+    radius = max(round(radius, precision), 10.0 ** -precision)
+    return ra, dec, radius
+
+def cone_key(ra, dec, radius):
+    """Key of a canonical cone, for caching, dedup and coalescing"""
+    precision = current_app.config.get('OBJECTS_CONE_PRECISION', 5)
+    return '%.*f %+.*f:%.*f' % (precision, ra, precision, dec, precision, radius)
+
+def cone_coordinates(ra, dec, radius):
+    """The position and radius of a canonical cone as astropy objects"""
+    return SkyCoord(ra, dec, frame='icrs', unit='deg'), Angle(radius, unit='deg')
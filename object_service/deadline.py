@@ -0,0 +1,32 @@
+import time
+from flask import current_app, request, g
+
+def set_request_deadline():
+    """
+    Set the deadline for the current request. All upstream calls made for the request
+    have to finish before this deadline. The time budget comes from the config, and
+    callers can ask for a shorter one by sending the number of seconds in a header.
+    """
+    budget = float(current_app.config.get('OBJECTS_REQUEST_DEADLINE', 30))
+    try:
+        budget = min(budget, float(request.headers.get(current_app.config.get('OBJECTS_DEADLINE_HEADER'))))
+    except (TypeError, ValueError):
+        pass
+    g.deadline = time.time() + budget
+
+def remaining_time(timeout=None):
+    """
+    Time-out to use for an upstream call: the given time-out, capped by the time left
+    before the request deadline (0 if the deadline has passed). Without a deadline,
+    the time-out is returned as is.
+    """
+    deadline = g.get('deadline')
+    if deadline is None:
+        return timeout
+    remaining = max(0, deadline - time.time())
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+def deadline_exceeded():
+    return remaining_time() == 0
@@ -0,0 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+def get_executor(name, max_workers):
+    """
+    Get the thread pool of the application with the given name, created on first use.
+    Pools live for as long as the application. (No threads are started until work
+    is submitted, so a pool that loses the race to be stored costs nothing.)
+    """
+    executors = current_app.extensions.setdefault('executors', {})
+    executor = executors.get(name)
+    if executor is None:
+        executor = executors.setdefault(name, ThreadPoolExecutor(max_workers=max_workers))
+    return executor
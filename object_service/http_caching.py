@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+import hashlib
+from functools import wraps
+from flask import current_app, request
+from flask import Response
+from .output import dumps
+from .cache import upstream_failed
+
+def unpack(result):
+    # The (data, status code, headers) of what a flask_restful view returned
+    if not isinstance(result, tuple):
+        return result, 200, {}
+    data = result[0]
+    status = result[1] if len(result) > 1 else 200
+    headers = result[2] if len(result) > 2 else {}
+    return data, status, dict(headers or {})
+
+def http_caching(name):
+    """
+    Decorator for views with responses that only depend on the request and on slowly
+    changing upstream data: adds a weak ETag (a hash of the JSON response, so it
+    changes when the translations change; weak, because the same response may be sent
+    with different content encodings) and the Cache-Control policy for the resource
+    (OBJECTS_CACHE_CONTROL), and answers conditional GET and HEAD requests
+    (If-None-Match) with a 304 when the client has the current response. As the ETag
+    is computed from the response, this saves sending the response, not the upstream
+    lookups. Errors, responses built from
+    expired translations (degraded mode) and responses that lack results because an
+    upstream service failed (e.g. unknown objects that were never looked up) are not
+    to be cached.
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if isinstance(result, Response):
+                return result
+            data, status, headers = unpack(result)
+            if status != 200 or not isinstance(data, dict) or 'Error' in data or data.get('degraded') \
+                    or upstream_failed():
+                headers['Cache-Control'] = 'no-store'
+                return data, status, headers
+            etag = hashlib.sha1(dumps(data)).hexdigest()
+            headers['ETag'] = 'W/"%s"' % etag
+            policy = current_app.config.get('OBJECTS_CACHE_CONTROL', {}).get(name)
+            if policy:
+                headers['Cache-Control'] = policy
+            if request.method in ('GET', 'HEAD') and request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers=headers)
+            return data, status, headers
+        return decorated
+    return decorator
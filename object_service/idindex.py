@@ -0,0 +1,129 @@
+"""
+    idindex
+    ~~~~~~~
+    Local index of the SIMBAD and NED identifiers (simbid and nedid values) that are
+    in the Solr index, so that identifiers can be checked without asking Solr. The
+    index is built offline from terms exports, one file per field, e.g.
+
+        curl '.../solr/collection1/terms?terms.fl=simbid&terms.limit=-1&wt=json' > simbid.json
+        python -m object_service.idindex /data/identifiers.idx simbid=simbid.json nedid=nedid.txt
+
+    A terms export is the JSON response of the Solr terms component, or a text file
+    with one identifier per line (optionally followed by a tab and a count). The index
+    is picked up by the service (OBJECTS_ID_INDEX) whenever the file is replaced.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+from flask import current_app
+from .sortedfile import SortedFile
+
+class IdentifierIndex(SortedFile):
+    """
+    Sorted file with one line per indexed identifier:
+
+        field<TAB>identifier
+
+    The file is memory-mapped and looked up by binary search, so a lookup costs
+    microseconds and the pages are shared by all workers on the host.
+    """
+    def __init__(self, path):
+        self.checked = 0
+        SortedFile.__init__(self, path)
+
+    def load(self):
+        """(Re)open the index file, if it exists and has changed since we opened it"""
+        self.checked = time.time()
+        return SortedFile.load(self)
+
+    def has_field(self, field):
+        """Returns True if the index has the identifiers of the field"""
+        prefix = ('%s\t' % field).encode('utf-8')
+        line = self.lower_bound(prefix)
+        return line is not None and line.startswith(prefix)
+
+    def contains(self, field, identifier):
+        """Returns True if the identifier is in the index"""
+        target = ('%s\t%s' % (field, identifier)).encode('utf-8')
+        return self.lower_bound(target) == target
+
+def write_index(path, entries):
+    """
+    Write an identifier index with the given (field, identifier) tuples. The file is
+    written under a temporary name and then moved into place, so readers never see a
+    partial index. Returns the number of identifiers written.
+    """
+    lines = set()
+    for field, identifier in entries:
+        identifier = identifier.strip()
+        if not identifier or '\t' in identifier or '\n' in identifier:
+            continue
+        lines.add(('%s\t%s' % (field, identifier)).encode('utf-8'))
+    tmp = '%s.%s' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(b'\n'.join(sorted(lines)))
+    os.rename(tmp, path)
+    return len(lines)
+
+def read_terms(f, field):
+    """
+    Returns the identifiers in a terms export for the field: a Solr terms component
+    response (JSON), or one identifier per line
+    """
+    data = f.read()
+    if data.lstrip().startswith('{'):
+        terms = json.loads(data)['terms'][field]
+        if isinstance(terms, dict):
+            # json.nl=map
+            return list(terms.keys())
+        # Flat list of terms and counts
+        return [str(t) for t in terms[::2]]
+    return [line.split('\t')[0] for line in data.splitlines() if line.strip()]
+
+def get_identifier_index():
+    """
+    Get the identifier index of the application, or None if there is none. Every
+    OBJECTS_ID_INDEX_CHECK_INTERVAL seconds we check whether the file was replaced.
+    """
+    path = current_app.config.get('OBJECTS_ID_INDEX')
+    if not path:
+        return None
+    index = current_app.extensions.get('identifier_index')
+    if index is None:
+        index = current_app.extensions.setdefault('identifier_index', IdentifierIndex(path))
+    elif time.time() - index.checked > current_app.config.get('OBJECTS_ID_INDEX_CHECK_INTERVAL', 60):
+        if index.load():
+            current_app.logger.info('Loaded identifier index %s' % path)
+    if index.mm is None:
+        return None
+    return index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the index of identifiers in Solr from terms exports')
+    parser.add_argument('output', help='index file to write')
+    parser.add_argument('exports', nargs='+', metavar='field=file', help='terms export of a field, e.g. simbid=simbid.json ("-" for standard input)')
+    args = parser.parse_args(argv)
+
+    entries = []
+    for export in args.exports:
+        field, sep, fname = export.partition('=')
+        if not sep:
+            parser.error('expected field=file, got %s' % export)
+        f = sys.stdin if fname == '-' else open(fname)
+        try:
+            identifiers = read_terms(f, field)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        print('%s: %s identifiers' % (field, len(identifiers)))
+        entries.extend((field, i) for i in identifiers)
+    count = write_index(args.output, entries)
+    print('Wrote %s identifiers to %s' % (count, args.output))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+from builtins import object
+import os
+import time
+import json
+import uuid
+import threading
+from flask import current_app, g
+from flask import copy_current_request_context
+from .executors import get_executor
+from .admission import AdmissionControl
+from .admission import client_key
+
+class MemoryJobStore(object):
+    """Job records of this worker, kept in memory"""
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def save(self, job):
+        with self.lock:
+            self.jobs[job['id']] = dict(job)
+            # Forget about jobs nobody came back for
+            now = time.time()
+            for job_id in [k for k, v in self.jobs.items() if v['created'] < now - self.ttl]:
+                del self.jobs[job_id]
+
+class FileJobStore(object):
+    """
+    Job records kept as JSON files in a directory, so that all workers on the host
+    (which share the directory) can report on every job
+    """
+    def __init__(self, directory, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, job_id):
+        return os.path.join(self.directory, '%s.json' % job_id)
+
+    def get(self, job_id):
+        try:
+            with open(self.path(job_id)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, job):
+        tmp = '%s.%s' % (self.path(job['id']), os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+        os.rename(tmp, self.path(job['id']))
+        if job['status'] == 'queued':
+            self.prune()
+
+    def prune(self):
+        cutoff = time.time() - self.ttl
+        for fname in os.listdir(self.directory):
+            path = os.path.join(self.directory, fname)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def get_job_store():
+    store = current_app.extensions.get('job_store')
+    if store is None:
+        ttl = current_app.config.get('OBJECTS_JOB_TTL', 3600)
+        if current_app.config.get('OBJECTS_JOB_DIR'):
+            store = FileJobStore(current_app.config.get('OBJECTS_JOB_DIR'), ttl)
+        else:
+            store = MemoryJobStore(ttl)
+        store = current_app.extensions.setdefault('job_store', store)
+    return store
+
+def get_job_executor():
+    # Threads used to run jobs
+    return get_executor('jobs', current_app.config.get('OBJECTS_JOB_WORKERS', 4))
+
+def get_job_limits():
+    # Limits on the number of queued and running jobs, per client and in total (like
+    # admission control for requests, but without a wait queue)
+    limits = current_app.extensions.get('job_limits')
+    if limits is None:
+        limits = current_app.extensions.setdefault('job_limits', AdmissionControl(
+                        client_limit=current_app.config.get('OBJECTS_JOB_CLIENT_LIMIT', 4),
+                        total_limit=current_app.config.get('OBJECTS_JOB_TOTAL_LIMIT', 32),
+                        queue_size=0, max_wait=0))
+    return limits
+
+def submit_job(func, *args):
+    """
+    Run func(*args) in the background, with a copy of the current request context and
+    a deadline of its own. Returns the job record; the result ends up in the job store
+    under the job id. Returns None if the client, or everyone together, has too many
+    jobs queued or running already.
+    """
+    limits = get_job_limits()
+    client = client_key()
+    if not limits.acquire(client):
+        return None
+    store = get_job_store()
+    job = {'id': uuid.uuid4().hex, 'status': 'queued', 'created': time.time()}
+    store.save(job)
+    budget = current_app.config.get('OBJECTS_JOB_DEADLINE', 300)
+
+    @copy_current_request_context
+    def run():
+        try:
+            g.deadline = time.time() + budget
+            store.save(dict(job, status='running'))
+            try:
+                result = func(*args)
+            except Exception as err:
+                current_app.logger.error('Job %s blew up: %s' % (job['id'], err))
+                result = {"Error": "Unable to get results!", "Error Info": "Job failed: %s" % err}
+            status = 'failed' if 'Error' in result else 'done'
+            store.save(dict(job, status=status, result=result, finished=time.time()))
+        finally:
+            limits.release(client)
+
+    try:
+        get_job_executor().submit(run)
+    except Exception:
+        limits.release(client)
+        raise
+    return job
+
+def wait_for_job(job_id, timeout):
+    """Returns the job record as soon as the job is finished, or when the time-out is over"""
+    store = get_job_store()
+    end = time.time() + timeout
+    while True:
+        job = store.get(job_id)
+        if job is None or job['status'] in ['done', 'failed'] or time.time() >= end:
+            return job
+        time.sleep(0.1)
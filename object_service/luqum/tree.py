@@ -260,7 +260,7 @@ class BaseOperation(Item):
     :param operands: expressions to apply operation on
     """
     def __init__(self, *operands):
-        self.operands = operands
+        self.operands = list(operands)
 
     def __str__(self):
         return (" %s " % self.op).join(str(o) for o in self.operands)
@@ -305,9 +305,16 @@ class AndOperation(BaseOperation):
 
 def create_operation(cls, a, b):
     """Create operation between a and b, merging if a or b is already an operation of same class
+
+    If ``a`` is already an operation of class ``cls``, ``b`` is appended to its
+    operands in place and ``a`` is returned. This way a chain like
+    ``A OR B OR ... OR Z`` ends up as a single n-ary node, built in linear time,
+    whatever the length of the chain.
     """
-    operands = []
-    operands.extend(a.operands if isinstance(a, cls) else [a])
+    if isinstance(a, cls):
+        a.operands.extend(b.operands if isinstance(b, cls) else [b])
+        return a
+    operands = [a]
     operands.extend(b.operands if isinstance(b, cls) else [b])
     return cls(*operands)
 
@@ -126,7 +126,9 @@ class LuceneTreeTransformer(LuceneTreeVisitor):
         parents = parents or []
         method = self._get_method(node)
         new_node = method(node, parents)
-        if parents:
+        # only look the node up in its parent if it actually changed: with n-ary
+        # operations, searching the operands of the parent for every child is quadratic
+        if parents and new_node is not node:
             self.replace_node(node, new_node, parents[-1])
         node = new_node
         for child in node.children:
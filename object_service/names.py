@@ -0,0 +1,28 @@
+import re
+from collections import OrderedDict
+
+def cleanup_object_name(object_name):
+    # remove catalog prefix if present
+    return re.sub(r'^(NAME|\*|S?V\*)\s+','',object_name)
+
+def normalize_object_name(object_name):
+    """
+    Canonical form of an object name, used to recognize the different ways of writing
+    the same name ("M 31", "m31", "M_31", "NAME M31"): no catalog prefix, no case and
+    no whitespace (underscores are used as spaces in NED identifiers)
+    """
+    name = object_name.replace('_', ' ').strip().upper()
+    name = cleanup_object_name(name)
+    return re.sub(r'\s+', '', name)
+
+def group_object_names(object_names):
+    """
+    Group object names by their normalized form. Returns an ordered dictionary with
+    the distinct spellings (in order of appearance) for every normalized name.
+    """
+    groups = OrderedDict()
+    for name in object_names:
+        spellings = groups.setdefault(normalize_object_name(name), [])
+        if name not in spellings:
+            spellings.append(name)
+    return groups
@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+import gzip
+import json
+from flask import current_app, request
+from flask import make_response
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def dumps(data):
+    """
+    Serialize the data of a response to JSON (bytes): with orjson when it is installed,
+    and otherwise with the standard library, without any whitespace
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            # Something orjson does not know how to serialize
+            pass
+    return (json.dumps(data, separators=(',', ':')) + '\n').encode('utf-8')
+
+def output_json(data, code, headers=None):
+    """JSON representation of flask_restful responses, with the fast encoder"""
+    resp = make_response(dumps(data), code)
+    resp.headers.extend(headers or {})
+    resp.mimetype = 'application/json'
+    return resp
+
+def compress(data, encoding):
+    # Compress the data for the given content encoding
+    levels = current_app.config.get('OBJECTS_COMPRESSION_LEVELS', {})
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=levels.get('zstd', 3)).compress(data)
+    if encoding == 'br':
+        return brotli.compress(data, quality=levels.get('br', 4))
+    return gzip.compress(data, compresslevel=levels.get('gzip', 6))
+
+def available_encodings():
+    # The content encodings we can do, in order of preference
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+def compress_response(response):
+    """
+    Compress the response with the best content encoding the client accepts
+    (Accept-Encoding), if it is big enough to make it worthwhile. Streamed responses
+    are sent as they are. A strong ETag is made weak when the response is compressed,
+    as it was computed for the uncompressed response.
+    """
+    if not current_app.config.get('OBJECTS_COMPRESSION', True):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in current_app.config.get('OBJECTS_COMPRESSION_TYPES', ['application/json', 'text/plain']):
+        return response
+    if (response.content_length or 0) < current_app.config.get('OBJECTS_COMPRESSION_MIN_SIZE', 1024):
+        return response
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if not encoding:
+        return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,112 @@
+from builtins import object
+import os
+import time
+import struct
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from flask import current_app
+from future.moves.urllib.parse import urlparse
+
+class TokenBucket(object):
+    """
+    Token bucket for the requests to an upstream service: 'rate' requests per second
+    on average, with bursts of up to 'burst' requests. A request that finds the bucket
+    empty reserves the next token and waits for it. When a state file is given, the
+    bucket is shared by all processes using that file (the workers on a host).
+    """
+    STATE = struct.Struct('<dd')
+
+    def __init__(self, rate, burst, path=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.lock = threading.Lock()
+        self.fd = None
+        if path and fcntl is not None:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # State when not shared: number of tokens and time of the last update
+        self.state = (self.burst, time.time())
+        # Statistics: number of requests, number of requests that had to wait, total
+        # and maximum waiting time
+        self.requests = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def read(self):
+        if self.fd is None:
+            return self.state
+        data = os.pread(self.fd, self.STATE.size, 0)
+        if len(data) < self.STATE.size:
+            return (self.burst, time.time())
+        return self.STATE.unpack(data)
+
+    def write(self, tokens, updated):
+        if self.fd is None:
+            self.state = (tokens, updated)
+        else:
+            os.pwrite(self.fd, self.STATE.pack(tokens, updated), 0)
+
+    def reserve(self, max_wait):
+        """
+        Take a token. Returns the time to wait for it (0 if there was one), or None if
+        that would take longer than max_wait (in which case no token is taken).
+        """
+        with self.lock:
+            if self.fd is not None:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                tokens, updated = self.read()
+                now = time.time()
+                tokens = min(self.burst, tokens + max(0, now - updated) * self.rate)
+                wait = max(0.0, (1 - tokens) / self.rate)
+                if max_wait is not None and wait > max_wait:
+                    self.write(tokens, now)
+                    return None
+                self.write(tokens - 1, now)
+            finally:
+                if self.fd is not None:
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN)
+            self.requests += 1
+            if wait > 0:
+                self.delayed += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            return wait
+
+def get_rate_limiter(service, url):
+    """
+    Get the rate limiter for requests to a service (e.g. 'simbad') at the host of the
+    given URL, or None if there is no rate limit for the service
+    """
+    limit = current_app.config.get('OBJECTS_%s_RATE_LIMIT' % service.upper())
+    if not limit:
+        return None
+    name = '%s_%s' % (service, urlparse(url).netloc)
+    limiters = current_app.extensions.setdefault('rate_limiters', {})
+    limiter = limiters.get(name)
+    if limiter is None:
+        path = None
+        directory = current_app.config.get('OBJECTS_RATE_LIMIT_DIR')
+        if directory:
+            path = os.path.join(directory, 'object_service_%s.bucket' % name.replace(':', '_'))
+        limiter = limiters.setdefault(name, TokenBucket(limit[0], limit[1], path))
+    return limiter
+
+def wait_for_rate_limit(service, url, max_wait):
+    """
+    Wait until a request to the service may be sent without going over its rate
+    limit. Returns the time waited, or None if we would have to wait longer than
+    max_wait seconds.
+    """
+    limiter = get_rate_limiter(service, url)
+    if limiter is None:
+        return 0
+    wait = limiter.reserve(max_wait)
+    if wait:
+        current_app.logger.info('Waited %.3f s for the %s rate limit (%s of %s requests delayed, %.3f s on average, %.3f s maximum)' % \
+            (wait, service.upper(), limiter.delayed, limiter.requests, limiter.total_wait / limiter.delayed, limiter.max_wait))
+        time.sleep(wait)
+    return wait
@@ -0,0 +1,83 @@
+from builtins import object
+import threading
+from flask import current_app, g
+from requests.exceptions import Timeout
+import timeout_decorator
+from .deadline import remaining_time
+
+class Call(object):
+    """An upstream call in flight, shared by everyone asking for the same thing"""
+    def __init__(self, deadline=None):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Deadline of the request that makes the call
+        self.deadline = deadline
+
+    def ran_out_of_time(self):
+        # Did the call fail because it timed out?
+        if self.error is not None:
+            return isinstance(self.error, (Timeout, timeout_decorator.TimeoutError))
+        if isinstance(self.result, dict):
+            info = str(self.result.get('Error Info', ''))
+            return 'timed out' in info or 'deadline exceeded' in info
+        return False
+
+def has_more_time(deadline):
+    # Does the current request have more time than a request with the given deadline?
+    if deadline is None:
+        return False
+    own = g.get('deadline')
+    return own is None or own > deadline
+
+class SingleFlight(object):
+    """
+    Deduplication of identical concurrent upstream calls: the first thread asking for
+    a key does the call, the others wait for it and all receive the same result.
+    Since the call is made with the time budget of the first request, a call that
+    timed out is not the last word for requests with more time left: they try again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = Call(g.get('deadline'))
+            if leader:
+                break
+            # Don't wait longer than the deadline of our own request allows (and
+            # don't send a request of our own when that has passed)
+            if not call.done.wait(remaining_time()):
+                return {"Error": "Unable to get results!",
+                        "Error Info": "Upstream request not sent: request deadline exceeded"}
+            if call.ran_out_of_time() and has_more_time(call.deadline):
+                # The call ran out of the time of another request: we have more
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+def coalesce(key, func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs), unless an identical call (same key) is already in
+    flight in this worker, in which case we wait for that call and use its result
+    """
+    flights = current_app.extensions.get('single_flight')
+    if flights is None:
+        flights = current_app.extensions.setdefault('single_flight', SingleFlight())
+    return flights.do(key, func, *args, **kwargs)
@@ -0,0 +1,72 @@
+from builtins import object
+import os
+import mmap
+
+class SortedFile(object):
+    """
+    Read-only file of sorted lines, memory-mapped and looked up by binary search, so
+    that opening a file with millions of lines costs (almost) nothing and its pages
+    are shared by all workers on the host. The file may be replaced (moved into place)
+    at any time; load() picks up the new one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        # Modification time and inode of the file we opened (a file that is moved
+        # into place has a new inode, even if its modification time looks the same)
+        self.version = None
+        self.load()
+
+    def load(self):
+        """(Re)open the file, if it exists and has changed since we opened it"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        version = (st.st_mtime, st.st_ino)
+        if version == self.version:
+            return False
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        # Lookups in progress keep the previous mapping, which is closed once unused
+        self.mm = mm
+        self.version = version
+        return True
+
+    def lower_bound(self, target, key=None):
+        """
+        Returns the first line that is not smaller than the target, or None. If given,
+        key(line) is what the lines are sorted by (and compared with the target).
+        """
+        mm = self.mm
+        if mm is None:
+            return None
+        lo, hi = 0, len(mm)
+        found = None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b'\n', 0, mid) + 1
+            end = mm.find(b'\n', start)
+            if end < 0:
+                end = len(mm)
+            line = mm[start:end]
+            if (key(line) if key else line) < target:
+                lo = end + 1
+            else:
+                found = line
+                hi = start
+        return found
+
+    def lines(self):
+        """Iterates over the lines of the file, in order"""
+        mm = self.mm
+        if mm is None:
+            return
+        start, size = 0, len(mm)
+        while start < size:
+            end = mm.find(b'\n', start)
+            if end < 0:
+                end = size
+            yield mm[start:end]
+            start = end + 1
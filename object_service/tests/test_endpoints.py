@@ -47,6 +47,81 @@ class TestExpectedResults(TestCase):
         expected = {u'3133169': {u'id': '3133169', u'canonical': u'LMC'}, u'1575544': {u'id': '1575544', u'canonical': u'ANDROMEDA'}}
         self.assertEqual(r.json, expected)
 
+    @httpretty.activate
+    def test_object_search_name_variants(self):
+        '''Test to see if object names are matched however they are written'''
+        QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        mockdata =  {"data":[[1575544, "M  31", "M  31"],[1575544, "NAME ANDROMEDA", "M  31"]]}
+        objects = ["m31", "M_31", "Andromeda"]
+        httpretty.register_uri(
+            httpretty.POST, QUERY_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(mockdata))
+        r = self.client.post(
+            url_for('objectsearch'),
+            content_type='application/json',
+            data=json.dumps({'objects': objects}))
+        self.assertTrue(r.status_code == 200)
+        expected = {'id': '1575544', 'canonical': 'M  31'}
+        self.assertEqual(r.json, {'m31': expected, 'M_31': expected, 'Andromeda': expected})
+
+    @httpretty.activate
+    def test_object_search_stream(self):
+        '''Test to see if object search results can be streamed as NDJSON'''
+        QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        self.app.config['OBJECTS_SIMBAD_CHUNK_SIZE'] = 2
+        mockdata =  {"data":[[1575544, "NAME ANDROMEDA","NAME ANDROMEDA"],[3133169, "NAME LMC", "NAME LMC"]]}
+        objects = ["Andromeda", "LMC", "Foo"]
+        httpretty.register_uri(
+            httpretty.POST, QUERY_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(mockdata))
+        r = self.client.post(
+            url_for('objectsearch'),
+            content_type='application/json',
+            data=json.dumps({'objects': objects, 'stream': True}))
+        self.assertTrue(r.status_code == 200)
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        lines = [json.loads(l) for l in r.data.decode('utf-8').splitlines()]
+        # One line per object
+        self.assertEqual(len(lines), 3)
+        results = {}
+        for line in lines:
+            results.update(line)
+        expected = {'Andromeda': {'id': '1575544', 'canonical': 'ANDROMEDA'},
+                    'LMC': {'id': '3133169', 'canonical': 'LMC'},
+                    'Foo': None}
+        self.assertEqual(results, expected)
+
+    @httpretty.activate
+    def test_object_search_stream_ned(self):
+        '''Test to see if NED object search results can be streamed as NDJSON'''
+        self.app.config['OBJECTS_SIMBAD_TAP_URL'] = self.app.config.get('OBJECTS_SIMBAD_TAP_URL_CDS')
+        NED_QUERY_URL = self.app.config.get('OBJECTS_NED_URL')
+        ned_mockdata = {'Preferred': {'Name': 'Andromeda'},
+                        'ResultCode': 3,
+                        'StatusCode': 100}
+        httpretty.register_uri(
+            httpretty.POST, NED_QUERY_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(ned_mockdata))
+        httpretty.register_uri(
+            httpretty.POST, self.app.config.get('OBJECTS_SIMBAD_TAP_URL'),
+            content_type='application/json',
+            status=200,
+            body='{"data": []}')
+        r = self.client.post(
+            url_for('objectsearch'),
+            content_type='application/json',
+            data=json.dumps({'objects': ['Andromeda', 'M31'], 'source': 'NED', 'stream': True}))
+        self.assertTrue(r.status_code == 200)
+        lines = [json.loads(l) for l in r.data.decode('utf-8').splitlines()]
+        expected = {'id': 'Andromeda', 'canonical': 'Andromeda'}
+        self.assertEqual(lines, [{'Andromeda': expected}, {'M31': expected}])
+
     @httpretty.activate
     def test_object_search_500(self):
         '''Test to see if a 500 from SIMBAD is processed correctly'''
@@ -223,9 +298,10 @@ class TestExpectedResults(TestCase):
         ned_mockdata = "\n".join(['bibcode1|Andromeda|foo|bar'])
         # Define the mock data to be returned to mock the Solr verify request
         SOLR_QUERY_URL = self.app.config.get('OBJECTS_SOLRQUERY_URL')
-        solr_mockdata = {"response":{
-            "docs":["a","b","c"]
-        }}
+        solr_mockdata = {"response":{"numFound":4, "docs":[]},
+            "facet_counts":{"facet_queries":{'simbid:"1575544"':1, 'simbid:"3133169"':1,
+                                             'simbid:"3253618"':1, 'nedid:"Andromeda"':1}}
+        }
         # The test query we will provide
         query = 'bibstem:A&A object:"80.89416667 -69.75611111:0.166666" year:2015'
         # Mock the SIMBAD reponse
@@ -281,6 +357,22 @@ class TestExpectedResults(TestCase):
         expected = {'Error': 'Unable to get results!', 'Error Info': 'SIMBAD request failed (not timeout): SIMBAD query blew up!, NED cone search failed (NED query blew up!)'}
         self.assertEqual(r.json, expected)
 
+    @mock.patch('object_service.views.ned_position_query')
+    @mock.patch('object_service.views.simbad_position_query')
+    @mock.patch('object_service.utils.current_app.client.get')
+    def test_position_search_solr_timeout(self, solr_mock, simbad_mock, ned_mock):
+        '''When the Solr verification times out, the unverified identifiers are used'''
+        simbad_mock.return_value = ['1575544']
+        ned_mock.return_value = ['Andromeda']
+        solr_mock.side_effect = requests.exceptions.ReadTimeout('Solr took too long')
+        query = 'object:"80.89416667 -69.75611111:0.166666"'
+        r = self.client.post(
+            url_for('querysearch'),
+            content_type='application/json',
+            data=json.dumps({'query': query}))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json, {'query': '(simbid:(1575544) OR nedid:(Andromeda))'})
+
     @httpretty.activate
     def test_id_search_200(self):
         '''Test to see if calling the id search endpoint
@@ -351,6 +443,173 @@ class TestExpectedResults(TestCase):
         expected = {'query': 'bibstem:A&A ((=abs:Andromeda OR simbid:1575544 OR nedid:Andromeda) database:astronomy) year:2015'}
         self.assertEqual(r.json, expected)
 
+    @httpretty.activate
+    def test_query_search_http_caching(self):
+        '''test cache headers and conditional requests for query translations'''
+        SIMBAD_QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        simbad_mockdata =  {"data":[[1575544, "NAME ANDROMEDA","NAME ANDROMEDA"]]}
+        NED_QUERY_URL = self.app.config.get('OBJECTS_NED_URL')
+        ned_mockdata = {'Preferred': {'Name': 'Andromeda'},
+                        'ResultCode': 3,
+                        'StatusCode': 100}
+        httpretty.register_uri(
+            httpretty.POST, SIMBAD_QUERY_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(simbad_mockdata))
+        httpretty.register_uri(
+            httpretty.POST, NED_QUERY_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(ned_mockdata))
+        query = 'bibstem:A&A object:Andromeda year:2015'
+        expected = {'query': 'bibstem:A&A ((=abs:Andromeda OR simbid:1575544 OR nedid:Andromeda) database:astronomy) year:2015'}
+        r = self.client.post(
+            url_for('querysearch'),
+            content_type='application/json',
+            data=json.dumps({'query': query}))
+        self.assertEqual(r.json, expected)
+        self.assertEqual(r.headers['Cache-Control'], self.app.config['OBJECTS_CACHE_CONTROL']['query'])
+        etag = r.headers['ETag']
+        # The same translation with a GET request has the same ETag
+        r = self.client.get(url_for('querysearch', query=query))
+        self.assertEqual(r.json, expected)
+        self.assertEqual(r.headers['ETag'], etag)
+        # The client has the current translation
+        r = self.client.get(url_for('querysearch', query=query), headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.data, b'')
+        self.assertEqual(r.headers['ETag'], etag)
+        r = self.client.get(url_for('querysearch', query=query), headers={'If-None-Match': '"outdated"'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json, expected)
+        # Only GET (and HEAD) requests are answered with a 304
+        r = self.client.post(
+            url_for('querysearch'),
+            content_type='application/json',
+            headers={'If-None-Match': etag},
+            data=json.dumps({'query': query}))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json, expected)
+        # Errors are not cached
+        r = self.client.get(url_for('querysearch'))
+        self.assertEqual(r.json['Error'], 'Unable to get results!')
+        self.assertEqual(r.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', r.headers)
+
+    @httpretty.activate
+    def test_query_search_http_caching_compressed(self):
+        '''test conditional requests for query translations sent compressed'''
+        self.app.config['OBJECTS_COMPRESSION_MIN_SIZE'] = 0
+        SIMBAD_QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        simbad_mockdata =  {"data":[[1575544, "NAME ANDROMEDA","NAME ANDROMEDA"]]}
+        NED_QUERY_URL = self.app.config.get('OBJECTS_NED_URL')
+        ned_mockdata = {'Preferred': {'Name': 'Andromeda'},
+                        'ResultCode': 3,
+                        'StatusCode': 100}
+        httpretty.register_uri(
+            httpretty.POST, SIMBAD_QUERY_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(simbad_mockdata))
+        httpretty.register_uri(
+            httpretty.POST, NED_QUERY_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(ned_mockdata))
+        query = 'bibstem:A&A object:Andromeda year:2015'
+        r = self.client.get(url_for('querysearch', query=query), headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        etag = r.headers['ETag']
+        # The ETag is not that of the gzipped bytes: it is weak, and the same as the
+        # ETag of the uncompressed response
+        self.assertTrue(etag.startswith('W/"'))
+        r = self.client.get(url_for('querysearch', query=query))
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(r.headers['ETag'], etag)
+        # The client has the current translation, compressed or not
+        for accept_encoding in ['gzip', 'identity']:
+            r = self.client.get(url_for('querysearch', query=query),
+                                headers={'If-None-Match': etag, 'Accept-Encoding': accept_encoding})
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(r.data, b'')
+            self.assertEqual(r.headers['ETag'], etag)
+            self.assertNotIn('Content-Encoding', r.headers)
+        # Clients may also send the ETag without the weak prefix
+        r = self.client.get(url_for('querysearch', query=query),
+                            headers={'If-None-Match': etag[2:], 'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.status_code, 304)
+
+    @httpretty.activate
+    def test_query_search_degraded(self):
+        '''test translation Solr query with expired translations when SIMBAD and NED fail'''
+        from object_service.cache import get_cache
+        cache = get_cache()
+        cache.max_stale = 0
+        cache.keep_expired = 3600
+        cache.set_entry('simbad', 'ANDROMEDA', '1575544', ttl=-1)
+        cache.set_entry('ned', 'ANDROMEDA', 'Andromeda', ttl=-1)
+        for QUERY_URL in [self.app.config.get('OBJECTS_SIMBAD_TAP_URL'),
+                          self.app.config.get('OBJECTS_SIMBAD_TAP_URL_CDS'),
+                          self.app.config.get('OBJECTS_NED_URL')]:
+            httpretty.register_uri(
+                httpretty.POST, QUERY_URL,
+                content_type='application/json',
+                status=500,
+                body='')
+        query = 'bibstem:A&A object:Andromeda year:2015'
+        r = self.client.post(
+            url_for('querysearch'),
+            content_type='application/json',
+            data=json.dumps({'query': query}))
+        expected = {'query': 'bibstem:A&A ((=abs:Andromeda OR simbid:1575544 OR nedid:Andromeda) database:astronomy) year:2015',
+                    'degraded': True}
+        self.assertEqual(r.json, expected)
+        # Degraded translations are not to be cached
+        self.assertEqual(r.headers['Cache-Control'], 'no-store')
+
+    @mock.patch('object_service.NED.current_app.client.post')
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_query_search_upstream_timeout(self, mocked_simbad, mocked_ned):
+        '''test that translations made while SIMBAD and NED time out are not cached'''
+        mocked_simbad.side_effect = ReadTimeout('Connection timed out.')
+        mocked_ned.side_effect = ReadTimeout('Connection timed out.')
+        query = 'bibstem:A&A object:Andromeda year:2015'
+        r = self.client.get(url_for('querysearch', query=query))
+        self.assertEqual(r.status_code, 200)
+        # Without a translation to fall back on, the object is not found
+        self.assertEqual(r.json, {'query': 'bibstem:A&A ((=abs:Andromeda OR simbid:0 OR nedid:0) database:astronomy) year:2015'})
+        self.assertEqual(r.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', r.headers)
+
+    @mock.patch('object_service.NED.current_app.client.post')
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_object_search_ned_deadline(self, mocked_simbad, mocked_ned):
+        '''test that object searches without time left for NED lookups are not cached'''
+        header = self.app.config.get('OBJECTS_DEADLINE_HEADER')
+        r = self.client.post(
+            url_for('objectsearch'),
+            content_type='application/json',
+            headers={header: '0'},
+            data=json.dumps({'objects': ['M31', 'LMC'], 'source': 'ned'}))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json, {'M31': None, 'LMC': None})
+        self.assertEqual(mocked_ned.call_count, 0)
+        self.assertEqual(r.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', r.headers)
+
+    @mock.patch('object_service.NED.current_app.client.post')
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_object_search_ned_timeout(self, mocked_simbad, mocked_ned):
+        '''test that object searches are not cached when NED lookups time out'''
+        mocked_ned.side_effect = ReadTimeout('Connection timed out.')
+        r = self.client.post(
+            url_for('objectsearch'),
+            content_type='application/json',
+            data=json.dumps({'objects': ['M31'], 'source': 'ned'}))
+        self.assertTrue('timed out' in r.json['Error Info'])
+        self.assertEqual(r.headers['Cache-Control'], 'no-store')
+
     @httpretty.activate
     def test_list_query_search_200(self):
         '''test translation Solr query (submitted as list) with "object:" modifier'''
@@ -9,6 +9,7 @@ import time
 from object_service import app
 import json
 import httpretty
+import mock
 
 class TestExpectedResults(TestCase):
 
@@ -86,6 +87,27 @@ class TestExpectedResults(TestCase):
         # The response should have a status code 200
         self.assertTrue(r.status_code == 200)
 
+    @httpretty.activate
+    @mock.patch('requests.Session.get')
+    def test_classic_query_search_solr_timeout(self, solr_mock):
+        '''A Solr time-out gives a 504'''
+        NED_URL = self.app.config.get('OBJECTS_NED_URL')
+        neddata = {'Preferred': {'Name': 'MESSIER 031'},
+                   'ResultCode': 3,
+                   'StatusCode': 100}
+        httpretty.register_uri(
+            httpretty.POST, NED_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(neddata))
+        solr_mock.side_effect = requests.exceptions.ReadTimeout('Solr took too long')
+        r = self.client.post(
+            url_for('classicobjectsearch'),
+            content_type='application/json',
+            data=json.dumps({'objects': ["NGC 224"]}))
+        self.assertEqual(r.status_code, 504)
+        self.assertEqual(r.json['Error Info'], 'Solr request timed out: Solr took too long')
+
     @httpretty.activate
     def test_classic_query_search_ambiguous(self):
         '''test query for the ADS Classic NED support - NED returns ambiguous results'''
@@ -174,5 +196,94 @@ class TestExpectedResults(TestCase):
         expected = {u'Error Info': u'No object names found in POST body', u'Error': u'Unable to get results!'}
         self.assertEqual(r.json, expected)
 
+    @httpretty.activate
+    def test_classic_query_search_job(self):
+        '''test submitting an ADS Classic NED query as a job'''
+        NED_URL = self.app.config.get('OBJECTS_NED_URL')
+        SOLRQUERY_URL = self.app.config.get('OBJECTS_SOLRQUERY_URL')
+        neddata = {u'Preferred': {u'Name': u'MESSIER 031'}, u'ResultCode': 3, u'StatusCode': 100}
+        solrdata = {u'response': {u'docs': [{u'bibcode': u'2016ApJ...817..111D'}, {u'bibcode': u'2016A&A...587A..52M'}]}}
+        httpretty.register_uri(
+            httpretty.POST, NED_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(neddata))
+        httpretty.register_uri(
+            httpretty.GET, SOLRQUERY_URL,
+            content_type='application/json',
+            status=200,
+            body='%s'%json.dumps(solrdata))
+        r = self.client.post(
+            url_for('classicobjectsearch'),
+            content_type='application/json',
+            headers={'Authorization': 'Bearer foo'},
+            data=json.dumps({'objects': ["NGC 224"], 'async': True}))
+        self.assertEqual(r.status_code, 202)
+        job_id = r.json['job']
+        r = self.client.get(url_for('classicobjectsearchjob', job_id=job_id, wait=5))
+        self.assertEqual(r.status_code, 200)
+        expected = {u'ambiguous': [], u'data': [u'2016ApJ...817..111D', u'2016A&A...587A..52M']}
+        self.assertEqual(r.json, expected)
+        # The Solr request was sent on behalf of the user who submitted the job
+        self.assertEqual(httpretty.last_request().headers['X-Forwarded-Authorization'], 'Bearer foo')
+        r = self.client.get(url_for('classicobjectsearchjob', job_id=job_id, output_format='text'))
+        self.assertEqual(r.data.decode('ascii'), '2016ApJ...817..111D\n2016A&A...587A..52M')
+
+    def test_classic_query_search_job_limits(self):
+        '''test that clients cannot queue more jobs than they are allowed to'''
+        from object_service.jobs import get_job_limits
+        limits = get_job_limits()
+        for i in range(limits.client_limit):
+            self.assertTrue(limits.acquire('Bearer foo'))
+        try:
+            r = self.client.post(
+                url_for('classicobjectsearch'),
+                content_type='application/json',
+                headers={'Authorization': 'Bearer foo'},
+                data=json.dumps({'objects': ["NGC 224"], 'async': True}))
+            self.assertEqual(r.status_code, 429)
+            self.assertEqual(r.headers['Retry-After'], str(self.app.config.get('OBJECTS_JOB_RETRY_AFTER')))
+            self.assertEqual(r.json['Error Info'], 'Too many jobs queued or running, please try again later')
+        finally:
+            for i in range(limits.client_limit):
+                limits.release('Bearer foo')
+        self.assertEqual(limits.total, 0)
+
+    def test_classic_query_search_job_pending(self):
+        '''test polling for a job that is not finished, or unknown'''
+        from object_service.jobs import get_job_store
+        get_job_store().save({'id': 'foo', 'status': 'running', 'created': time.time()})
+        r = self.client.get(url_for('classicobjectsearchjob', job_id='foo'))
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(r.json, {'job': 'foo', 'status': 'running'})
+        r = self.client.get(url_for('classicobjectsearchjob', job_id='bar'))
+        self.assertEqual(r.status_code, 404)
+        # Polls do not wait for longer than allowed, whatever the client asks for
+        self.app.config['OBJECTS_JOB_MAX_WAIT'] = 0.2
+        for wait in ['nan', 'inf', '-inf', '-1', '1e9', 'foo']:
+            stime = time.time()
+            r = self.client.get(url_for('classicobjectsearchjob', job_id='foo', wait=wait))
+            self.assertEqual(r.status_code, 202)
+            self.assertTrue(time.time() - stime < 1)
+
+    def test_file_job_store(self):
+        '''test the job store shared by the workers on a host'''
+        import tempfile
+        import shutil
+        from object_service.jobs import FileJobStore
+        tmpdir = tempfile.mkdtemp()
+        try:
+            store = FileJobStore(os.path.join(tmpdir, 'jobs'), ttl=3600)
+            store.save({'id': 'foo', 'status': 'queued', 'created': time.time()})
+            store.save({'id': 'foo', 'status': 'done', 'created': time.time(), 'result': {'data': []}})
+            other = FileJobStore(os.path.join(tmpdir, 'jobs'))
+            self.assertEqual(other.get('foo')['result'], {'data': []})
+            self.assertEqual(other.get('bar'), None)
+            store.ttl = -1
+            store.prune()
+            self.assertEqual(other.get('foo'), None)
+        finally:
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     unittest.main()
@@ -595,6 +595,107 @@ class TestDataRetrieval(TestCase):
         expected = self.app.config.get('OBJECTS_SIMBAD_TAP_URL_CDS')
         self.assertEqual(v, expected)
 
+    def test_adql_chunks(self):
+        '''Test to see if ADQL value lists are escaped and split as expected'''
+        from object_service.SIMBAD import adql_chunks
+        self.assertEqual(adql_chunks(["Barnard's Star", 'M31']), [["'Barnard''s Star'", "'M31'"]])
+        self.assertEqual(adql_chunks(['1575544', 3133169], numeric=True), [['1575544', '3133169']])
+        chunks = adql_chunks(['NGC %s' % i for i in range(1000)], max_count=300)
+        self.assertEqual([len(c) for c in chunks], [300, 300, 300, 100])
+        chunks = adql_chunks(['NGC %s' % i for i in range(1000)], max_bytes=1000)
+        self.assertTrue(all(sum(len(v) + 1 for v in c) <= 1000 for c in chunks))
+        self.assertEqual(sum(len(c) for c in chunks), 1000)
+
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_get_simbad_objects_chunked(self, mocked_post):
+        '''Test to see if long lists of object names are sent in chunks'''
+        from object_service.SIMBAD import get_simbad_data
+        import re
+        self.app.config['OBJECTS_SIMBAD_CHUNK_SIZE'] = 10
+        queries = []
+        def post(url, data=None, headers=None, timeout=None):
+            queries.append(data['query'])
+            names = re.findall(r"'([^']*)'", data['query'].split(' IN ')[1])
+            response = mock.Mock()
+            response.status_code = 200
+            response.json.return_value = {'data': [[int(n.split()[1]), n, n] for n in names]}
+            return response
+        mocked_post.side_effect = post
+        objects = ['NGC %s' % i for i in range(25)]
+        result = get_simbad_data(objects, 'objects')
+        self.assertEqual(len(queries), 3)
+        self.assertTrue(all(q.endswith(');') for q in queries))
+        self.assertEqual(result['data']['NGC 24'], {'id': '24', 'canonical': 'NGC 24'})
+        self.assertEqual(len([k for k in result['data'] if ' ' in k]), 25)
+
+    @httpretty.activate
+    def test_get_simbad_objects_csv(self):
+        '''Test to see if SIMBAD results in CSV format are decoded as expected'''
+        from object_service.SIMBAD import get_simbad_data
+        self.app.config['OBJECTS_SIMBAD_FORMAT'] = 'csv'
+        mockdata = 'oidref,id,main_id\n1575544,NAME ANDROMEDA,M  31\n1575544,"NAME Andromeda, ""Great"" Nebula",M  31\n'
+        QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        httpretty.register_uri(
+            httpretty.POST, QUERY_URL,
+            content_type='text/csv',
+            status=200,
+            body=mockdata)
+        result = get_simbad_data(['Andromeda'], 'objects')
+        self.assertEqual(httpretty.last_request().parsed_body['format'], ['csv'])
+        expected = {'id': '1575544', 'canonical': 'M  31'}
+        self.assertEqual(result['data']['ANDROMEDA'], expected)
+        self.assertEqual(result['data']['ANDROMEDA, "GREAT" NEBULA'], expected)
+
+    @httpretty.activate
+    def test_get_simbad_objects_csv_error(self):
+        '''Test to see if a SIMBAD response that is not CSV is reported'''
+        from object_service.SIMBAD import get_simbad_data
+        self.app.config['OBJECTS_SIMBAD_FORMAT'] = 'csv'
+        QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        httpretty.register_uri(
+            httpretty.POST, QUERY_URL,
+            content_type='application/x-votable+xml',
+            status=200,
+            body='<VOTABLE><RESOURCE type="results"><INFO name="QUERY_STATUS" value="ERROR"/></RESOURCE></VOTABLE>')
+        result = get_simbad_data(['Andromeda'], 'objects')
+        expected = {"Error": "Unable to get results!", "Error Info": "SIMBAD did not return CSV data"}
+        self.assertEqual(result, expected)
+
+    def test_read_ned_object_names(self):
+        '''Test to see if object names are read from NED objsearch results as expected'''
+        from object_service.NED import read_ned_object_names
+        lines = ['Some preamble',
+                 'No.|Object Name|RA(deg)|DEC(deg)|Type',
+                 '1|MESSIER 031|10.68479|41.26906|G',
+                 '2|Andromeda I|11.41542|38.04180|G',
+                 '3|NGC 0205|10.09189|41.68541|G']
+        self.assertEqual(read_ned_object_names(lines, 50), ['MESSIER_031', 'Andromeda_I', 'NGC_0205'])
+        self.assertEqual(read_ned_object_names(lines, 2), ['MESSIER_031', 'Andromeda_I'])
+        lines = ['Object Name|No.', 'MESSIER 031|1']
+        self.assertEqual(read_ned_object_names(lines, 50), ['MESSIER_031'])
+
+    @mock.patch('object_service.NED.current_app.client.get')
+    def test_ned_position_query_stops_reading(self, mocked_get):
+        '''Test to see if NED cone search results are only read as far as needed'''
+        from object_service.utils import parse_position_string
+        from object_service.NED import ned_position_query
+        self.app.config['OBJECTS_NED_MAX_NUMBER'] = 3
+        read = []
+        def lines():
+            yield 'No.|Object Name|RA(deg)|DEC(deg)|Type'
+            for i in range(1000):
+                read.append(i)
+                yield '%s|NGC %s|10.0|41.0|G' % (i, i)
+        response = mock.Mock()
+        response.status_code = 200
+        response.iter_lines.return_value = lines()
+        mocked_get.return_value = response
+        coords, radius = parse_position_string("80.89416667 -69.75611111:0.166666")
+        self.assertEqual(ned_position_query(coords, radius), ['NGC_0', 'NGC_1', 'NGC_2'])
+        self.assertEqual(read, [0, 1, 2])
+        self.assertTrue(response.close.called)
+        self.assertTrue(mocked_get.call_args[1]['stream'])
+
 @timeout_decorator.timeout(2)
 def timeout(s):
     time.sleep(s)
@@ -622,5 +723,86 @@ class TestTimeOut(TestCase):
             res = 'timeout'
         self.assertEqual(res, 'timeout')
 
+class TestHedgedQueries(TestCase):
+
+    '''Check if hedging of SIMBAD TAP queries works as expected'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        _app = app.create_app()
+        _app.config['OBJECTS_SIMBAD_HEDGE'] = True
+        _app.config['OBJECTS_SIMBAD_HEDGE_DELAY'] = 0.1
+        return _app
+
+    def mock_post(self, delays):
+        '''Fake TAP services that answer after a delay that depends on the URL'''
+        def post(url, **kwargs):
+            time.sleep(delays[url])
+            response = mock.Mock()
+            response.status_code = 200
+            response.json.return_value = {"data":[[url]]}
+            return response
+        return post
+
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_fast_primary(self, mocked_post):
+        '''No hedging when the primary service answers in time'''
+        from object_service.SIMBAD import do_tap_query
+        primary = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        secondary = self.app.config.get('OBJECTS_SIMBAD_TAP_URL_CDS')
+        mocked_post.side_effect = self.mock_post({primary: 0, secondary: 0})
+        result = do_tap_query('SELECT * FROM basic;', 'Object Search', 0)
+        self.assertEqual(result, {"data":[[primary]]})
+        self.assertEqual(mocked_post.call_count, 1)
+
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_slow_primary(self, mocked_post):
+        '''The mirror answers first when the primary service is slow'''
+        from object_service.SIMBAD import do_tap_query
+        primary = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        secondary = self.app.config.get('OBJECTS_SIMBAD_TAP_URL_CDS')
+        mocked_post.side_effect = self.mock_post({primary: 1, secondary: 0})
+        stime = time.time()
+        result = do_tap_query('SELECT * FROM basic;', 'Object Search', 0)
+        self.assertEqual(result, {"data":[[secondary]]})
+        self.assertTrue(time.time() - stime < 0.5)
+        self.assertEqual(mocked_post.call_count, 2)
+
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_hedge_budget(self, mocked_post):
+        '''No hedging once the hedge budget is used up'''
+        from object_service.SIMBAD import do_tap_query
+        primary = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        secondary = self.app.config.get('OBJECTS_SIMBAD_TAP_URL_CDS')
+        self.app.config['OBJECTS_SIMBAD_HEDGE_BUDGET'] = 0.01
+        mocked_post.side_effect = self.mock_post({primary: 0.2, secondary: 0})
+        result = do_tap_query('SELECT * FROM basic;', 'Object Search', 0)
+        self.assertEqual(result, {"data":[[secondary]]})
+        result = do_tap_query('SELECT * FROM basic;', 'Object Search', 0)
+        self.assertEqual(result, {"data":[[primary]]})
+        self.assertEqual(mocked_post.call_count, 3)
+
+    def test_latency_percentile(self):
+        '''Check the percentile of recorded response times'''
+        from object_service.SIMBAD import TapLatencies
+        latencies = TapLatencies()
+        self.assertEqual(latencies.percentile('foo', 95), None)
+        for i in range(100):
+            latencies.add('foo', i / 100.0)
+        self.assertEqual(latencies.percentile('foo', 95), 0.95)
+        self.assertEqual(latencies.percentile('foo', 50), 0.5)
+
+    def test_hedge_executor_per_app(self):
+        '''Thread pools belong to the application and are sized from its config'''
+        from object_service.SIMBAD import get_hedge_executor
+        self.app.config['OBJECTS_SIMBAD_HEDGE_WORKERS'] = 3
+        executor = get_hedge_executor()
+        self.assertEqual(executor._max_workers, 3)
+        self.assertIs(get_hedge_executor(), executor)
+        other = app.create_app()
+        other.config['OBJECTS_SIMBAD_HEDGE_WORKERS'] = 5
+        with other.app_context():
+            self.assertEqual(get_hedge_executor()._max_workers, 5)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,65 @@
+import sys
+import os
+from flask_testing import TestCase
+from flask import url_for
+import unittest
+import time
+import threading
+from object_service import app
+import json
+
+class TestAdmissionControl(TestCase):
+
+    '''Check if concurrent requests are admitted as expected'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def test_client_limit(self):
+        '''A client cannot have more than its share of requests going'''
+        from object_service.admission import AdmissionControl
+        admission = AdmissionControl(client_limit=2, total_limit=10, max_wait=0)
+        self.assertTrue(admission.acquire('foo'))
+        self.assertTrue(admission.acquire('foo'))
+        self.assertFalse(admission.acquire('foo'))
+        self.assertTrue(admission.acquire('bar'))
+        admission.release('foo')
+        self.assertTrue(admission.acquire('foo'))
+
+    def test_total_limit(self):
+        '''Over the total limit requests wait in a queue of limited size'''
+        from object_service.admission import AdmissionControl
+        admission = AdmissionControl(client_limit=10, total_limit=1, queue_size=1, max_wait=1)
+        self.assertTrue(admission.acquire('foo'))
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(admission.acquire('bar')))
+        waiter.start()
+        time.sleep(0.1)
+        # The queue is full
+        stime = time.time()
+        self.assertFalse(admission.acquire('baz'))
+        self.assertTrue(time.time() - stime < 0.1)
+        admission.release('foo')
+        waiter.join()
+        self.assertEqual(results, [True])
+        # Nobody lets go: the wait is over after max_wait
+        stime = time.time()
+        self.assertFalse(admission.acquire('foo'))
+        self.assertTrue(time.time() - stime >= 1)
+
+    def test_too_many_requests(self):
+        '''A request over capacity gets a 429'''
+        self.app.config['OBJECTS_CLIENT_CONCURRENCY'] = 0
+        r = self.client.post(
+            url_for('querysearch'),
+            content_type='application/json',
+            headers={'Authorization': 'Bearer foo'},
+            data=json.dumps({'query': 'object:Andromeda'}))
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(r.headers['Retry-After'], '1')
+        self.assertEqual(r.json['Error Info'], 'Too many concurrent requests, please try again later')
+
+if __name__ == '__main__':
+    unittest.main()
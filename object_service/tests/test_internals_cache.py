@@ -0,0 +1,345 @@
+import sys
+import os
+from flask_testing import TestCase
+import unittest
+import time
+from object_service import app
+import json
+import httpretty
+import mock
+import tempfile
+import shutil
+import threading
+
+class FakeRedis(object):
+    '''In-memory stand-in for a Redis client'''
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def get(self, key):
+        if self.down:
+            raise Exception('Connection refused')
+        value, expires = self.data.get(key, (None, 0))
+        if expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        if self.down:
+            raise Exception('Connection refused')
+        self.data[key] = (value, time.time() + ex)
+
+    def pttl(self, key):
+        if self.down:
+            raise Exception('Connection refused')
+        value, expires = self.data.get(key, (None, 0))
+        if expires < time.time():
+            return -2
+        return int((expires - time.time()) * 1000)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+class FakePipeline(object):
+    '''Pipeline of a FakeRedis client: the commands are run by execute()'''
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append((self.client.get, key))
+
+    def pttl(self, key):
+        self.commands.append((self.client.pttl, key))
+
+    def execute(self):
+        return [command(key) for command, key in self.commands]
+
+class TestCache(TestCase):
+
+    '''Check if the object cache behaves as expected'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def test_lru_cache(self):
+        '''Least recently used and expired entries are dropped'''
+        from object_service.cache import LRUCache
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1, 10)
+        cache.set('b', 2, 10)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3, 10)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        cache.set('d', 4, -1)
+        self.assertEqual(cache.get('d'), None)
+
+    def test_shared_cache(self):
+        '''Entries are shared between workers through the shared tier'''
+        from object_service.cache import ObjectCache, LRUCache, SharedCache
+        client = FakeRedis()
+        worker1 = ObjectCache(LRUCache(), SharedCache(client))
+        worker2 = ObjectCache(LRUCache(), SharedCache(client))
+        worker1.set('simbad', 'M31', '1575544')
+        self.assertEqual(client.get('objects:simbad:M31'), '"1575544"')
+        self.assertEqual(worker2.get('simbad', 'M31'), '1575544')
+        self.assertEqual(worker2.get('ned', 'M31'), None)
+
+    def test_shared_cache_ttl(self):
+        '''Entries from the shared tier are kept locally for as long as they live there'''
+        from object_service.cache import ObjectCache, LRUCache, SharedCache
+        client = FakeRedis()
+        worker1 = ObjectCache(LRUCache(), SharedCache(client), ttl=3600)
+        worker2 = ObjectCache(LRUCache(), SharedCache(client), ttl=3600)
+        worker1.set('solr_simbid', '1575544', True, ttl=60)
+        self.assertEqual(worker2.get('solr_simbid', '1575544'), True)
+        expires = worker2.local.data['objects:solr_simbid:1575544'][1]
+        self.assertTrue(time.time() + 55 < expires <= time.time() + 60)
+        # The entry expires in the shared tier: it is not used here any longer either
+        client.data['objects:solr_simbid:1575544'] = (client.data['objects:solr_simbid:1575544'][0], time.time() + 0.1)
+        worker3 = ObjectCache(LRUCache(), SharedCache(client), ttl=3600)
+        self.assertEqual(worker3.get('solr_simbid', '1575544'), True)
+        time.sleep(0.15)
+        self.assertEqual(worker3.get('solr_simbid', '1575544'), None)
+
+    def test_shared_cache_down(self):
+        '''When the shared tier is unreachable, the local tier keeps working'''
+        from object_service.cache import ObjectCache, LRUCache, SharedCache
+        client = FakeRedis()
+        client.down = True
+        cache = ObjectCache(LRUCache(), SharedCache(client, retry_interval=60))
+        cache.set('simbad', 'M31', '1575544')
+        self.assertEqual(cache.get('simbad', 'M31'), '1575544')
+        self.assertEqual(cache.get('simbad', 'LMC'), None)
+        # The shared tier is left alone for a while
+        client.down = False
+        self.assertEqual(cache.get('simbad', 'LMC'), None)
+        self.assertEqual(client.data, {})
+
+    @httpretty.activate
+    def test_cached_translations(self):
+        '''Name translations are only looked up once'''
+        from object_service.utils import get_object_translations
+        self.app.config['OBJECTS_CACHE_CLIENT'] = FakeRedis()
+        mockdata = {"data":[[1575544, "NAME ANDROMEDA","NAME ANDROMEDA"]]}
+        QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        queries = []
+        def request_callback(request, uri, headers):
+            queries.append(request.body)
+            return (200, headers, '%s'%json.dumps(mockdata))
+        httpretty.register_uri(
+            httpretty.POST, QUERY_URL,
+            content_type='application/json',
+            body=request_callback)
+        expected = {'simbad': {'Andromeda': '1575544'}}
+        self.assertEqual(get_object_translations(['Andromeda'], ['simbad']), expected)
+        self.assertEqual(get_object_translations(['Andromeda'], ['simbad']), expected)
+        self.assertEqual(len(queries), 1)
+        entry = json.loads(self.app.config['OBJECTS_CACHE_CLIENT'].get('objects:simbad:ANDROMEDA'))
+        self.assertEqual(entry['value'], '1575544')
+
+    def test_stale_while_revalidate(self):
+        '''Timed-out translations are used right away and refreshed in the background'''
+        from object_service.utils import get_object_translation
+        from object_service.cache import get_cache
+        import object_service.cache
+        cache = get_cache()
+        cache.max_stale = 100
+        cache.set_entry('simbad', 'M31', '1575544', ttl=-1)
+        self.assertEqual(cache.get_entry('simbad', 'M31'), ('1575544', 'stale'))
+        lookups = []
+        def get_object_data(identifiers, service):
+            lookups.append(identifiers)
+            time.sleep(0.1)
+            return {'data': {'M31': {'id': '42', 'canonical': 'M  31'}}}
+        with mock.patch('object_service.utils.get_object_data', side_effect=get_object_data):
+            stime = time.time()
+            self.assertEqual(get_object_translation('M31', 'simbad'), '1575544')
+            # A refresh is already under way
+            self.assertEqual(get_object_translation('M31', 'simbad'), '1575544')
+            self.assertTrue(time.time() - stime < 0.1)
+            while object_service.cache.refreshing:
+                time.sleep(0.01)
+            self.assertEqual(lookups, [['M31']])
+            self.assertEqual(cache.get_entry('simbad', 'M31'), ('42', 'fresh'))
+            # Beyond the maximum staleness, the lookup is done right away
+            cache.max_stale = 0
+            cache.set_entry('simbad', 'LMC', '3133169', ttl=-1)
+            self.assertEqual(get_object_translation('LMC', 'simbad'), '42')
+            self.assertEqual(lookups, [['M31'], ['LMC']])
+
+    def test_snapshot(self):
+        '''Entries written to a snapshot are found by binary search'''
+        from object_service.cache import Snapshot, write_snapshot
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'cache')
+            snapshot = Snapshot(path)
+            self.assertEqual(snapshot.get('objects:simbad:M31'), None)
+            expires = time.time() + 100
+            entries = [('objects:simbad:M%s' % i, expires, str(i)) for i in range(1000)]
+            self.assertEqual(write_snapshot(path, entries + [('bad\tkey', expires, '1')]), 1000)
+            self.assertTrue(snapshot.load())
+            self.assertFalse(snapshot.load())
+            for i in range(1000):
+                self.assertEqual(snapshot.get('objects:simbad:M%s' % i), (str(i), round(expires)))
+            self.assertEqual(snapshot.get('objects:simbad:M1000'), None)
+            self.assertEqual(snapshot.get('objects:ned:M31'), None)
+            self.assertEqual(len(snapshot.items()), 1000)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_snapshot_warm_start(self):
+        '''A new worker starts with the entries saved by a previous one'''
+        from object_service.cache import ObjectCache, LRUCache, Snapshot
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'cache')
+            worker1 = ObjectCache(LRUCache(), snapshot=Snapshot(path))
+            worker1.set('simbad', 'M31', '1575544')
+            worker1.set('ned', 'M31', 'MESSIER_031')
+            worker1.set('ned_cone', '10.68 41.26:0.1', ['MESSIER_031'])
+            worker1.set('simbad', 'FooBar', '0', ttl=-1)
+            self.assertEqual(worker1.save_snapshot(['simbad', 'ned']), 2)
+            worker2 = ObjectCache(LRUCache(), snapshot=Snapshot(path))
+            self.assertEqual(worker2.get('simbad', 'M31'), '1575544')
+            self.assertEqual(worker2.get('ned', 'M31'), 'MESSIER_031')
+            self.assertEqual(worker2.get('ned_cone', '10.68 41.26:0.1'), None)
+            self.assertEqual(worker2.get('simbad', 'FooBar'), None)
+            # Saving again keeps the entries of the previous snapshot
+            worker2.set('simbad', 'LMC', '3133169')
+            self.assertEqual(worker2.save_snapshot(['simbad', 'ned']), 3)
+            self.assertEqual(worker1.get('simbad', 'LMC'), None)
+            worker1.snapshot.load()
+            self.assertEqual(worker1.get('simbad', 'LMC'), '3133169')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_snapshot_merge(self):
+        '''Saving a snapshot merges the new entries into it, and drops the expired ones'''
+        from object_service.cache import ObjectCache, LRUCache, Snapshot, write_snapshot
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'cache')
+            now = time.time()
+            write_snapshot(path, [('objects:simbad:A', now + 100, '1'),
+                                  ('objects:simbad:B', now - 100, '2'),
+                                  ('objects:simbad:D', now + 100, '4')])
+            worker = ObjectCache(LRUCache(), snapshot=Snapshot(path))
+            worker.set('simbad', 'C', '3')
+            worker.set('simbad', 'D', '5')
+            self.assertEqual(worker.save_snapshot(['simbad']), 3)
+            self.assertEqual(sorted((k, v) for k, e, v in worker.snapshot.items()),
+                             [('objects:simbad:A', '1'), ('objects:simbad:C', '3'), ('objects:simbad:D', '5')])
+            # Nothing changed: the snapshot is left alone
+            version = worker.snapshot.version
+            self.assertEqual(worker.save_snapshot(['simbad']), 3)
+            self.assertFalse(worker.snapshot.load())
+            self.assertEqual(worker.snapshot.version, version)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_snapshot_concurrent_writers(self):
+        '''Workers saving the snapshot at the same time keep each other's entries'''
+        from object_service.cache import ObjectCache, LRUCache, Snapshot, snapshot_lock, write_snapshot
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'cache')
+            workers = [ObjectCache(LRUCache(), snapshot=Snapshot(path)) for i in range(2)]
+            for n, worker in enumerate(workers):
+                for i in range(500):
+                    worker.set('simbad', 'W%sM%s' % (n, i), str(i))
+            # A worker that wants to write while another one is writing waits for it,
+            # and then writes on top of what the other one wrote
+            with snapshot_lock(path):
+                writer = threading.Thread(target=workers[1].save_snapshot, args=(['simbad'],))
+                writer.start()
+                writer.join(0.2)
+                self.assertTrue(writer.is_alive())
+                write_snapshot(path, workers[0].local.items())
+            writer.join()
+            snapshot = Snapshot(path)
+            self.assertEqual(len(snapshot.items()), 1000)
+            # Both at the same time, a few times
+            errors = []
+            def save(worker):
+                try:
+                    for i in range(5):
+                        worker.save_snapshot(['simbad'])
+                except Exception as err:
+                    errors.append(err)
+            threads = [threading.Thread(target=save, args=(worker,)) for worker in workers]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+            snapshot = Snapshot(path)
+            self.assertEqual(len(snapshot.items()), 1000)
+            self.assertEqual(snapshot.get('objects:simbad:W0M7')[0], '7')
+            self.assertEqual(snapshot.get('objects:simbad:W1M499')[0], '499')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_degraded_translations(self):
+        '''Expired translations are used when the upstream service fails'''
+        from flask import g
+        from object_service.utils import get_object_translation
+        from object_service.cache import get_cache, is_degraded
+        cache = get_cache()
+        cache.max_stale = 0
+        cache.keep_expired = 3600
+        cache.set_entry('ned', 'M31', 'MESSIER_031', ttl=-1)
+        self.assertEqual(cache.get_entry('ned', 'M31'), ('MESSIER_031', 'expired'))
+        error = {"Error": "Unable to get results!", "Error Info": "NED service unavailable (circuit open)"}
+        with mock.patch('object_service.utils.get_object_data', return_value=error):
+            self.assertFalse(is_degraded())
+            self.assertEqual(get_object_translation('M31', 'ned'), 'MESSIER_031')
+            self.assertTrue(is_degraded())
+            g.degraded = False
+            self.assertEqual(get_object_translation('LMC', 'ned'), error)
+            self.assertFalse(is_degraded())
+        # Without degraded mode, expired translations are not kept
+        cache.keep_expired = 0
+        cache.set_entry('ned', 'M31', 'MESSIER_031', ttl=-1)
+        self.assertEqual(cache.get_entry('ned', 'M31'), (None, None))
+
+    def test_translations_normalized(self):
+        '''Known translations are shared by all spellings of a name, unknown ones are not'''
+        from object_service.utils import get_object_translation
+        lookups = []
+        def get_object_data(identifiers, service):
+            lookups.append(identifiers[0])
+            if identifiers[0] == 'm31':
+                return {'data': {'m31': None}}
+            return {'data': {'M31': {'id': '1575544', 'canonical': 'M  31'}}}
+        with mock.patch('object_service.utils.get_object_data', side_effect=get_object_data):
+            self.assertEqual(get_object_translation('m31', 'simbad'), '0')
+            self.assertEqual(get_object_translation('M 31', 'simbad'), '1575544')
+            self.assertEqual(get_object_translation('M_31', 'simbad'), '1575544')
+            self.assertEqual(get_object_translation('m31', 'simbad'), '1575544')
+        self.assertEqual(lookups, ['m31', 'M 31'])
+
+    def test_translations_deduplicated(self):
+        '''Every distinct name in a request is looked up once'''
+        from object_service.utils import get_object_translations
+        lookups = []
+        def get_object_data(identifiers, service):
+            lookups.append((service, identifiers[0]))
+            if identifiers[0] in ['m31', 'FooBar']:
+                return {'data': {identifiers[0]: None}}
+            return {'data': {'M31': {'id': '1575544', 'canonical': 'M  31'}}}
+        onames = ['m31', 'M31', 'M 31', 'm31', 'FooBar', 'FooBar']
+        with mock.patch('object_service.utils.get_object_data', side_effect=get_object_data):
+            result = get_object_translations(onames, ['simbad'])
+        self.assertEqual(result, {'simbad': {'m31': '1575544', 'M31': '1575544', 'M 31': '1575544', 'FooBar': '0'}})
+        # 'm31' is not known, so the next spelling is tried
+        self.assertEqual(lookups, [('simbad', 'm31'), ('simbad', 'M31'), ('simbad', 'FooBar')])
+
+if __name__ == '__main__':
+    unittest.main()
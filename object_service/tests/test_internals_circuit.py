@@ -0,0 +1,130 @@
+import sys
+import os
+from flask_testing import TestCase
+import unittest
+import time
+from object_service import app
+import json
+import httpretty
+import mock
+from requests.exceptions import ReadTimeout
+
+class TestCircuitBreaker(TestCase):
+
+    '''Check if the circuit breakers for upstream services behave as expected'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def test_breaker_opens_on_errors(self):
+        '''The circuit opens when the error rate gets too high'''
+        from object_service.circuit import CircuitBreaker
+        breaker = CircuitBreaker('test', min_requests=4, error_rate=0.5, timeout_rate=1.0, cooldown=60)
+        breaker.record_success()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+    def test_breaker_opens_on_timeouts(self):
+        '''The circuit opens when the timeout rate gets too high'''
+        from object_service.circuit import CircuitBreaker
+        breaker = CircuitBreaker('test', min_requests=4, error_rate=0.9, timeout_rate=0.25, cooldown=60)
+        for i in range(3):
+            breaker.record_success()
+        breaker.record_failure(timeout=True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_breaker_half_open(self):
+        '''After the cool-down, one probe is let through'''
+        from object_service.circuit import CircuitBreaker
+        breaker = CircuitBreaker('test', min_requests=1, cooldown=0.1)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow_request())
+        time.sleep(0.15)
+        # One probe request is allowed, others still fail fast
+        self.assertTrue(breaker.allow_request())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow_request())
+        # A failing probe re-opens the circuit
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow_request())
+        # A successful probe closes it
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow_request())
+
+    def test_breaker_window(self):
+        '''Only outcomes within the rolling window count'''
+        from object_service.circuit import CircuitBreaker
+        breaker = CircuitBreaker('test', window=0.1, min_requests=2, error_rate=0.5)
+        breaker.record_failure()
+        time.sleep(0.15)
+        breaker.record_success()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @mock.patch('object_service.NED.current_app.client.post')
+    def test_ned_fails_fast(self, mocked_post):
+        '''When NED keeps timing out, requests are no longer sent'''
+        from object_service.NED import do_ned_object_lookup
+        mocked_post.side_effect = ReadTimeout('Connection timed out.')
+        self.app.config['OBJECTS_CIRCUIT_MIN_REQUESTS'] = 3
+        QUERY_URL = self.app.config.get('OBJECTS_NED_URL')
+        for i in range(3):
+            result = do_ned_object_lookup(QUERY_URL, "M31")
+            self.assertTrue('timed out' in result['Error Info'])
+        result = do_ned_object_lookup(QUERY_URL, "M31")
+        self.assertEqual(result, {"Error": "Unable to get results!", "Error Info": "NED service unavailable (circuit open)"})
+        self.assertEqual(mocked_post.call_count, 3)
+
+    @mock.patch('object_service.NED.wait_for_rate_limit')
+    @mock.patch('object_service.NED.current_app.client.post')
+    def test_probe_refused_by_rate_limit(self, mocked_post, mocked_wait):
+        '''A probe that the rate limit does not let through does not block later probes'''
+        from object_service.NED import send_ned_object_lookup
+        from object_service.circuit import get_breaker, CircuitBreaker
+        QUERY_URL = self.app.config.get('OBJECTS_NED_URL')
+        breaker = get_breaker(QUERY_URL)
+        breaker._open(time.time() - breaker.cooldown)
+        mocked_wait.return_value = None
+        result = send_ned_object_lookup(QUERY_URL, "M31")
+        self.assertEqual(result['Error Info'], "NED request not sent: rate limit exceeded")
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.probing)
+        self.assertEqual(mocked_post.call_count, 0)
+        # The next request gets to probe NED, and closes the circuit
+        mocked_wait.return_value = 0
+        mocked_post.return_value = mock.Mock(status_code=200, json=lambda: {'ResultCode': 0, 'StatusCode': 100})
+        send_ned_object_lookup(QUERY_URL, "M31")
+        self.assertEqual(mocked_post.call_count, 1)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @httpretty.activate
+    def test_tap_verification_circuit_open(self):
+        '''When the CfA TAP service circuit is open, we switch to CDS without probing'''
+        from object_service.SIMBAD import verify_tap_service
+        from object_service.circuit import get_breaker
+        QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        queries = []
+        def request_callback(request, uri, headers):
+            queries.append(request.body)
+            return (200, headers, '%s'%json.dumps({"data":[[1]]}))
+        httpretty.register_uri(
+            httpretty.POST, QUERY_URL,
+            content_type='application/json',
+            body=request_callback)
+        breaker = get_breaker(QUERY_URL)
+        breaker._open(time.time())
+        self.assertEqual(verify_tap_service(), self.app.config.get('OBJECTS_SIMBAD_TAP_URL_CDS'))
+        self.assertEqual(queries, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import sys
+import os
+from flask_testing import TestCase
+from flask import g
+import unittest
+import time
+from object_service import app
+import json
+import httpretty
+import mock
+
+class TestRequestDeadline(TestCase):
+
+    '''Check if the request deadline is applied to upstream calls'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def test_no_deadline(self):
+        '''Without a deadline, time-outs are used as is'''
+        from object_service.deadline import remaining_time, deadline_exceeded
+        self.assertEqual(remaining_time(5), 5)
+        self.assertEqual(remaining_time(), None)
+        self.assertFalse(deadline_exceeded())
+
+    def test_deadline_from_config(self):
+        '''The deadline is taken from the config'''
+        from object_service.deadline import set_request_deadline, remaining_time
+        self.app.config['OBJECTS_REQUEST_DEADLINE'] = 2
+        set_request_deadline()
+        self.assertTrue(1 < remaining_time() <= 2)
+        self.assertTrue(1 < remaining_time(10) <= 2)
+        self.assertEqual(remaining_time(0.5), 0.5)
+
+    def test_deadline_from_header(self):
+        '''Callers can ask for a shorter deadline, but not for a longer one'''
+        from object_service.deadline import set_request_deadline, remaining_time
+        self.app.config['OBJECTS_REQUEST_DEADLINE'] = 2
+        header = self.app.config.get('OBJECTS_DEADLINE_HEADER')
+        with self.app.test_request_context(headers={header: '0.5'}):
+            set_request_deadline()
+            self.assertTrue(0 < remaining_time() <= 0.5)
+        with self.app.test_request_context(headers={header: '100'}):
+            set_request_deadline()
+            self.assertTrue(1 < remaining_time() <= 2)
+        with self.app.test_request_context(headers={header: 'foo'}):
+            set_request_deadline()
+            self.assertTrue(1 < remaining_time() <= 2)
+
+    def test_deadline_exceeded(self):
+        '''No upstream calls are made after the deadline'''
+        from object_service.deadline import deadline_exceeded
+        from object_service.SIMBAD import do_tap_query
+        g.deadline = time.time() - 1
+        self.assertTrue(deadline_exceeded())
+        result = do_tap_query('SELECT TOP 1 * FROM basic;', 'Object Search', 0)
+        self.assertEqual(result['Error Info'], 'SIMBAD request not sent: request deadline exceeded')
+
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_deadline_keeps_tap_service(self, mocked_post):
+        '''A request without time left does not switch the worker to the other TAP service'''
+        from flask import url_for
+        tap_url = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        header = self.app.config.get('OBJECTS_DEADLINE_HEADER')
+        r = self.client.get(url_for('querysearch', query='object:Andromeda'), headers={header: '0'})
+        self.assertEqual(r.status_code, 200)
+        r = self.client.post(url_for('objectsearch'), headers={header: '0'},
+                             content_type='application/json', data=json.dumps({'objects': ['M31']}))
+        self.assertEqual(self.app.config.get('OBJECTS_SIMBAD_TAP_URL'), tap_url)
+        self.assertEqual(mocked_post.call_count, 0)
+
+    @mock.patch('object_service.NED.current_app.client.post')
+    def test_ned_partial_results(self, mocked_post):
+        '''Results found before the deadline are returned'''
+        from object_service.NED import get_ned_data
+        def post(url, **kwargs):
+            time.sleep(0.2)
+            response = mock.Mock()
+            response.status_code = 200
+            response.json.return_value = {'Preferred': {'Name': 'FOO BAR'}, 'ResultCode': 3, 'StatusCode': 100}
+            return response
+        mocked_post.side_effect = post
+        g.deadline = time.time() + 0.3
+        result = get_ned_data(['a', 'b', 'c'], 'identifiers')
+        self.assertEqual(result['data'], {'a': {'id': 'a', 'canonical': 'FOO BAR'}, 'b': {'id': 'b', 'canonical': 'FOO BAR'}})
+        self.assertEqual(result['skipped'], ['c'])
+        # The second request only got the time left before the deadline
+        self.assertTrue(mocked_post.call_args_list[1][1]['timeout'] < 0.2)
+
+if __name__ == '__main__':
+    unittest.main()
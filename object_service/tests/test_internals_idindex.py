@@ -0,0 +1,90 @@
+import sys
+import os
+from flask_testing import TestCase
+import unittest
+import io
+import json
+import tempfile
+import shutil
+from object_service import app
+import mock
+
+class TestIdentifierIndex(TestCase):
+
+    '''Check the local index of identifiers in Solr'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'identifiers.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index_lookup(self):
+        '''Identifiers are found by binary search in the index file'''
+        from object_service.idindex import IdentifierIndex
+        from object_service.idindex import write_index
+        simbids = [str(i) for i in range(1000, 3000, 7)]
+        entries = [('simbid', i) for i in simbids] + [('nedid', 'MESSIER_031'), ('nedid', 'NGC_0224'), ('nedid', 'MESSIER_031')]
+        self.assertEqual(write_index(self.path, entries), len(simbids) + 2)
+        index = IdentifierIndex(self.path)
+        self.assertTrue(all(index.contains('simbid', i) for i in simbids))
+        self.assertFalse(index.contains('simbid', '1001'))
+        self.assertFalse(index.contains('simbid', '100'))
+        self.assertFalse(index.contains('nedid', '1000'))
+        self.assertTrue(index.contains('nedid', 'NGC_0224'))
+        self.assertFalse(index.contains('nedid', 'NGC_0225'))
+        self.assertTrue(index.has_field('nedid'))
+        self.assertFalse(index.has_field('ned'))
+        self.assertFalse(index.has_field('zzz'))
+
+    def test_read_terms(self):
+        '''Terms exports are Solr terms responses or lists of identifiers'''
+        from object_service.idindex import read_terms
+        export = json.dumps({'responseHeader': {'status': 0}, 'terms': {'simbid': ['1575544', 10, '3133169', 2]}})
+        self.assertEqual(read_terms(io.StringIO(export), 'simbid'), ['1575544', '3133169'])
+        export = json.dumps({'terms': {'nedid': {'MESSIER_031': 10}}})
+        self.assertEqual(read_terms(io.StringIO(export), 'nedid'), ['MESSIER_031'])
+        self.assertEqual(read_terms(io.StringIO(u'MESSIER_031\t10\n\nNGC_0224\n'), 'nedid'), ['MESSIER_031', 'NGC_0224'])
+
+    def test_build_index(self):
+        '''The index is built from terms exports on the command line'''
+        from object_service.idindex import main
+        from object_service.idindex import IdentifierIndex
+        fname = os.path.join(self.tmpdir, 'nedid.txt')
+        with open(fname, 'w') as f:
+            f.write('MESSIER_031\nNGC_0224\n')
+        with mock.patch('sys.stdout'):
+            self.assertEqual(main([self.path, 'nedid=%s' % fname]), 0)
+        self.assertTrue(IdentifierIndex(self.path).contains('nedid', 'MESSIER_031'))
+
+    @mock.patch('object_service.utils.current_app.client.get')
+    def test_verify_with_index(self, mocked_get):
+        '''Fields in the index are not checked against Solr'''
+        from object_service.idindex import write_index
+        from object_service.utils import verify_identifiers
+        write_index(self.path, [('simbid', '1575544'), ('nedid', 'MESSIER_031')])
+        self.app.config['OBJECTS_ID_INDEX'] = self.path
+        result = verify_identifiers({'simbid': ['1575544', '3133169'], 'nedid': ['NGC_0001', 'MESSIER_031']})
+        self.assertEqual(result, {'simbid': ['1575544'], 'nedid': ['MESSIER_031']})
+        self.assertFalse(mocked_get.called)
+
+    def test_drop_unindexed(self):
+        '''Translations to identifiers that are not indexed are dropped'''
+        from object_service.idindex import write_index
+        from object_service.utils import drop_unindexed
+        translations = {'simbad': {'M31': '1575544', 'Foo': '42', 'Bar': '0'}, 'ned': {'M31': 'MESSIER_031', 'Foo': '0', 'Bar': '0'}}
+        # Without an index, nothing changes
+        self.assertEqual(drop_unindexed(dict(translations)), translations)
+        write_index(self.path, [('simbid', '1575544'), ('nedid', 'MESSIER_031')])
+        self.app.config['OBJECTS_ID_INDEX'] = self.path
+        expected = {'simbad': {'M31': '1575544', 'Foo': '0', 'Bar': '0'}, 'ned': {'M31': 'MESSIER_031', 'Foo': '0', 'Bar': '0'}}
+        self.assertEqual(drop_unindexed(translations), expected)
+
+if __name__ == '__main__':
+    unittest.main()
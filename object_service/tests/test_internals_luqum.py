@@ -336,6 +336,19 @@ class TestParser(TestCase):
         self.assertEqual(str(tree), str(parsed))
         self.assertEqual(tree, parsed)
 
+    def test_flattened_chains(self):
+        """Long chains of the same operator result in a single n-ary node
+        """
+        names = ["N%s" % i for i in range(500)]
+        parsed = parser.parse("object:(%s)" % " OR ".join(names))
+        self.assertEqual(parsed, SearchField("object", FieldGroup(OrOperation(*[Word(n) for n in names]))))
+        self.assertEqual(len(parsed.expr.expr.operands), 500)
+        # chains of another operator are nested, but flattened themselves
+        parsed = parser.parse("a AND b AND c OR d OR e")
+        tree = OrOperation(AndOperation(Word("a"), Word("b"), Word("c")), Word("d"), Word("e"))
+        self.assertEqual(str(parsed), str(tree))
+        self.assertEqual(parsed, tree)
+
     def test_reserved_ko(self):
         """Test reserved word hurt as they hurt lucene
         """
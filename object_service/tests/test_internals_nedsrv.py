@@ -336,5 +336,37 @@ class TestDataRetrieval(TestCase):
                     "Status Code": 500}
         self.assertEqual(result, expected)
 
+    @httpretty.activate
+    def test_duplicate_object_names(self):
+        '''Test to see if names that occur more than once are only looked up once'''
+        from object_service.NED import get_NED_refcodes
+        obj_data = {'objects':['FOO_BAR', 'FOO BAR', 'FOO_BAR', 'foo bar']}
+        solr_mockdata = {'response': {'docs': [{'bibcode': '2000ApJ...1..1X'}]}}
+        SOLR_URL = self.app.config.get('OBJECTS_SOLRQUERY_URL')
+        solr_queries = []
+        def solr_callback(request, uri, headers):
+            solr_queries.append(request.querystring['q'][0])
+            return (200, headers, json.dumps(solr_mockdata))
+        httpretty.register_uri(
+            httpretty.GET, SOLR_URL,
+            content_type='application/json',
+            body=solr_callback)
+        ned_mockdata = {u'NameResolver': u'NED-Egret', u'Copyright': u'(C) 2017 California Institute of Technology',
+                    u'Preferred': {u'Name': u'FOO BAR'},
+                    u'ResultCode': 3, u'StatusCode': 100}
+        NED_URL = self.app.config.get('OBJECTS_NED_URL')
+        ned_names = []
+        def ned_callback(request, uri, headers):
+            ned_names.append(json.loads(request.body)["name"]["v"])
+            return (200, headers, json.dumps(ned_mockdata))
+        httpretty.register_uri(
+            httpretty.POST, NED_URL,
+            content_type='application/json',
+            body=ned_callback)
+        result = get_NED_refcodes(obj_data)
+        self.assertEqual(result['data'], ['2000ApJ...1..1X'])
+        self.assertEqual(ned_names, ['FOO_BAR'])
+        self.assertEqual(solr_queries, ['nedid:FOO_BAR year:1800-%s' % now.year])
+
 if __name__ == '__main__':
     unittest.main()
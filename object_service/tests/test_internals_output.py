@@ -0,0 +1,86 @@
+import sys
+import os
+from flask_testing import TestCase
+from flask import url_for
+import unittest
+import gzip
+import json
+import httpretty
+from object_service import app
+
+class TestOutput(TestCase):
+
+    '''Check the serialization and compression of responses'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def test_dumps(self):
+        '''The fast encoder gives the same JSON as the standard library'''
+        from object_service.output import dumps
+        data = {'data': ['2017ApJ...845...12X', u'2018A&A...611A..95é'], 'count': 2, 'ok': True, 'none': None, 'x': 1.5}
+        self.assertEqual(json.loads(dumps(data).decode('utf-8')), data)
+        self.assertTrue(dumps(data).endswith(b'\n'))
+
+    def object_search(self, n, headers):
+        QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        mockdata = {"data": [[1000000 + i, "NGC %s" % i, "NGC %s" % i] for i in range(n)]}
+        httpretty.register_uri(
+            httpretty.POST, QUERY_URL,
+            content_type='application/json',
+            status=200,
+            body=json.dumps(mockdata))
+        return self.client.post(
+            url_for('objectsearch'),
+            content_type='application/json',
+            headers=headers,
+            data=json.dumps({'identifiers': [str(1000000 + i) for i in range(n)]}))
+
+    @httpretty.activate
+    def test_compressed_response(self):
+        '''Large responses are compressed when the client accepts that'''
+        r = self.object_search(200, {'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', r.headers['Vary'])
+        self.assertEqual(int(r.headers['Content-Length']), len(r.data))
+        data = json.loads(gzip.decompress(r.data).decode('utf-8'))
+        self.assertEqual(len(data), 200)
+        self.assertEqual(data['1000007'], {'id': '1000007', 'canonical': 'NGC 7'})
+
+    @httpretty.activate
+    def test_uncompressed_response(self):
+        '''Small responses, and responses to clients that do not accept it, are not compressed'''
+        r = self.object_search(200, {})
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(len(r.json), 200)
+        r = self.object_search(200, {'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.app.config['OBJECTS_COMPRESSION'] = False
+        r = self.object_search(200, {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', r.headers)
+
+    @httpretty.activate
+    def test_small_response(self):
+        '''Responses below the size threshold are not compressed'''
+        r = self.object_search(2, {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(len(r.json), 2)
+
+    def test_compressed_etag(self):
+        '''A strong ETag is made weak when the response is compressed'''
+        from object_service.output import compress_response, output_json
+        with self.app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = output_json({'data': ['x' * 2000]}, 200, {'ETag': '"abc"'})
+            response = compress_response(response)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.headers['ETag'], 'W/"abc"')
+        with self.app.test_request_context():
+            response = output_json({'data': ['x' * 2000]}, 200, {'ETag': '"abc"'})
+            response = compress_response(response)
+            self.assertEqual(response.headers['ETag'], '"abc"')
+
+if __name__ == '__main__':
+    unittest.main()
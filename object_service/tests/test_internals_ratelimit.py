@@ -0,0 +1,87 @@
+import sys
+import os
+from flask_testing import TestCase
+import unittest
+import time
+import tempfile
+import shutil
+from object_service import app
+import mock
+
+class TestRateLimit(TestCase):
+
+    '''Check if requests to upstream services are rate limited'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def test_token_bucket(self):
+        '''Bursts are allowed, after that requests wait for their turn'''
+        from object_service.ratelimit import TokenBucket
+        bucket = TokenBucket(10, 3)
+        self.assertEqual([bucket.reserve(1) for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.reserve(1), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(1), 0.2, places=2)
+        # Nothing is taken when we can't wait that long
+        self.assertEqual(bucket.reserve(0.1), None)
+        self.assertAlmostEqual(bucket.reserve(1), 0.3, places=2)
+        self.assertEqual(bucket.requests, 6)
+        self.assertEqual(bucket.delayed, 3)
+        self.assertAlmostEqual(bucket.max_wait, 0.3, places=2)
+
+    def test_shared_token_bucket(self):
+        '''Buckets using the same file share the rate'''
+        from object_service.ratelimit import TokenBucket
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'bucket')
+            worker1 = TokenBucket(10, 2, path)
+            worker2 = TokenBucket(10, 2, path)
+            self.assertEqual(worker1.reserve(1), 0)
+            self.assertEqual(worker2.reserve(1), 0)
+            self.assertAlmostEqual(worker1.reserve(1), 0.1, places=2)
+            self.assertAlmostEqual(worker2.reserve(1), 0.2, places=2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_rate_limited_tap_query(self, mocked_post):
+        '''SIMBAD requests are not sent faster than the rate limit'''
+        from object_service.SIMBAD import do_tap_query
+        self.app.config['OBJECTS_SIMBAD_RATE_LIMIT'] = [20, 1]
+        response = mock.Mock()
+        response.status_code = 200
+        response.json.return_value = {'data': [[1]]}
+        mocked_post.return_value = response
+        stime = time.time()
+        for i in range(3):
+            self.assertEqual(do_tap_query('SELECT %s;' % i, 'Object Search', 0), {'data': [[1]]})
+        self.assertTrue(time.time() - stime >= 0.09)
+        # Requests that would have to wait too long are not sent
+        self.app.config['OBJECTS_SIMBAD_TIMEOUT'] = 0.01
+        expected = {"Error": "Unable to get results!", "Error Info": "SIMBAD request not sent: rate limit exceeded"}
+        self.assertEqual(do_tap_query('SELECT 4;', 'Object Search', 0), expected)
+        self.assertEqual(mocked_post.call_count, 3)
+
+    @mock.patch('object_service.SIMBAD.current_app.client.post')
+    def test_tap_verification_not_rate_limited(self, mocked_post):
+        '''The TAP service verification neither uses nor waits for the rate limit'''
+        from object_service.SIMBAD import do_tap_query, verify_tap_service
+        from object_service.ratelimit import get_rate_limiter
+        self.app.config['OBJECTS_SIMBAD_RATE_LIMIT'] = [1, 1]
+        self.app.config['OBJECTS_SIMBAD_TIMEOUT'] = 0.01
+        response = mock.Mock()
+        response.status_code = 200
+        response.json.return_value = {'data': [[1]]}
+        mocked_post.return_value = response
+        tap_url = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        self.assertEqual(do_tap_query('SELECT 1;', 'Object Search', 0), {'data': [[1]]})
+        # The bucket is empty now, but the service is still verified (and kept)
+        self.assertEqual(verify_tap_service(), tap_url)
+        self.assertEqual(mocked_post.call_count, 2)
+        self.assertEqual(get_rate_limiter('simbad', tap_url).requests, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import sys
+import os
+from flask_testing import TestCase
+import unittest
+import time
+import threading
+from object_service import app
+import mock
+
+class TestSingleFlight(TestCase):
+
+    '''Check if identical concurrent upstream calls are coalesced'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def run_threads(self, func, n):
+        results = []
+        def target():
+            with self.app.app_context():
+                results.append(func())
+        threads = [threading.Thread(target=target) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_single_flight(self):
+        '''Concurrent calls with the same key share one call'''
+        from object_service.singleflight import coalesce
+        calls = []
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.2)
+            return {'data': x}
+        results = self.run_threads(lambda: coalesce('foo', slow, 1), 5)
+        self.assertEqual(results, [{'data': 1}] * 5)
+        self.assertEqual(calls, [1])
+        # Once the call is done, the next one goes upstream again
+        self.assertEqual(coalesce('foo', slow, 2), {'data': 2})
+        self.assertEqual(calls, [1, 2])
+
+    def test_single_flight_error(self):
+        '''Everyone waiting for a call that blew up gets the exception'''
+        from object_service.singleflight import coalesce
+        def boink():
+            time.sleep(0.2)
+            raise Exception('boink')
+        def call():
+            try:
+                return coalesce('foo', boink)
+            except Exception as err:
+                return str(err)
+        self.assertEqual(self.run_threads(call, 3), ['boink'] * 3)
+
+    def test_single_flight_deadlines(self):
+        '''A call that ran out of the time of a hurried request is retried by the others'''
+        from flask import g
+        from object_service.singleflight import coalesce
+        from object_service.deadline import remaining_time
+        calls = []
+        def lookup():
+            budget = remaining_time()
+            calls.append(budget)
+            if budget < 0.3:
+                time.sleep(budget)
+                return {"Error": "Unable to get results!", "Error Info": "SIMBAD request timed out"}
+            time.sleep(0.1)
+            return {'data': 1}
+        results = {}
+        def request(name, budget, delay):
+            with self.app.app_context():
+                g.deadline = time.time() + budget
+                time.sleep(delay)
+                results[name] = coalesce('foo', lookup)
+        threads = [threading.Thread(target=request, args=('hurried', 0.2, 0)),
+                   threading.Thread(target=request, args=('patient', 5, 0.05))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results['hurried']['Error Info'], 'SIMBAD request timed out')
+        self.assertEqual(results['patient'], {'data': 1})
+        self.assertEqual(len(calls), 2)
+
+    def test_single_flight_waiter_deadline(self):
+        '''A request waiting for a call does not make one of its own when its deadline passes'''
+        from flask import g
+        from object_service.singleflight import coalesce
+        calls = []
+        def lookup():
+            calls.append(1)
+            time.sleep(0.3)
+            return {'data': 1}
+        results = {}
+        def request(name, budget, delay):
+            with self.app.app_context():
+                g.deadline = time.time() + budget
+                time.sleep(delay)
+                results[name] = coalesce('foo', lookup)
+        threads = [threading.Thread(target=request, args=('patient', 5, 0)),
+                   threading.Thread(target=request, args=('hurried', 0.1, 0.05))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results['patient'], {'data': 1})
+        self.assertEqual(results['hurried']['Error Info'], 'Upstream request not sent: request deadline exceeded')
+        self.assertEqual(len(calls), 1)
+
+    @mock.patch('object_service.NED.current_app.client.post')
+    def test_ned_lookups_coalesced(self, mocked_post):
+        '''Concurrent NED lookups for the same name send one request'''
+        from object_service.NED import do_ned_object_lookup
+        def post(url, **kwargs):
+            time.sleep(0.2)
+            response = mock.Mock()
+            response.status_code = 200
+            response.json.return_value = {'Preferred': {'Name': 'MESSIER 031'}, 'ResultCode': 3, 'StatusCode': 100}
+            return response
+        mocked_post.side_effect = post
+        QUERY_URL = self.app.config.get('OBJECTS_NED_URL')
+        names = ['M31', 'M 31', 'm31', 'M31', 'M  31']
+        results = self.run_threads(lambda: do_ned_object_lookup(QUERY_URL, names.pop()), 5)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0]['Preferred']['Name'], 'MESSIER 031')
+        self.assertEqual(mocked_post.call_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
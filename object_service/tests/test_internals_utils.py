@@ -36,6 +36,14 @@ class TestDataRetrieval(TestCase):
         test = ')x('
         self.assertFalse(isBalanced(test))
 
+    def test_normalize_object_name(self):
+        '''Different ways of writing an object name have the same normalized form'''
+        from object_service.names import normalize_object_name
+        names = ['M31', 'M 31', 'm31', 'M_31', ' M  31 ', 'NAME M31', 'name m 31']
+        self.assertEqual(set(normalize_object_name(n) for n in names), set(['M31']))
+        self.assertEqual(normalize_object_name('V* RR Lyr'), 'RRLYR')
+        self.assertNotEqual(normalize_object_name('M31'), normalize_object_name('M3 1a'))
+
     def test_parse_query_string_unbalanced(self):
         '''Check is query string is parsed correctly'''
         from object_service.utils import parse_query_string
@@ -96,9 +104,9 @@ class TestDataRetrieval(TestCase):
         '''Test if verification of objects against Solr index works'''
         from object_service.utils import verify_query
         QUERY_URL = self.app.config.get('OBJECTS_SOLRQUERY_URL')
-        mockdata = {"response":{
-            "docs":["a","b","c"]
-        }}
+        mockdata = {"response":{"numFound":1, "docs":[]},
+                    "facet_counts":{"facet_queries":{'simbid:"a"':1, 'simbid:"b"':0}}
+        }
         ids = ["a", "b"]
         def request_callback(request, uri, headers):
             data = request.body
@@ -111,6 +119,10 @@ class TestDataRetrieval(TestCase):
             body=request_callback)
         v = verify_query(ids, "simbid")
         self.assertEqual(v, True)
+        # No documents are requested, only counts
+        params = httpretty.last_request().querystring
+        self.assertEqual(params['rows'], ['0'])
+        self.assertEqual(params['facet.query'], ['simbid:"a"', 'simbid:"b"'])
 
     @httpretty.activate   
     def test_verify_query_empty(self):
@@ -172,5 +184,64 @@ class TestDataRetrieval(TestCase):
         expected = {'Status Code': 500, 'Error Info': 'Solr response: {}', 'Error': 'Unable to get results!'}
         self.assertEqual(v, expected)
 
+    @httpretty.activate
+    def test_verify_identifiers(self):
+        '''SIMBAD and NED identifiers are verified in one request, and remembered'''
+        from object_service.utils import verify_identifiers
+        QUERY_URL = self.app.config.get('OBJECTS_SOLRQUERY_URL')
+        requests = []
+        def request_callback(request, uri, headers):
+            requests.append(request.querystring)
+            counts = dict((q, int(q != 'nedid:"NGC_0001"')) for q in request.querystring['facet.query'])
+            mockdata = {"response":{"numFound":2, "docs":[]},
+                        "facet_counts":{"facet_queries":counts}}
+            return (200, headers, json.dumps(mockdata))
+        httpretty.register_uri(
+            httpretty.GET, QUERY_URL,
+            content_type='application/json',
+            body=request_callback)
+        ids = {'simbid': ['1575544', '3133169'], 'nedid': ['MESSIER_031', 'NGC_0001']}
+        expected = {'simbid': ['1575544', '3133169'], 'nedid': ['MESSIER_031']}
+        self.assertEqual(verify_identifiers(ids), expected)
+        self.assertEqual(len(requests), 1)
+        # Only identifiers not known to be indexed are checked again
+        self.assertEqual(verify_identifiers(ids), expected)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[1]['facet.query'], ['nedid:"NGC_0001"'])
+        self.assertEqual(verify_identifiers({'simbid': ['3133169']}), {'simbid': ['3133169']})
+        self.assertEqual(len(requests), 2)
+
+    def test_canonical_cone(self):
+        '''Different ways of writing the same cone give the same canonical cone'''
+        from object_service.utils import parse_position_string
+        from object_service.cones import canonical_cone
+        from object_service.cones import cone_key
+        cones = ["80.8941667 -69.7561111:0.1", "05 23 34.6 -69 45 22:6'", "05h23m34.6s -69d45m22s:0 6 0"]
+        keys = set(cone_key(*canonical_cone(*parse_position_string(c))) for c in cones)
+        self.assertEqual(keys, set(['80.89417 -69.75611:0.10000']))
+        # The radius is at most the maximum radius of the service
+        coords, radius = parse_position_string("80.894 -69.756:10")
+        self.assertEqual(canonical_cone(coords, radius, 3), (80.894, -69.756, 3.0))
+        self.assertEqual(cone_key(*canonical_cone(coords, radius, 3)), '80.89400 -69.75600:3.00000')
+
+    @httpretty.activate
+    def test_equivalent_cone_searches(self):
+        '''Equivalent cone searches share one upstream query'''
+        from object_service.utils import parse_position_string
+        from object_service.SIMBAD import simbad_position_query
+        QUERY_URL = self.app.config.get('OBJECTS_SIMBAD_TAP_URL')
+        queries = []
+        def request_callback(request, uri, headers):
+            queries.append(request.parsed_body['query'])
+            return (200, headers, json.dumps({"data": [[3133169, 0.01]]}))
+        httpretty.register_uri(
+            httpretty.POST, QUERY_URL,
+            content_type='application/json',
+            body=request_callback)
+        for pstring in ["05 23 34.6 -69 45 22:6'", "80.8941667 -69.7561111:0.1"]:
+            self.assertEqual(simbad_position_query(*parse_position_string(pstring)), ['3133169'])
+        self.assertEqual(len(queries), 1)
+        self.assertIn("CIRCLE('ICRS', 80.89417, -69.75611, 0.1)", queries[0][0])
+
 if __name__ == '__main__':
     unittest.main()
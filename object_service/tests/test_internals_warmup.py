@@ -0,0 +1,104 @@
+import sys
+import os
+from flask_testing import TestCase
+import unittest
+import time
+from object_service import app
+import mock
+
+class TestWarmUp(TestCase):
+
+    '''Check the cache warm-up tool'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def test_read_queries(self):
+        '''Object names and positions are extracted from logs and name lists'''
+        from object_service.warmup import read_queries
+        lines = [
+            'INFO Received object query: object:Andromeda',
+            'INFO Received object query: object:(LMC OR "M 31") year:2000',
+            '{"message": "Received object query: object:Andromeda", "level": "INFO"}',
+            'INFO Received object query: object:"80.89416667 -69.75611111:0.166666"',
+            'INFO Starting cone search at RA, DEC, radius',
+            'INFO Received object query: year:2000',
+            '',
+        ]
+        names, cones, skipped = read_queries(lines)
+        self.assertEqual(names, {'Andromeda': 2, 'LMC': 1, 'M 31': 1})
+        self.assertEqual(cones, {'80.89416667 -69.75611111:0.166666': 1})
+        self.assertEqual(skipped, 1)
+        lines = ['SMC', 'M 31', 'object:(LMC OR SMC)', '05 23 34.6 -69 45 22:0.1']
+        names, cones, skipped = read_queries(lines, plain=True)
+        self.assertEqual(names, {'SMC': 2, 'LMC': 1, 'M 31': 1})
+        self.assertEqual(cones, {'05 23 34.6 -69 45 22:0.1': 1})
+        self.assertEqual(skipped, 0)
+
+    @mock.patch('object_service.warmup.ned_position_query')
+    @mock.patch('object_service.warmup.simbad_position_query')
+    @mock.patch('object_service.warmup.get_object_translation')
+    def test_warm_up(self, translation, simbad_cone, ned_cone):
+        '''Names are resolved once and upstream errors are counted'''
+        from collections import Counter
+        from object_service.warmup import warm_up
+        from object_service.cache import get_cache
+        get_cache().set_entry('simbad', 'LMC', '3133169')
+        def lookup(oname, trgt, use_cache=True):
+            if trgt == 'ned':
+                return {"Error": "Unable to get results!", "Error Info": "NED returned status 500"}
+            return {'Andromeda': '1575544', 'FooBar': '0'}[oname]
+        translation.side_effect = lookup
+        simbad_cone.return_value = ['3133169']
+        ned_cone.return_value = []
+        stats = warm_up(Counter({'Andromeda': 3, 'LMC': 2, 'FooBar': 1}),
+                        Counter({'80.89416667 -69.75611111:0.166666': 1, '05 23 34.6 -69 45 22:0.166666': 1}), rate=1000)
+        # Both positions are the same cone
+        self.assertEqual(stats['cones'], 1)
+        self.assertEqual(stats['lookups'], 7)
+        self.assertEqual(stats['cached'], 1)
+        self.assertEqual(stats['resolved'], 2)
+        self.assertEqual(stats['unknown'], 2)
+        self.assertEqual(stats['errors'], {'ned': 3})
+        self.assertEqual(stats['skipped'], 0)
+
+    @mock.patch('object_service.warmup.ned_position_query')
+    @mock.patch('object_service.warmup.simbad_position_query')
+    @mock.patch('object_service.warmup.get_object_translation')
+    def test_warm_up_rate(self, translation, simbad_cone, ned_cone):
+        '''Upstream lookups are spaced evenly, and cached cones are not looked up'''
+        from collections import Counter
+        from object_service.warmup import warm_up
+        from object_service.cache import get_cache
+        calls = []
+        def lookup(*args):
+            calls.append(time.time())
+            return '1'
+        translation.side_effect = lookup
+        simbad_cone.side_effect = lambda *args: lookup() and ['1']
+        get_cache().set('ned_cone', '80.89417 -69.75611:0.16667', ['LMC'])
+        names = Counter(dict(('NGC %s' % i, 1) for i in range(4)))
+        stats = warm_up(names, Counter({'80.89416667 -69.75611111:0.166666': 1}), targets=['simbad'], rate=20, batch_size=10)
+        self.assertEqual(stats['lookups'], 5)
+        self.assertEqual(stats['cached'], 1)
+        self.assertFalse(ned_cone.called)
+        # The first lookup goes right away, the others wait for their turn
+        gaps = [b - a for a, b in zip(calls, calls[1:])]
+        self.assertEqual(len(gaps), 4)
+        self.assertTrue(min(gaps) > 0.04)
+
+    @mock.patch('object_service.warmup.get_object_translation')
+    def test_warm_up_stops(self, translation):
+        '''The warm-up stops when the upstream services keep failing'''
+        from collections import Counter
+        from object_service.warmup import warm_up
+        translation.return_value = {"Error": "Unable to get results!", "Error Info": "circuit open"}
+        names = Counter(dict(('NGC %s' % i, 1) for i in range(10)))
+        stats = warm_up(names, Counter(), rate=1000, batch_size=2, max_errors=4)
+        self.assertEqual(stats['lookups'], 4)
+        self.assertEqual(stats['skipped'], 8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -39,6 +39,60 @@ class TestQueryStringParsing(TestCase):
             self.assertEqual(object_names, expected[0])
             self.assertEqual(object_queries, expected[1])
     
+    def test_query_parsing_long_list(self):
+        '''Test parsing of a query string with a long list of object names'''
+        from object_service.utils import parse_query_string as parse
+        names = ['N%s' % i for i in range(2000)]
+        oquery = 'object:(%s)' % ' OR '.join(names)
+        object_names, object_queries = parse('%s year:2010' % oquery)
+        self.assertEqual(object_names, names)
+        self.assertEqual(object_queries, [oquery])
+        # mixed operators and nested groups
+        object_names, object_queries = parse('object:(A OR (B AND C) OR -D)')
+        self.assertEqual(object_names, ['A', 'B', 'C', 'D'])
+        self.assertEqual(object_queries, ['object:(A OR (B AND C) OR -D)'])
+
+    def test_query_parsing_fast_path(self):
+        '''Test that the fast path and the full parser agree on the common query shapes'''
+        from object_service.utils import fast_parse_query_string as fast
+        from object_service.utils import full_parse_query_string as full
+        from object_service.utils import parse_query_string as parse
+        simple = [
+            'object:Bla',
+            'object:"Small Magellanic Cloud"',
+            'object:"Bla OR Something"',
+            'object:(Bla OR Something)',
+            'object:( "M 81"  OR M1 AND  SMC )',
+            'object:(A B)',
+            'object:("")',
+            'mod1:bar object:Bla mod2:foo',
+            'bibstem:"A&A" object:("*Foo +Ba" OR SMC) year:2015',
+            'bibstem:A&A object:(M31 OR "M 81") year:2010-2015 property:refereed',
+            'object:Foo OR object:Bar',
+            'object:X AND NOT year:2000',
+            '=abs:M31 object:M31',
+            'object:"80.89416667 -69.75611111:0.166666"',
+            'author:"^Smith" title:supernova',
+        ]
+        for qstring in simple:
+            self.assertIsNotNone(fast(qstring))
+            self.assertEqual(fast(qstring), full(qstring))
+            self.assertEqual(parse(qstring), full(qstring))
+        other = [
+            'object:(("*Foo +Ba" OR SMC) AND Andromeda)',
+            'citations(object:(X OR Y) OR fulltext:X)',
+            '-object:X',
+            'object:M31"x"',
+            'object:X~',
+            'object:(A TO B)',
+            'object:2015-12-19T22:30',
+            'year:[2000 TO 2010] object:M1',
+            'object:(A OR)',
+        ]
+        for qstring in other:
+            self.assertIsNone(fast(qstring))
+            self.assertEqual(parse(qstring), full(qstring))
+
     def test_query_translation(self):
         '''Test creation of translated query'''
         from object_service.utils import translate_query as translate
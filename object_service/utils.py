@@ -1,12 +1,25 @@
 from __future__ import absolute_import
 from builtins import map
 from builtins import str
+import re
 from . import luqum
 from .luqum.parser import parser
 from .luqum.utils import LuceneTreeTransformer
 from .NED import get_ned_data
 from .SIMBAD import get_simbad_data
 from .client import client
+from .circuit import get_breaker
+from .deadline import remaining_time
+from .deadline import deadline_exceeded
+from .cache import get_cache
+from .cache import revalidate
+from .cache import mark_degraded
+from .cache import mark_upstream_failure
+from .cache import FRESH, STALE
+from .names import normalize_object_name
+from .names import group_object_names
+from .idindex import get_identifier_index
+from requests.exceptions import Timeout, ConnectionError
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 from astropy.coordinates import Angle
@@ -17,40 +30,20 @@ class IncorrectPositionFormatError(Exception):
 
 class ObjectQueryExtractor(LuceneTreeTransformer):
     def visit_search_field(self, node, parents):
-        if isinstance(node, luqum.tree.SearchField):
-            if node.name != 'object':
-                return node
+        if node.name != 'object':
+            return node
+        self.object_nodes.append(str(node))
+        # The parser flattens chains of the same boolean operator into a single node,
+        # so object:(A OR B OR ... OR Z) is one loop over the operands. Nested
+        # expressions, like object:(("M 81" OR M1) AND M31), are handled with an explicit
+        # stack (in reverse, to keep the order in which names appear in the query)
+        stack = [node.expr]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, luqum.tree.Phrase) or isinstance(item, luqum.tree.Word):
+                self.object_names.append(item.value.replace('"','').strip())
             else:
-                self.revisit = False
-                self.object_nodes.append(str(node))
-        if isinstance(node.expr, luqum.tree.FieldGroup) or isinstance(node.expr, luqum.tree.Group):
-            # We need the following if statement for the case object:("M 81")
-            if isinstance(node.expr.expr, luqum.tree.Phrase) or isinstance(node.expr.expr, luqum.tree.Word):
-                self.object_names.append(node.expr.expr.value.replace('"','').strip())
-            # otherwise it is object:("M 81" OR M1)
-            else:
-                for o in node.expr.expr.operands:
-                    if isinstance(o, luqum.tree.Phrase) or isinstance(o, luqum.tree.Word):
-                        self.object_names.append(o.value.replace('"','').strip())
-                    else:
-                        self.revisit = True
-                        self.visit_search_field(o, parents)
-        elif isinstance(node.expr, luqum.tree.Word):
-            self.object_names.append(node.expr.value)
-        elif isinstance(node.expr, luqum.tree.Phrase):
-            self.object_names.append(node.expr.value.replace('"','').strip())
-        else:
-            # This section is to capture contents for recursive calls
-            if isinstance(node.expr, luqum.tree.Phrase) or isinstance(node.expr, luqum.tree.Word):
-                self.object_names.append(node.expr.expr.value.replace('"','').strip())
-            # otherwise it is object:("M 81" OR M1)
-            else:
-                for o in node.expr.operands:
-                    if isinstance(o, luqum.tree.Phrase) or isinstance(o, luqum.tree.Word):
-                        self.object_names.append(o.value.replace('"','').strip())
-                    else:
-                        self.revisit = True
-                        self.visit_search_field(o, parents)
+                stack.extend(reversed(item.children))
         return node
 
 def isBalanced(s):
@@ -77,6 +70,98 @@ def isBalanced(s):
     #            return False
     return len(stack)==0
 
+# Tokens recognized by the fast path query scanner. Anything else (ranges, boosts,
+# fuzzy terms, escapes, nested groups, ...) makes the scanner give up and the query
+# is handed over to the full luqum parser.
+FAST_TOKEN_RE = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<field>[=\w][\w.]*):
+  | (?P<phrase>"[^"]*")
+  | (?P<lparen>\()
+  | (?P<rparen>\))
+  | (?P<word>[^\s:^~(){}\[\],"'+\-][^\s:^~(){}\[\]"']*)
+''', re.VERBOSE | re.UNICODE)
+FAST_OPERATORS = ('AND', 'OR')
+
+def fast_parse_query_string(query_string):
+    """
+    Extract object names and object queries from the common query shapes, like
+    object:X, object:"A B" and object:(A OR B), combined with other fielded terms,
+    in one linear scan. Returns the same as parse_query_string, or None when the
+    query is too complex for this scanner.
+    """
+    tokens = []
+    pos = 0
+    while pos < len(query_string):
+        m = FAST_TOKEN_RE.match(query_string, pos)
+        if not m:
+            return None
+        pos = m.end()
+        if m.lastgroup == 'space':
+            continue
+        # For luqum, quotes directly following a word are part of that word
+        if m.lastgroup == 'word' and query_string[pos:pos + 1] in ('"', "'"):
+            return None
+        tokens.append((m.lastgroup, m.group(m.lastgroup)))
+    object_names = []
+    object_nodes = []
+    # Top level: clauses, optionally preceded by NOT, separated by whitespace, AND or OR
+    i = 0
+    expect_clause = True
+    while i < len(tokens):
+        kind, value = tokens[i]
+        i += 1
+        if kind == 'word' and value in FAST_OPERATORS:
+            if expect_clause:
+                return None
+            expect_clause = True
+            continue
+        if kind == 'word' and value == 'NOT':
+            expect_clause = True
+            continue
+        if kind == 'word' and value == 'TO':
+            return None
+        if kind in ('word', 'phrase'):
+            expect_clause = False
+            continue
+        if kind != 'field' or i == len(tokens):
+            return None
+        field = value
+        # We have a fielded term: its value is a word, a phrase or a flat group
+        kind, value = tokens[i]
+        i += 1
+        if kind == 'phrase' or (kind == 'word' and value not in FAST_OPERATORS + ('NOT', 'TO')):
+            items = [value]
+            field_value = value
+        elif kind == 'lparen':
+            items = []
+            group = []
+            while i < len(tokens) and tokens[i][0] != 'rparen':
+                kind, value = tokens[i]
+                i += 1
+                if kind == 'word' and value in FAST_OPERATORS:
+                    # an operator needs an item on both sides
+                    if not group or group[-1] in FAST_OPERATORS:
+                        return None
+                elif kind == 'phrase' or (kind == 'word' and value not in ('NOT', 'TO')):
+                    items.append(value)
+                else:
+                    return None
+                group.append(value)
+            if i == len(tokens) or not items or group[-1] in FAST_OPERATORS:
+                return None
+            i += 1
+            field_value = "(%s)" % " ".join(group)
+        else:
+            return None
+        if field == 'object':
+            object_nodes.append('object:%s' % field_value)
+            object_names += [o.replace('"','').strip() for o in items]
+        expect_clause = False
+    if expect_clause:
+        return None
+    return [on for on in object_names if on.strip()], object_nodes
+
 def parse_query_string(query_string):
     # We only accept Solr queries with balanced parentheses
     balanced = isBalanced(query_string)
@@ -84,6 +169,13 @@ def parse_query_string(query_string):
         current_app.logger.error('Unbalanced parentheses found in Solr query: %s'%query_string)
         return [], []
     # The query string is valid from the parenthese point-of-view
+    # Most queries have a simple shape that does not require the full parser
+    parsed = fast_parse_query_string(query_string)
+    if parsed is not None:
+        return parsed
+    return full_parse_query_string(query_string)
+
+def full_parse_query_string(query_string):
     # First create the query tree
     try:
         query_tree = parser.parse(query_string)
@@ -119,22 +211,87 @@ def get_object_translations(onames, trgts):
         idmap[trgt] = {}
         for oname in onames:
             idmap[trgt][oname] = "0"
-    # now get the object translations for the targets specified
+    # now get the object translations for the targets specified. Names that occur
+    # more than once, or are written in different ways, are only looked up once (a
+    # different spelling is only tried when the previous one was not known).
+    groups = group_object_names(onames)
     for trgt in trgts:
-        for oname in onames:
-            result = get_object_data([oname], trgt)
-            if 'Error' in result or 'data' not in result:
-                # An error was returned!
-                current_app.logger.error('Failed to find data for {0} object {1}!: {2}'.format(trgt.upper(), oname, result.get('Error Info','NA')))
-                continue
-            try:
-                # We need to have a 'try' here in case a service returns an empty 'data' attribute
-                idmap[trgt][oname] =[e.get('id',0) for e in result['data'].values()][0]
-            except:
+        for spellings in groups.values():
+            translation = "0"
+            for oname in spellings:
+                translation = get_object_translation(oname, trgt)
+                if translation != "0":
+                    break
+            if isinstance(translation, dict):
+                # An error was returned: the objects keep the "0" translation
                 continue
+            for oname in spellings:
+                idmap[trgt][oname] = translation
 
     return idmap
 
+def get_object_translation(oname, trgt, use_cache=True):
+    # Translations are cached per target (an unknown name is cached as "0").
+    # Translations hardly ever change, so when a cached translation has timed out,
+    # we still use it and refresh it in the background. Only when it is older than
+    # the maximum staleness, it has to be looked up again before we can use it.
+    # Translations are shared by all ways of writing a name, but an unknown name is
+    # only cached as written (another spelling may well be known).
+    cache = get_cache()
+    key = normalize_object_name(oname)
+    cached, state = None, None
+    if use_cache:
+        cached, state = cache.get_entry(trgt, key)
+        if cached is None:
+            cached, state = cache.get_entry('%s_unknown' % trgt, oname)
+        if state == FRESH:
+            return cached
+        if state == STALE:
+            revalidate(('translation', trgt, oname), get_object_translation, oname, trgt, False)
+            return cached
+    if deadline_exceeded():
+        # Out of time: no translation for this object
+        current_app.logger.info('Request deadline exceeded, no {0} translation for object {1}'.format(trgt.upper(), oname))
+        result = {"Error": "Unable to get results!",
+                  "Error Info": "{0} request not sent: request deadline exceeded".format(trgt.upper())}
+    else:
+        result = get_object_data([oname], trgt)
+    if 'Error' in result or 'data' not in result:
+        # An error was returned!
+        current_app.logger.error('Failed to find data for {0} object {1}!: {2}'.format(trgt.upper(), oname, result.get('Error Info','NA')))
+        if cached is not None:
+            # Degraded mode: an expired translation is better than none
+            current_app.logger.info('Using expired {0} translation for object {1}'.format(trgt.upper(), oname))
+            mark_degraded()
+            return cached
+        mark_upstream_failure()
+        return {"Error": "Unable to get results!", "Error Info": result.get('Error Info','NA')}
+    try:
+        # We need to have a 'try' here in case a service returns an empty 'data' attribute
+        translation = [e.get('id',0) for e in result['data'].values()][0]
+    except:
+        cache.set_entry('%s_unknown' % trgt, oname, "0", current_app.config.get('OBJECTS_CACHE_NEGATIVE_TIMEOUT', 3600))
+        return "0"
+    cache.set_entry(trgt, key, translation)
+    return translation
+
+def drop_unindexed(translations):
+    # Identifiers that are not in the Solr index can't match anything: they are
+    # treated like unknown names. Only done when there is a local identifier index.
+    index = get_identifier_index()
+    if index is None:
+        return translations
+    fields = {'simbad': 'simbid', 'ned': 'nedid'}
+    for trgt, idmap in translations.items():
+        field = fields.get(trgt)
+        if field is None or not index.has_field(field):
+            continue
+        for oname, identifier in idmap.items():
+            if identifier != "0" and not index.contains(field, str(identifier)):
+                current_app.logger.info('{0} identifier {1} for object {2} not in Solr index'.format(trgt.upper(), identifier, oname))
+                idmap[oname] = "0"
+    return translations
+
 def translate_query(solr_query, oqueries, trgts, onames, translations):
     # The goal is to translate the original Solr query with the embedded
     # "object:" queries into a Solr query with actual Solr fields
@@ -229,21 +386,96 @@ def parse_position_string(pstring):
 
     return coords, search_radius
 
-def verify_query(identifiers, field):
-    # Safeguard for guarantee that SIMBAD and NED identifiers found are
-    # indeed in Solr index
-    query = '{0}:({1})'.format(field, " OR ".join(identifiers))
-    params = {'wt': 'json', 'q': query, 'fl': 'id',
-              'rows': 10}
-    response = current_app.client.get(current_app.config['OBJECTS_SOLRQUERY_URL'], params=query)
+def solr_identifier_query(field, identifier):
+    # Query for one identifier, quoted so that NED identifiers with special characters
+    # are taken literally
+    return '%s:"%s"' % (field, identifier.replace('\\', '\\\\').replace('"', '\\"'))
+
+def verify_identifiers(identifiers):
+    """
+    Check which SIMBAD and NED identifiers are in the Solr index. The argument maps the
+    Solr fields ('simbid', 'nedid') to lists of identifiers; the same mapping is returned,
+    with only the identifiers that are indexed (or an error dictionary). Identifiers
+    known to be indexed are cached, and the others are checked in one Solr query for all
+    fields: no documents are returned (rows=0), only a facet count per identifier.
+    Fields that are in the local identifier index (OBJECTS_ID_INDEX) are checked
+    against the index instead.
+    """
+    cache = get_cache()
+    ttl = current_app.config.get('OBJECTS_SOLR_VERIFY_TTL', 86400)
+    index = get_identifier_index()
+    verified = dict((field, []) for field in identifiers)
+    todo = []
+    for field, ids in identifiers.items():
+        if index is not None and index.has_field(field):
+            # The local index knows all identifiers of this field
+            verified[field] = [i for i in ids if index.contains(field, i)]
+            continue
+        for identifier in ids:
+            if cache.get('solr_%s' % field, identifier):
+                verified[field].append(identifier)
+            else:
+                todo.append((field, identifier))
+    if not todo:
+        return verified
+    facet_queries = [solr_identifier_query(field, identifier) for field, identifier in todo]
+    params = {'wt': 'json', 'q': " OR ".join(facet_queries), 'fl': 'id', 'rows': 0,
+              'facet': 'true', 'facet.query': facet_queries}
+    solr_url = current_app.config['OBJECTS_SOLRQUERY_URL']
+    if deadline_exceeded():
+        return {"Error": "Unable to get results!",
+                "Error Info": "Solr request not sent: request deadline exceeded"}
+    breaker = get_breaker(solr_url)
+    if not breaker.allow_request():
+        current_app.logger.info('Solr request to %s not sent: circuit is open'%solr_url)
+        return {"Error": "Unable to get results!",
+                "Error Info": "Solr service unavailable (circuit open)"}
+    try:
+        response = current_app.client.get(solr_url, params=params, timeout=remaining_time())
+    except Timeout as err:
+        breaker.record_failure(timeout=True)
+        current_app.logger.info('Solr request to %s timed out: %s'%(solr_url, err))
+        return {"Error": "Unable to get results!",
+                "Error Info": "Solr request timed out: {0}".format(err)}
+    except ConnectionError as err:
+        breaker.record_failure()
+        current_app.logger.error('Solr request to %s failed: %s'%(solr_url, err))
+        return {"Error": "Unable to get results!",
+                "Error Info": "Solr request failed ({0})".format(err)}
+    except Exception:
+        breaker.record_failure()
+        raise
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
     if response.status_code != 200:
         return {"Error": "Unable to get results!",
                 "Error Info": "Solr response: %s" % str(response.text),
                 "Status Code": response.status_code}
     resp = response.json()
     try:
-        docs = resp['response']['docs']
+        counts = resp['facet_counts']['facet_queries']
     except:
-        docs = []
-    # return True (we found docs) or False (no docs found)
-    return len(docs) > 0
+        # No counts per identifier: all of them are fine if anything was found
+        try:
+            found = resp['response']['numFound'] > 0
+        except:
+            found = False
+        counts = dict((q, int(found)) for q in facet_queries)
+    for (field, identifier), fquery in zip(todo, facet_queries):
+        if counts.get(fquery, 0) > 0:
+            verified[field].append(identifier)
+            if 'facet_counts' in resp:
+                cache.set('solr_%s' % field, identifier, True, ttl)
+    # Keep the order in which the identifiers were given
+    verified = dict((field, set(ids)) for field, ids in verified.items())
+    return dict((field, [i for i in ids if i in verified[field]]) for field, ids in identifiers.items())
+
+def verify_query(identifiers, field):
+    # Safeguard for guarantee that SIMBAD and NED identifiers found are
+    # indeed in Solr index: returns True if any of them is
+    verified = verify_identifiers({field: identifiers})
+    if 'Error' in verified:
+        return verified
+    return len(verified[field]) > 0
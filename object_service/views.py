@@ -5,11 +5,14 @@ from flask import current_app, request
 from flask_restful import Resource
 from flask_discoverer import advertise
 from flask import Response
+from flask import stream_with_context
 from .SIMBAD import get_simbad_data
+from .SIMBAD import iter_simbad_data
 from .SIMBAD import simbad_position_query
 from .SIMBAD import verify_tap_service
 
 from .NED import get_ned_data
+from .NED import iter_ned_data
 from .NED import get_NED_refcodes
 from .NED import ned_position_query
 
@@ -18,9 +21,19 @@ from .utils import get_object_translations
 from .utils import translate_query
 from .utils import isBalanced
 from .utils import parse_position_string
-from .utils import verify_query
+from .utils import verify_identifiers
+from .utils import drop_unindexed
+from .cache import is_degraded
+from .cache import mark_upstream_failure
+from .names import normalize_object_name
+from .jobs import submit_job
+from .jobs import wait_for_job
+from .admission import admission_control
+from .http_caching import http_caching
 
 import time
+import math
+import json
 import timeout_decorator
 
 class IncorrectPositionFormatError(Exception):
@@ -31,7 +44,7 @@ class ObjectSearch(Resource):
     """Return object identifiers for a given object string"""
     scopes = []
     rate_limit = [1000, 60 * 60 * 24]
-    decorators = [advertise('scopes', 'rate_limit')]
+    decorators = [http_caching('objects'), admission_control, advertise('scopes', 'rate_limit')]
 
     def post(self):
         stime = time.time()
@@ -74,6 +87,10 @@ class ObjectSearch(Resource):
             current_app.logger.error('No identifiers or objects were specified for SIMBAD object query')
             return {"Error": "Unable to get results!",
                     "Error Info": "No identifiers/objects found in POST body"}, 200
+        # Long lists can be streamed: a line of JSON per object, as soon as it is resolved
+        if request.json.get('stream'):
+            return Response(stream_with_context(stream_object_data(source, identifiers, input_type)),
+                            mimetype='application/x-ndjson')
         # We have a known object data source and a list of identifiers. Let's start!
         # We have identifiers
         if source == 'simbad':
@@ -85,6 +102,7 @@ class ObjectSearch(Resource):
         if 'Error' in result:
             # An error was returned!
             err_msg = result['Error Info']
+            mark_upstream_failure()
             current_app.logger.error('Failed to find data for %s %s query (%s)!'%(source.upper(), input_type,err_msg))
             current_app.logger.error('Original request: %s'%str(request.json))
             return result
@@ -94,17 +112,65 @@ class ObjectSearch(Resource):
             current_app.logger.info('Found objects for %s %s in %s user seconds.' % (source.upper(), input_type, duration))
             # Now pick the entries in the results that correspond with the original object names
             if input_type == 'objects':
-#                result['data'] = {k: result['data'].get(k.upper()) for k in identifiers}
-                result['data'] = {k: result['data'].get(k) or result['data'].get(k.upper())  for k in identifiers}
+                result['data'] = dict(match_object_names(identifiers, result['data']))
             # Send back the results
             return result.get('data',{})
 
+def match_object_names(names, data):
+    # Returns tuples of the object names and their entries in the results (looked up
+    # as written, or else by their normalized form)
+    normalized = {normalize_object_name(k): v for k, v in data.items() if v}
+    return [(k, data.get(k) or normalized.get(normalize_object_name(k))) for k in names]
+
+def ned_batches(identifiers, input_type):
+    # The NED lookups, in the same form as the SIMBAD chunks of iter_simbad_data
+    for ident, data in iter_ned_data(identifiers, input_type):
+        if data is None:
+            yield [ident], {'data': {}}
+        elif 'Error' in data:
+            yield [ident], data
+        else:
+            yield [ident], {'data': {ident: data}}
+
+def stream_object_data(source, identifiers, input_type):
+    """
+    Generator for streamed object searches: a line of JSON ({"<name>": {"id": ...,
+    "canonical": ...}}) per object, sent as soon as the SIMBAD chunk or the NED lookup
+    it is in is done. Object names that are not found get null, like in the full
+    response. An error is sent as a line with "Error" and "Error Info": the objects
+    it applies to are left out.
+    """
+    stime = time.time()
+    if source == 'simbad':
+        batches = iter_simbad_data(identifiers, input_type)
+    else:
+        batches = ned_batches(identifiers, 'simple' if input_type == 'identifiers' else input_type)
+    count = 0
+    for names, result in batches:
+        if 'Error' in result:
+            current_app.logger.error('Failed to find data for %s %s query (%s)!'%(source.upper(), input_type, result.get('Error Info')))
+            yield json.dumps(result) + '\n'
+            continue
+        if input_type == 'objects':
+            entries = match_object_names(names, result.get('data', {}))
+        else:
+            entries = result.get('data', {}).items()
+        for name, value in entries:
+            count += 1
+            yield json.dumps({name: value}) + '\n'
+    current_app.logger.info('Streamed %s objects for %s %s in %s user seconds.' % (count, source.upper(), input_type, time.time() - stime))
+
 class QuerySearch(Resource):
 
     """Given a Solr query with object names, return a Solr query with SIMBAD identifiers"""
     scopes = []
     rate_limit = [1000, 60 * 60 * 24]
-    decorators = [advertise('scopes', 'rate_limit')]
+    decorators = [http_caching('query'), admission_control, advertise('scopes', 'rate_limit')]
+
+    def get(self):
+        # The same as a POST, with the query (and target) as URL parameters, so that
+        # the translations can be cached by the gateway and browsers
+        return self.post()
 
     def post(self):
         stime = time.time()
@@ -120,8 +186,9 @@ class QuerySearch(Resource):
         query = None
         itype = None
         name2id = {}
+        params = request.args if request.method == 'GET' else request.json
         try:
-            query = request.json['query']
+            query = params['query']
             input_type = 'query'
         except:
             current_app.logger.error('No query was specified for the  object search')
@@ -136,7 +203,7 @@ class QuerySearch(Resource):
         current_app.logger.info('Received object query: %s'%solr_query)
         # Check if an explicit target service was specified
         try:
-            targets = [t.strip() for t in request.json['target'].lower().split(',')]
+            targets = [t.strip() for t in params['target'].lower().split(',')]
         except:
             targets = ['simbad', 'ned']
         # Get the object names and individual object queries from the Solr query
@@ -170,27 +237,33 @@ class QuerySearch(Resource):
             simbad_fail = False
             ned_fail = False
             sids = simbad_position_query(coordinates, radius)
-            if len(sids) > 0 and type(sids) == list:
-                vq = verify_query(sids, 'simbid')
-                if not vq:
-                    current_app.logger.info('SIMBAD identifiers not in Solr index: {0}'.format(",".join(sids)))
-                    simbad_fail = 'SIMBAD identifiers not found in Solr index'
-                    sids = []
             result['simbad'] = sids
             if 'Error' in result['simbad']:
+                mark_upstream_failure()
                 simbad_fail = result['simbad']['Error Info']
                 result['simbad'] = []
             nids = ned_position_query(coordinates, radius)
-            if len(nids) > 0 and type(nids) == list:
-                vq = verify_query(nids, 'nedid')
-                if not vq:
-                    current_app.logger.info('NED identifiers not in Solr index: {0}'.format(",".join(nids)))
-                    ned_fail = 'NED identifiers not found in Solr index'
-                    nids = []
             result['ned'] = nids
             if 'Error' in result['ned']:
+                mark_upstream_failure()
                 ned_fail = result['ned']['Error Info']
                 result['ned'] = []
+            # Check (in one go) that the identifiers found are in the Solr index
+            found = dict((f, result[s]) for f, s in [('simbid', 'simbad'), ('nedid', 'ned')] if result[s])
+            if found:
+                verified = verify_identifiers(found)
+                if 'Error' in verified:
+                    current_app.logger.warning('Identifiers could not be verified: {0}'.format(verified['Error Info']))
+                    mark_upstream_failure()
+                    verified = found
+                if 'simbid' in found and not verified['simbid']:
+                    current_app.logger.info('SIMBAD identifiers not in Solr index: {0}'.format(",".join(result['simbad'])))
+                    simbad_fail = 'SIMBAD identifiers not found in Solr index'
+                if 'nedid' in found and not verified['nedid']:
+                    current_app.logger.info('NED identifiers not in Solr index: {0}'.format(",".join(result['ned'])))
+                    ned_fail = 'NED identifiers not found in Solr index'
+                result['simbad'] = verified.get('simbid', [])
+                result['ned'] = verified.get('nedid', [])
             # If both SIMBAD and NED errored out, return an error
             if simbad_fail and ned_fail:
                 return {"Error": "Unable to get results!",
@@ -205,9 +278,12 @@ class QuerySearch(Resource):
             translated_query = solr_query.replace(object_queries[0], oquery)
             return {'query': translated_query}
         # Create the translation map from the object names provided to identifiers indexed in Solr (simbid and nedid)
-        name2id = get_object_translations(object_names, targets)
+        name2id = drop_unindexed(get_object_translations(object_names, targets))
         # Now we have all necessary information to created the translated query
         translated_query = translate_query(solr_query, object_queries, targets, object_names, name2id)
+        if is_degraded():
+            # Some translations are expired ones, because SIMBAD or NED failed
+            return {'query': translated_query, 'degraded': True}
 
         return {'query': translated_query}
 
@@ -216,7 +292,7 @@ class ClassicObjectSearch(Resource):
     """Return object NED refcodes for a given object list"""
     scopes = []
     rate_limit = [1000, 60 * 60 * 24]
-    decorators = [advertise('scopes', 'rate_limit')]
+    decorators = [admission_control, advertise('scopes', 'rate_limit')]
 
     def post(self):
         stime = time.time()
@@ -227,26 +303,60 @@ class ClassicObjectSearch(Resource):
                 return {'Error': 'Unable to get results!',
                             'Error Info': 'No object names found in POST body'}, 200
 
+        # Big object lists can take a long time: they can be submitted as a job
+        if request.json.get('async'):
+            job = submit_job(get_NED_refcodes, request.json)
+            if job is None:
+                current_app.logger.info('Classic Object Search job refused: too many jobs')
+                return {"Error": "Unable to get results!",
+                        "Error Info": "Too many jobs queued or running, please try again later"}, 429, \
+                       {'Retry-After': str(current_app.config.get('OBJECTS_JOB_RETRY_AFTER', 10))}
+            current_app.logger.info('Classic Object Search job %s submitted for %s object(s)' % (job['id'], len(request.json['objects'])))
+            return {'job': job['id'], 'status': job['status']}, 202
+
         results = get_NED_refcodes(request.json)
+        if "Error" not in results:
+            duration = time.time() - stime
+            current_app.logger.info('Classic Object Search request successfully completed in %s real seconds'%duration)
+        return classic_object_search_response(results, request.json.get('output_format', 'json'))
+
+class ClassicObjectSearchJob(Resource):
 
-        if "Error" in results:
-            status = 400
-            error_info = results.get('Error Info', 'NA')
-            if error_info.find('timed out') > -1:
-                status = 504
-            current_app.logger.error('Classic Object Search request request blew up. Error info: %s' % error_info)
-            return results, status
-        duration = time.time() - stime
-        current_app.logger.info('Classic Object Search request successfully completed in %s real seconds'%duration)
-        # what output format?
+    """Return the status, or the results, of a Classic Object Search job"""
+    scopes = []
+    rate_limit = [1000, 60 * 60 * 24]
+    decorators = [advertise('scopes', 'rate_limit')]
+
+    def get(self, job_id):
+        # Clients can wait for the job to finish (up to a maximum time)
         try:
-            oformat = request.json['output_format']
-        except:
-            oformat = 'json'
-        # send the results back in the requested format
-        if oformat == 'json':
-            return results
-        else:
-            output = "\n".join(results['data'])
-            return Response(output, mimetype='text/plain; charset=us-ascii')
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            wait = 0
+        if not math.isfinite(wait):
+            wait = 0
+        wait = max(0, min(wait, current_app.config.get('OBJECTS_JOB_MAX_WAIT', 30)))
+        job = wait_for_job(job_id, wait)
+        if job is None:
+            return {'Error': 'Unable to get results!',
+                    'Error Info': 'Unknown job: {0}'.format(job_id)}, 404
+        if job['status'] not in ['done', 'failed']:
+            return {'job': job_id, 'status': job['status']}, 202
+        return classic_object_search_response(job['result'], request.args.get('output_format', 'json'))
 
+def classic_object_search_response(results, oformat):
+    if "Error" in results:
+        status = 400
+        error_info = results.get('Error Info', 'NA')
+        if error_info.find('timed out') > -1 or error_info.find('deadline exceeded') > -1:
+            status = 504
+        elif error_info.find('circuit open') > -1 or error_info.find('rate limit') > -1:
+            status = 503
+        current_app.logger.error('Classic Object Search request request blew up. Error info: %s' % error_info)
+        return results, status
+    # send the results back in the requested format
+    if oformat == 'json':
+        return results
+    else:
+        output = "\n".join(results['data'])
+        return Response(output, mimetype='text/plain; charset=us-ascii')
@@ -0,0 +1,216 @@
+"""
+    warmup
+    ~~~~~~
+    Fill the object cache ahead of traffic, with the object names and cone searches
+    from the service logs ('Received object query: ...' entries) or from plain lists
+    with one object name, position or object query per line (--plain). Example:
+
+        python -m object_service.warmup --rate 5 /var/log/object_service/app.log
+
+    Names are resolved against SIMBAD and NED in batches, no faster than the given
+    rate, and the run stops when the upstream services keep failing. The cache has to
+    have a shared store (OBJECTS_CACHE_REDIS_URL) or a snapshot (OBJECTS_CACHE_SNAPSHOT)
+    for the results to be of any use to the service.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+from flask import current_app
+from .app import create_app
+from .SIMBAD import verify_tap_service
+from .SIMBAD import simbad_position_query
+from .NED import ned_position_query
+from .cache import get_cache
+from .cache import FRESH
+from .ratelimit import TokenBucket
+from .utils import parse_query_string
+from .utils import parse_position_string
+from .utils import get_object_translation
+from .names import normalize_object_name
+from .cones import canonical_cone
+from .cones import cone_key
+
+LOG_MARKER = 'Received object query: '
+
+def extract_query(line):
+    # Returns the object query in a line of the logs (None for other log entries)
+    line = line.strip()
+    if line.startswith('{'):
+        # JSON formatted log entry
+        try:
+            line = json.loads(line).get('message', '')
+        except (ValueError, AttributeError):
+            pass
+    if LOG_MARKER in line:
+        return line.split(LOG_MARKER, 1)[1].strip()
+    return None
+
+def read_queries(lines, plain=False):
+    """
+    Returns the counts of object names and cone searches (positions) found in the
+    lines, and the number of object queries that did not give any. The lines are log
+    entries, or (plain=True) object names, positions or object queries.
+    """
+    names = Counter()
+    cones = Counter()
+    skipped = 0
+    for line in lines:
+        query = line.strip() if plain else extract_query(line)
+        if not query:
+            continue
+        if plain and 'object:' not in query:
+            # A plain object name or position
+            query = 'object:"%s"' % query.replace('"', '')
+        try:
+            object_names, object_queries = parse_query_string(query.replace('^',''))
+        except Exception:
+            object_names, object_queries = [], []
+        if not object_names:
+            skipped += 1
+            continue
+        if len(object_queries) == 1:
+            try:
+                parse_position_string(object_names[0])
+                cones[object_names[0]] += 1
+                continue
+            except Exception:
+                pass
+        names.update(object_names)
+    return names, cones, skipped
+
+def warm_up(names, cones, targets=('simbad', 'ned'), rate=5.0, batch_size=50, max_errors=20, refresh=False):
+    """
+    Resolve the object names and cone searches (most frequent first) to fill the
+    cache. Upstream lookups are spaced to at most 'rate' per second, and the run stops
+    after 'max_errors' consecutive upstream errors. Returns a dictionary with
+    statistics.
+    """
+    # Different ways of writing the same name only need one lookup (the most
+    # frequent spelling is used)
+    spellings = {}
+    counts = Counter()
+    for name, count in names.most_common():
+        key = normalize_object_name(name)
+        spellings.setdefault(key, name)
+        counts[key] += count
+    # The same goes for different ways of writing the same cone
+    positions = {}
+    cone_counts = Counter()
+    for position, count in cones.most_common():
+        key = cone_key(*canonical_cone(*parse_position_string(position)))
+        positions.setdefault(key, position)
+        cone_counts[key] += count
+    stats = {'names': len(counts), 'cones': len(cone_counts), 'lookups': 0, 'cached': 0,
+             'resolved': 0, 'unknown': 0, 'errors': Counter(), 'skipped': 0}
+    cache = get_cache()
+    work = [('name', spellings[k]) for k, c in counts.most_common()] + [('cone', positions[k]) for k, c in cone_counts.most_common()]
+    # The lookups are spaced evenly: every upstream lookup takes a token
+    bucket = TokenBucket(rate, 1)
+    def lookup(func, *args):
+        wait = bucket.reserve(None)
+        if wait:
+            time.sleep(wait)
+        stats['lookups'] += 1
+        return func(*args)
+    cone_searches = [('simbad', simbad_position_query, 'simbad_cone', 'OBJECTS_SIMBAD_MAX_RADIUS'),
+                     ('ned', ned_position_query, 'ned_cone', 'OBJECTS_NED_MAX_RADIUS')]
+    consecutive_errors = 0
+    stime = time.time()
+    for start in range(0, len(work), batch_size):
+        if consecutive_errors >= max_errors:
+            current_app.logger.error('Stopping cache warm-up after %s consecutive upstream errors' % consecutive_errors)
+            stats['skipped'] += len(work) - start
+            break
+        for kind, item in work[start:start + batch_size]:
+            results = []
+            if kind == 'cone':
+                coordinates, radius = parse_position_string(item)
+                for trgt, search, namespace, max_radius in cone_searches:
+                    key = cone_key(*canonical_cone(coordinates, radius, current_app.config.get(max_radius)))
+                    if cache.get(namespace, key) is not None:
+                        # Cone searches are served from the cache anyway
+                        stats['cached'] += 1
+                        continue
+                    results.append((trgt, lookup(search, coordinates, radius)))
+            else:
+                for trgt in targets:
+                    if not refresh and cache.get_entry(trgt, normalize_object_name(item))[1] == FRESH:
+                        stats['cached'] += 1
+                        continue
+                    results.append((trgt, lookup(get_object_translation, item, trgt, False)))
+            for trgt, result in results:
+                if isinstance(result, dict):
+                    stats['errors'][trgt] += 1
+                    consecutive_errors += 1
+                    continue
+                consecutive_errors = 0
+                if not result or result == "0":
+                    stats['unknown'] += 1
+                else:
+                    stats['resolved'] += 1
+    duration = time.time() - stime
+    stats['duration'] = duration
+    stats['throughput'] = stats['lookups'] / duration if duration > 0 else 0.0
+    if cache.snapshot is not None:
+        cache.save_snapshot(current_app.config.get('OBJECTS_CACHE_SNAPSHOT_NAMESPACES', ['simbad', 'ned']))
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fill the object cache with the names from query logs or name lists')
+    parser.add_argument('files', nargs='+', help='log files or lists of object names ("-" for standard input)')
+    parser.add_argument('--plain', action='store_true', help='the files have one object name, position or query per line')
+    parser.add_argument('--target', default='simbad,ned', help='services to resolve names with (default: simbad,ned)')
+    parser.add_argument('--rate', type=float, default=5.0, help='maximum number of upstream lookups per second (default: 5)')
+    parser.add_argument('--batch-size', type=int, default=50, help='number of names per batch (default: 50)')
+    parser.add_argument('--max-errors', type=int, default=20, help='stop after this many consecutive upstream errors (default: 20)')
+    parser.add_argument('--limit', type=int, default=0, help='only resolve the most frequent names and positions')
+    parser.add_argument('--refresh', action='store_true', help='also resolve names that are in the cache already')
+    parser.add_argument('--dry-run', action='store_true', help='only list the names and positions found')
+    args = parser.parse_args(argv)
+
+    app = create_app()
+    with app.app_context():
+        if not current_app.config.get('OBJECTS_CACHE_REDIS_URL') and not current_app.config.get('OBJECTS_CACHE_SNAPSHOT'):
+            print('Warning: no shared cache or snapshot configured, the results will not be kept', file=sys.stderr)
+        names = Counter()
+        cones = Counter()
+        skipped = 0
+        for fname in args.files:
+            f = sys.stdin if fname == '-' else open(fname)
+            try:
+                n, c, s = read_queries(f, plain=args.plain)
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+            names.update(n)
+            cones.update(c)
+            skipped += s
+        if args.limit:
+            names = Counter(dict(names.most_common(args.limit)))
+            cones = Counter(dict(cones.most_common(args.limit)))
+        if args.dry_run:
+            for name, count in names.most_common():
+                print('%s\t%s' % (count, name))
+            for position, count in cones.most_common():
+                print('%s\t%s (cone)' % (count, position))
+            return 0
+        # Pick the TAP service the same way the service does
+        try:
+            current_app.config['OBJECTS_SIMBAD_TAP_URL'] = verify_tap_service()
+        except Exception:
+            current_app.config['OBJECTS_SIMBAD_TAP_URL'] = current_app.config.get('OBJECTS_SIMBAD_TAP_URL_CDS')
+        targets = [t.strip() for t in args.target.lower().split(',')]
+        stats = warm_up(names, cones, targets=targets, rate=args.rate, batch_size=args.batch_size,
+                        max_errors=args.max_errors, refresh=args.refresh)
+    print('Object names: %s, positions: %s, lines without object query: %s' % (stats['names'], stats['cones'], skipped))
+    print('Upstream lookups: %s in %.1f s (%.2f/s)' % (stats['lookups'], stats['duration'], stats['throughput']))
+    print('Already cached: %s, resolved: %s, unknown: %s, skipped: %s' % (stats['cached'], stats['resolved'], stats['unknown'], stats['skipped']))
+    print('Upstream errors: %s' % (', '.join('%s %s' % (k.upper(), v) for k, v in sorted(stats['errors'].items())) or 'none'))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())